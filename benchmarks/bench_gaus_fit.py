@@ -0,0 +1,84 @@
+'''
+Benchmark of the batched NumPy Gaussian fits against the per-slice ROOT TH1::Fit loop
+used in compute_reso, on synthetic sWeighted d0xy distributions
+
+Usage: python benchmarks/bench_gaus_fit.py [--ncand N] [--nslices N] [--repeat N]
+'''
+import argparse
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from hist_utils import uniform_bin_index, variable_bin_index, stacked_histogram, stacked_stats # pylint: disable=wrong-import-position
+from fit_utils import fit_gaus_batched # pylint: disable=wrong-import-position
+
+N_BINS, XMIN, XMAX = 1600, -0.8, 0.8
+FIT_MIN, FIT_MAX = -0.005, 0.005
+
+def make_stack(ncand, nslices, seed=42):
+    '''
+    Stacked d0xy histograms with a phi-dependent Gaussian core and sWeight-like weights
+    '''
+    rng = np.random.default_rng(seed)
+    phi = rng.uniform(0, 2 * np.pi, ncand)
+    dca = rng.normal(1.e-4 * np.sin(phi), 0.002 + 3.e-4 * np.cos(phi))
+    weights = rng.normal(1., 0.3, ncand)
+    phi_idx = variable_bin_index(phi, np.linspace(0, 2 * np.pi, nslices + 1))
+    dca_idx = uniform_bin_index(dca, N_BINS, XMIN, XMAX)
+    sumw, sumw2 = stacked_histogram(phi_idx, dca_idx, nslices, N_BINS, weights)
+    in_range = (dca_idx > 0) & (dca_idx <= N_BINS)
+    stats = stacked_stats(phi_idx[in_range], nslices, weights[in_range], dca[in_range])
+    return sumw[1:-1, 1:-1], sumw2[1:-1, 1:-1], stats[1:-1]
+
+def fit_numpy(sumw, sumw2, stats):
+    edges = np.linspace(XMIN, XMAX, N_BINS + 1)
+    mean = stats[:, 2] / stats[:, 0]
+    rms = np.sqrt(stats[:, 3] / stats[:, 0] - mean**2)
+    init = np.stack([sumw.max(axis=1), mean, rms], axis=1)
+    res = fit_gaus_batched(0.5 * (edges[1:] + edges[:-1]), sumw, sumw2, FIT_MIN, FIT_MAX, init)
+    return res['mu'], res['sigma']
+
+def fit_root(sumw, sumw2):
+    import ROOT # pylint: disable=import-outside-toplevel
+    mus, sigmas = [], []
+    for islice, (content, err2) in enumerate(zip(sumw, sumw2)):
+        hist = ROOT.TH1F(f'hbench{islice}', '', N_BINS, XMIN, XMAX)
+        hist.Sumw2()
+        for ibin, (cont, err) in enumerate(zip(content, err2)):
+            hist.SetBinContent(ibin + 1, cont)
+            hist.SetBinError(ibin + 1, np.sqrt(err))
+        func = ROOT.TF1(f'fbench{islice}', 'gaus', FIT_MIN, FIT_MAX)
+        func.SetParameters(hist.GetMaximum(), hist.GetMean(), hist.GetRMS())
+        hist.Fit(func, 'RQ0')
+        mus.append(func.GetParameter(1))
+        sigmas.append(func.GetParameter(2))
+    return np.array(mus), np.array(sigmas)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the batched Gaussian fits')
+    parser.add_argument('--ncand', type=int, default=1000000, help='Number of synthetic candidates')
+    parser.add_argument('--nslices', type=int, default=16, help='Number of fitted slices')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of repetitions')
+    args = parser.parse_args()
+
+    sumw, sumw2, stats = make_stack(args.ncand, args.nslices)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        mu_np, sigma_np = fit_numpy(sumw, sumw2, stats)
+    time_np = (time.perf_counter() - start) / args.repeat
+    print(f'numpy batched fit: {time_np*1.e3:.2f} ms for {args.nslices} slices')
+
+    try:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            mu_root, sigma_root = fit_root(sumw, sumw2)
+        time_root = (time.perf_counter() - start) / args.repeat
+    except ImportError:
+        print('ROOT not available, per-slice loop not benchmarked')
+    else:
+        print(f'ROOT per-slice fit: {time_root*1.e3:.2f} ms for {args.nslices} slices '
+              f'(speed-up x{time_root / time_np:.1f})')
+        print(f'max |delta mu| = {np.max(np.abs(mu_np - mu_root)):.3e}, '
+              f'max |delta sigma| / sigma = {np.max(np.abs(sigma_np - sigma_root) / sigma_root):.3e}')
@@ -0,0 +1,254 @@
+'''
+Benchmark of the whole pipeline on synthetic candidates (see make_candidates): splot_fit.process,
+cube_utils.build_cubes, compute_reso.compute_reso and plot_data_vs_mc, each run in a fresh process to
+measure its wall time per stage, its throughput (input rows/s) and its peak memory, overall and (on Linux)
+per stage. The steps whose dependencies (flarefly, ROOT) are missing are skipped; without flarefly the
+results store is written from the true signal flag.
+
+Usage: python benchmarks/bench_pipeline.py WORK_DIR [--ncand N] [--nfiles N] [--ndfs N] [--nmc N]
+                                          [--jobs N] [--threads N] [--formats ...] [--n-replicas N]
+                                          [--output results.json]
+'''
+import argparse
+import os
+import sys
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import yaml
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from make_candidates import write_ao2d, write_mc, iterate_truth # pylint: disable=wrong-import-position
+from fit_monitor import STAGES, get_peak_rss_mb, load_fit_log, peak_rss, timed # pylint: disable=wrong-import-position
+from io_utils import get_preselection, preselection_mask, read_candidates # pylint: disable=wrong-import-position
+from store_utils import get_partition, get_store_dir, write_bin # pylint: disable=wrong-import-position
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'config_file_pp.yml')
+
+def make_config(work_dir, gen_dir, threads=None, formats=('png',), template=TEMPLATE):
+    '''
+    Configuration of the benchmark: binning and fit settings of the template, synthetic inputs,
+    outputs in the work directory and no fit cache
+    '''
+    with open(template, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    cfg['inputs'].update({'data': os.path.join(gen_dir, 'AO2D_synthetic_*.root'),
+                          'fTreeDmeson': 'DF_*/O2hfcharmcandlite', 'threads': threads})
+    cfg['output'].update({'dir': os.path.join(work_dir, 'output'), 'suffix': '', 'store': None})
+    cfg['output']['export'] = {**cfg['output'].get('export', {}), 'formats': list(formats), 'only_if_changed': False}
+    cfg['cache'] = {'dir': None}
+    cfg_file_name = os.path.join(work_dir, 'config_bench.yml')
+    with open(cfg_file_name, 'w') as cfg_file:
+        yaml.safe_dump(cfg, cfg_file)
+    return cfg_file_name, cfg
+
+def get_selections(cfg):
+    '''
+    Partition selections of the bins of a configuration, with their mass ranges
+    '''
+    n_bins = len(cfg['pt_mins'])
+    mass_mins = cfg.get('mass_mins') or [-9999] * n_bins
+    mass_maxs = cfg.get('mass_maxs') or [9999] * n_bins
+    selections = []
+    for cent_min, cent_max in zip(cfg['cent_bins'][:-1], cfg['cent_bins'][1:]):
+        for pt_min, pt_max, bkg_max, sig_min, mass_min, mass_max in zip(
+                cfg['pt_mins'], cfg['pt_maxs'], cfg['bdt_bkg_bins'], cfg['bdt_sgn_bins'], mass_mins, mass_maxs):
+            selections.append(({'cent_min': cent_min, 'cent_max': cent_max, 'pt_min': pt_min, 'pt_max': pt_max,
+                                'bkg_max': bkg_max, 'sig_min': sig_min}, (mass_min, mass_max)))
+    return selections
+
+def measure(func, args):
+    '''
+    Run func(*args), which returns its stage times and row count, and add the total time and peak memory
+    '''
+    result = {}
+    with timed(result, 'wall_time'):
+        result.update(func(*args))
+    result['rows_per_s'] = result['rows'] / result['wall_time'] if result['wall_time'] > 0 else 0.
+    result['peak_rss_mb'] = get_peak_rss_mb()
+    return result
+
+def run_isolated(func, *args):
+    '''
+    Measure func in a new (spawned) process, so that the peak memory is that of the step alone
+    '''
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(measure, func, args).result()
+
+def bench_read(cfg_file_name, ncand):
+    '''
+    io_utils.read_candidates alone: tree reading, decompression and preselection of the input files
+    '''
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    stages = {}
+    with peak_rss(stages, 'read_peak_rss_mb'), timed(stages, 'read_time'):
+        df = read_candidates(cfg)
+    return {'rows': ncand, 'stages': {**stages, 'preselected': len(df)}}
+
+def bench_splot(cfg_file_name, jobs, ncand):
+    '''
+    splot_fit.process, with the stage times summed over the bins from its fit log
+    '''
+    import splot_fit # pylint: disable=import-outside-toplevel
+    splot_fit.process(cfg_file_name, jobs)
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    df_bins, run_record = load_fit_log(os.path.join(cfg['output']['dir'] + cfg['output']['suffix'], 'fit_log.jsonl'))
+    stages = {'read_time': run_record['read_time'], **{stage: float(df_bins[stage].sum()) for stage in STAGES},
+              'read_peak_rss_mb': run_record['read_peak_rss_mb'], 'bin_peak_rss_mb': float(df_bins['peak_rss_mb'].max())}
+    return {'rows': ncand, 'stages': stages}
+
+def bench_truth_store(cfg_file_name, ncand, nfiles, ndfs):
+    '''
+    Results store written from the generated candidates, with the true signal flag as sWeights
+    (replaces splot_fit when flarefly is not available)
+    '''
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    presel = get_preselection(cfg)
+    selections = get_selections(cfg)
+    bins = [[] for _ in selections]
+    stages = {}
+    for arrays, is_sgn in iterate_truth(ncand, nfiles, ndfs):
+        with timed(stages, 'select_time'):
+            mask = preselection_mask(arrays, presel)
+            arrays = {key: val[mask] for key, val in arrays.items()}
+            arrays['sgn_sweights'] = is_sgn[mask].astype(np.float32)
+            for (selection, (mass_min, mass_max)), chunks in zip(selections, bins):
+                in_bin = (arrays['fPt'] > selection['pt_min']) & (arrays['fPt'] < selection['pt_max']) & \
+                         (arrays['fMlScoreBkg'] > 0) & (arrays['fMlScoreBkg'] < selection['bkg_max']) & \
+                         (arrays['fMlScoreNonPrompt'] > selection['sig_min']) & \
+                         (arrays['fM'] > mass_min) & (arrays['fM'] < mass_max)
+                chunks.append({key: val[in_bin] for key, val in arrays.items()})
+    with timed(stages, 'write_time'):
+        for (selection, _), chunks in zip(selections, bins):
+            df_bin = pd.DataFrame({key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]})
+            write_bin(get_store_dir(cfg), df_bin, get_partition(**selection))
+    return {'rows': ncand, 'stages': stages}
+
+def bench_cubes(cfg_file_name):
+    '''
+    cube_utils.build_cubes on the store, then the phi and d0xy histograms of each bin projected from the cubes
+    '''
+    from cube_utils import build_cubes, get_cube_config, load_cubes, project_histogram # pylint: disable=import-outside-toplevel
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    stages = {}
+    with peak_rss(stages, 'fill_peak_rss_mb'), timed(stages, 'fill_time'):
+        build_cubes(cfg)
+    cube_dir, _ = get_cube_config(cfg)
+    rows = 0
+    for selection, _ in get_selections(cfg):
+        with timed(stages, 'load_time'):
+            cube = load_cubes(cube_dir, **selection)
+        rows += int(cube['entries'].sum())
+        with timed(stages, 'project_time'):
+            project_histogram(cube, 'phi', 100, 0, 2 * np.pi)
+            project_histogram(cube, 'd0xy', 1600, -0.8, 0.8)
+    return {'rows': rows, 'stages': stages}
+
+def bench_reso(cfg_file_name, work_dir, formats, n_replicas=0):
+    '''
+    compute_reso on each bin of the store: read, histogram and fit (with n_replicas bootstrap replicas), draw and write
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    import compute_reso # pylint: disable=import-outside-toplevel
+    from store_utils import read_bins # pylint: disable=import-outside-toplevel
+    ROOT.gROOT.SetBatch(True)
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    outdir = os.path.join(work_dir, 'reso')
+    os.makedirs(outdir, exist_ok=True)
+    outfile = ROOT.TFile(os.path.join(outdir, 'dxy_phi.root'), 'recreate')
+    ROOT.gROOT.cd()
+    stages, rows = {}, 0
+    peaks = {}
+    for selection, _ in get_selections(cfg):
+        with peak_rss(peaks, 'read'), timed(stages, 'read_time'):
+            df = read_bins(get_store_dir(cfg), columns=['fPhi', 'fImpactParameterXY', 'sgn_sweights'], **selection)
+        rows += len(df)
+        with peak_rss(peaks, 'fit'), timed(stages, 'fit_time'):
+            res = compute_reso.fit_reso(df, n_replicas=n_replicas)
+        del df
+        for stage, stage_peak in peaks.items():
+            stages[f'{stage}_peak_rss_mb'] = max(stages.get(f'{stage}_peak_rss_mb', 0.), stage_peak)
+        with timed(stages, 'draw_time'):
+            compute_reso.draw_reso(res, selection['pt_min'], selection['pt_max'], outdir, outfile, formats)
+    outfile.Close()
+    return {'rows': rows, 'stages': stages}
+
+def bench_data_vs_mc(cfg_file_name, work_dir, mc_file):
+    '''
+    plot_data_vs_mc on each bin of the store against the synthetic MC: read and plot
+    '''
+    import plot_data_vs_mc # pylint: disable=import-outside-toplevel
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    outdir = os.path.join(work_dir, 'data_vs_mc')
+    os.makedirs(outdir, exist_ok=True)
+    stages, rows = {}, 0
+    for selection, _ in get_selections(cfg):
+        with timed(stages, 'read_time'):
+            comparison = plot_data_vs_mc.compare_data_vs_mc(get_store_dir(cfg), selection, mc_file,
+                                                            f"ML_output_Bkg < {selection['bkg_max']}")
+        rows += int(comparison['data']['entries'].sum() + comparison['mc']['entries'].sum())
+        with timed(stages, 'plot_time'):
+            plot_data_vs_mc.plot_data_vs_mc(comparison, f"pt_{selection['pt_min']}_{selection['pt_max']}", outdir)
+    return {'rows': rows, 'stages': stages}
+
+def print_result(name, result):
+    units = {'_time': '{:.2f} s', '_mb': '{:.0f} MB'}
+    stages = ', '.join(f'{stage} ' + next((fmt for suffix, fmt in units.items() if stage.endswith(suffix)), '{}').format(value)
+                       for stage, value in result['stages'].items())
+    print(f"{name:>12}: {result['wall_time']:8.2f} s, {result['rows_per_s']:12.0f} rows/s, "
+          f"peak RSS {result['peak_rss_mb']:7.0f} MB ({stages})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the pipeline on synthetic candidates')
+    parser.add_argument('work_dir', help='Directory of the synthetic inputs and of the outputs')
+    parser.add_argument('--ncand', type=int, default=1000000, help='Number of synthetic candidates')
+    parser.add_argument('--nfiles', type=int, default=1, help='Number of AO2D files')
+    parser.add_argument('--ndfs', type=int, default=4, help='Number of DF_* trees per file')
+    parser.add_argument('--nmc', type=int, default=1000000, help='Number of MC candidates')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Bins fitted in parallel by splot_fit')
+    parser.add_argument('--threads', type=int, default=None, help='Threads reading the input, all the cores if not set')
+    parser.add_argument('--formats', nargs='*', default=['png'], help='Image formats, none to skip the images')
+    parser.add_argument('--n-replicas', type=int, default=0, help='Bootstrap replicas of the resolution fits')
+    parser.add_argument('--regenerate', action='store_true', help='Write the synthetic inputs even if they exist')
+    parser.add_argument('--output', help='JSON file with the results, to compare the runs')
+    args = parser.parse_args()
+
+    gen_dir = os.path.join(args.work_dir, f'inputs_{args.ncand}_{args.nfiles}x{args.ndfs}')
+    mc_file = os.path.join(args.work_dir, f'MC_synthetic_{args.nmc}.parquet.gzip')
+    if args.regenerate or not os.path.isdir(gen_dir):
+        print(f'Writing {args.ncand} candidates to {gen_dir}')
+        write_ao2d(gen_dir, args.ncand, args.nfiles, args.ndfs)
+    if args.regenerate or not os.path.isfile(mc_file):
+        write_mc(mc_file, args.nmc)
+    cfg_file_name, _ = make_config(args.work_dir, gen_dir, args.threads, args.formats)
+
+    results = {'ncand': args.ncand, 'nfiles': args.nfiles, 'ndfs': args.ndfs, 'nmc': args.nmc,
+               'jobs': args.jobs, 'threads': args.threads, 'cpus': os.cpu_count(), 'steps': {}}
+    results['steps']['read'] = run_isolated(bench_read, cfg_file_name, args.ncand)
+    try:
+        results['steps']['splot_fit'] = run_isolated(bench_splot, cfg_file_name, args.jobs, args.ncand)
+    except ImportError as exc:
+        print(f'splot_fit not benchmarked ({exc}), store written from the true signal flag')
+        results['steps']['truth_store'] = run_isolated(bench_truth_store, cfg_file_name, args.ncand, args.nfiles, args.ndfs)
+    results['steps']['cubes'] = run_isolated(bench_cubes, cfg_file_name)
+    try:
+        results['steps']['compute_reso'] = run_isolated(bench_reso, cfg_file_name, args.work_dir, args.formats, args.n_replicas)
+    except ImportError as exc:
+        print(f'compute_reso not benchmarked ({exc})')
+    try:
+        results['steps']['data_vs_mc'] = run_isolated(bench_data_vs_mc, cfg_file_name, args.work_dir, mc_file)
+    except ImportError as exc:
+        print(f'plot_data_vs_mc not benchmarked ({exc})')
+
+    for name, result in results['steps'].items():
+        print_result(name, result)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump(results, out_file, indent=1)
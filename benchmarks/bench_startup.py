@@ -0,0 +1,100 @@
+'''
+Benchmark of the startup of the entry-point scripts: each module is imported in a fresh interpreter with
+python -X importtime, and its cumulative import time is compared with a budget. The heaviest top-level
+packages are listed, and the check fails if a package that should only be loaded when fitting or drawing
+(ROOT, flarefly, zfit, matplotlib, ...) is imported at startup. The exit code is 1 if a module is over
+budget, loads a deferred package or cannot be imported, so that the benchmark can be used as a check.
+
+Usage: python benchmarks/bench_startup.py [MODULE ...] [--budget-ms MS] [--repeat N] [--top N]
+                                          [--output results.json]
+'''
+import argparse
+import os
+import sys
+import json
+import subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ['splot_fit', 'compute_reso', 'cube_utils', 'plot_data_vs_mc', 'fit_monitor']
+# loaded by the functions that fit or draw, never when importing the scripts
+DEFERRED = ['ROOT', 'flarefly', 'zfit', 'tensorflow', 'matplotlib', 'seaborn', 'uproot', 'scipy']
+
+def parse_importtime(stderr):
+    '''
+    Import times of the -X importtime output
+
+    Returns:
+        list: (module, self time, cumulative time) in microseconds, in import order
+    '''
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+def measure_import(module):
+    '''
+    Import a module in a fresh interpreter, from the repository directory
+
+    Returns:
+        dict: cumulative import time (ms), self time of each top-level package (ms) and the error if the import failed
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=REPO_DIR,
+                          capture_output=True, text=True, check=False)
+    imports = parse_importtime(proc.stderr)
+    packages = {}
+    for name, self_us, _ in imports:
+        top = name.split('.')[0]
+        packages[top] = packages.get(top, 0.) + self_us / 1000.
+    total = next((cumulative_us / 1000. for name, _, cumulative_us in reversed(imports) if name == module), None)
+    error = proc.stderr.strip().splitlines()[-1] if proc.returncode != 0 else None
+    return {'total_ms': total, 'packages': packages, 'error': error}
+
+def bench_startup(module, repeat=3):
+    '''
+    Fastest of repeat imports of a module (the first one also compiles the bytecode of the changed files)
+
+    Returns:
+        dict: as measure_import, with the deferred packages that were imported
+    '''
+    results = [measure_import(module) for _ in range(repeat)]
+    failed = [result for result in results if result['error'] is not None]
+    result = failed[0] if failed else min(results, key=lambda res: res['total_ms'])
+    result['deferred'] = [name for name in DEFERRED if name in result['packages']]
+    return result
+
+def print_result(module, result, budget_ms, top=5):
+    if result['error'] is not None:
+        print(f"{module:<18} import failed: {result['error']}")
+        return
+    status = 'OK' if result['total_ms'] <= budget_ms else 'OVER BUDGET'
+    print(f"{module:<18} {result['total_ms']:8.1f} ms  {status}")
+    heaviest = sorted(result['packages'].items(), key=lambda item: -item[1])[:top]
+    print('    ' + ', '.join(f'{name} {time_ms:.1f} ms' for name, time_ms in heaviest))
+    if result['deferred']:
+        print(f"    loaded at startup instead of when used: {', '.join(result['deferred'])}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import time of the entry-point scripts against a budget')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='Modules to import, the entry points if not given')
+    parser.add_argument('--budget-ms', type=float, default=1000., help='Maximum cumulative import time of each module')
+    parser.add_argument('--repeat', type=int, default=3, help='Imports of each module, the fastest is kept')
+    parser.add_argument('--top', type=int, default=5, help='Number of heaviest packages listed per module')
+    parser.add_argument('--output', help='JSON file with the results, to compare the runs')
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.modules:
+        results[module] = bench_startup(module, args.repeat)
+        print_result(module, results[module], args.budget_ms, args.top)
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump({'budget_ms': args.budget_ms, 'results': results}, out_file, indent=2)
+    failed = [module for module, result in results.items() if result['error'] is not None or result['deferred']
+              or result['total_ms'] > args.budget_ms]
+    if failed:
+        print(f"Startup check failed for {', '.join(failed)}")
+        sys.exit(1)
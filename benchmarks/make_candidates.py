@@ -0,0 +1,140 @@
+'''
+Synthetic D+ candidates shaped like the O2hfcharmcandlite trees, for benchmarks without the real AO2D inputs:
+a Gaussian D+ peak over an exponential background in fM, pT spectra, a phi acceptance with the 18 TPC
+sectors, pT- and phi-dependent d0xy resolution (with a displaced non-prompt component) and BDT scores
+separating signal and background. The candidates are written to AO2D-like ROOT files (DF_*/O2hfcharmcandlite
+trees) and to a signal-only MC Parquet file with the ML_output_* columns of the MC samples.
+
+Usage: python benchmarks/make_candidates.py OUT_DIR [--ncand N] [--nfiles N] [--ndfs N] [--nmc N] [--seed N]
+'''
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+D_MASS = 1.8695 # GeV/c^2
+MASS_MIN, MASS_MAX = 1.7, 2.1
+TREE_NAME = 'O2hfcharmcandlite'
+CHUNK_SIZE = 1_000_000
+
+def sample_expo(rng, slope, xmin, xmax, size):
+    '''
+    Exponential exp(slope * x) truncated to [xmin, xmax], by inversion of the CDF
+    '''
+    u = rng.uniform(size=size)
+    return xmin + np.log1p(u * np.expm1(slope * (xmax - xmin))) / slope
+
+def sample_phi(rng, size, modulation=0.05, n_sectors=18):
+    '''
+    Azimuthal angle with an acceptance 1 + modulation * cos(n_sectors * phi), first-order inversion of the CDF
+    '''
+    u = rng.uniform(0, 2 * np.pi, size)
+    return np.mod(u - modulation * np.sin(n_sectors * u) / n_sectors, 2 * np.pi)
+
+def get_d0xy_resolution(pt, phi):
+    '''
+    Width of the d0xy distribution (cm), worse at low pT and modulated by the sectors
+    '''
+    return (0.0015 + 0.004 / pt) * (1 + 0.1 * np.cos(18 * phi))
+
+def generate_candidates(size, seed=42, sig_frac=0.1, nonprompt_frac=0.1):
+    '''
+    Generate candidates with the branches read by the pipeline (float32, as in the AO2D)
+
+    Returns:
+        tuple: (dict branch -> array, boolean array flagging the signal candidates)
+    '''
+    rng = np.random.default_rng(seed)
+    is_sgn = rng.uniform(size=size) < sig_frac
+    is_nonprompt = is_sgn & (rng.uniform(size=size) < nonprompt_frac)
+    n_sgn = int(is_sgn.sum())
+
+    pt = np.where(is_sgn, 1 + rng.gamma(2.2, 1.6, size), 1 + rng.gamma(1.6, 1.3, size))
+    phi = sample_phi(rng, size)
+    mass = sample_expo(rng, -2., MASS_MIN, MASS_MAX, size)
+    mass[is_sgn] = rng.normal(D_MASS, 0.006 + 0.0008 * pt[is_sgn])
+
+    sigma_d0 = get_d0xy_resolution(pt, phi)
+    d0xy = rng.normal(0, np.where(is_sgn, 1., 2.) * sigma_d0)
+    # non-prompt D mesons come from displaced b-hadron decay vertices
+    d0xy[is_nonprompt] += rng.choice([-1, 1], int(is_nonprompt.sum())) * rng.exponential(0.01, int(is_nonprompt.sum()))
+
+    score_bkg = rng.beta(0.8, 3., size)
+    score_bkg[is_sgn] = rng.beta(0.5, 40., n_sgn)
+    score_nonprompt = rng.beta(1., 5., size)
+    score_nonprompt[is_sgn] = np.where(is_nonprompt[is_sgn], rng.beta(5., 2., n_sgn), rng.beta(1., 20., n_sgn))
+
+    arrays = {
+        'fM': mass, 'fPt': pt, 'fPhi': phi, 'fImpactParameterXY': d0xy,
+        'fMlScoreBkg': score_bkg, 'fMlScoreNonPrompt': score_nonprompt,
+        'fCentFT0C': rng.uniform(0, 100, size)
+    }
+    return {key: val.astype(np.float32) for key, val in arrays.items()}, is_sgn
+
+def get_chunks(ncand, seed, chunk_size=CHUNK_SIZE):
+    '''
+    Sizes and seeds of the chunks generating ncand candidates, reproducible for a given seed
+    '''
+    sizes = [min(chunk_size, ncand - start) for start in range(0, ncand, chunk_size)]
+    return [(size, seed * 100003 + ichunk) for ichunk, size in enumerate(sizes)]
+
+def write_ao2d(out_dir, ncand, nfiles=1, ndfs=1, seed=42, sig_frac=0.1):
+    '''
+    Write ncand candidates to nfiles AO2D-like files with ndfs DF_* trees each, chunk by chunk
+
+    Returns:
+        list: written file names
+    '''
+    import uproot # pylint: disable=import-outside-toplevel
+    os.makedirs(out_dir, exist_ok=True)
+    ntrees = nfiles * ndfs
+    file_names = []
+    for ifile in range(nfiles):
+        file_name = os.path.join(out_dir, f'AO2D_synthetic_{ifile}.root')
+        with uproot.recreate(file_name) as outfile:
+            for idf in range(ndfs):
+                itree = ifile * ndfs + idf
+                tree = None
+                for size, chunk_seed in get_chunks(ncand // ntrees + (itree < ncand % ntrees), seed + itree):
+                    arrays, _ = generate_candidates(size, chunk_seed, sig_frac)
+                    if tree is None:
+                        tree = outfile.mktree(f'DF_{2000000000000000 + itree}/{TREE_NAME}',
+                                              {key: val.dtype for key, val in arrays.items()})
+                    tree.extend(arrays)
+        file_names.append(file_name)
+    return file_names
+
+def iterate_truth(ncand, nfiles=1, ndfs=1, seed=42, sig_frac=0.1):
+    '''
+    Candidates written by write_ao2d with the same arguments, chunk by chunk, with the true signal flag
+    '''
+    ntrees = nfiles * ndfs
+    for itree in range(ntrees):
+        for size, chunk_seed in get_chunks(ncand // ntrees + (itree < ncand % ntrees), seed + itree):
+            yield generate_candidates(size, chunk_seed, sig_frac)
+
+def write_mc(file_name, ncand, seed=4242):
+    '''
+    Write a signal-only MC sample in the format of the MC Parquet files (ML_output_* scores)
+    '''
+    arrays, _ = generate_candidates(ncand, seed, sig_frac=1.)
+    df_mc = pd.DataFrame({'fM': arrays['fM'], 'fPt': arrays['fPt'], 'fPhi': arrays['fPhi'],
+                          'fImpactParameterXY': arrays['fImpactParameterXY'],
+                          'ML_output_Bkg': arrays['fMlScoreBkg'], 'ML_output_FD': arrays['fMlScoreNonPrompt']})
+    df_mc.to_parquet(file_name, engine='pyarrow', compression='gzip')
+    return file_name
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic D+ candidates')
+    parser.add_argument('out_dir', help='Output directory')
+    parser.add_argument('--ncand', type=int, default=1000000, help='Number of candidates in the AO2D files')
+    parser.add_argument('--nfiles', type=int, default=1, help='Number of AO2D files')
+    parser.add_argument('--ndfs', type=int, default=1, help='Number of DF_* trees per file')
+    parser.add_argument('--nmc', type=int, default=100000, help='Number of MC candidates, 0 for no MC file')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    args = parser.parse_args()
+
+    for name in write_ao2d(args.out_dir, args.ncand, args.nfiles, args.ndfs, args.seed):
+        print(f'Written {name}')
+    if args.nmc > 0:
+        print(f"Written {write_mc(os.path.join(args.out_dir, 'MC_synthetic.parquet.gzip'), args.nmc)}")
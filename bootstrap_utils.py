@@ -0,0 +1,110 @@
+'''
+Poisson-bootstrap uncertainties of the d0xy resolution fits. Each replica reweights every candidate by an
+independent Poisson(1) count, so that the replicas are a (replica x candidate) weight matrix, generated
+chunk by chunk. The replicas are histogrammed in the phi slices and in the d0xy bins of the fit range with
+one bincount per chunk, and the (replica x phi) histograms are all fitted at once with fit_gaus_batched.
+The spread of the replicas includes the correlation of mu and sigma (for the sigma/mu ratio) and of the
+phi slices; the sWeights are kept at their nominal values, the mass fits are not repeated.
+'''
+import math
+import warnings
+import numpy as np
+
+from hist_utils import uniform_bin_index, variable_bin_index
+from fit_utils import fit_gaus_batched, chunk_slices
+
+# quantiles of the central 68% interval, as +-1 sigma of a Gaussian
+ROBUST_QUANTILES = [15.865525393145708, 50., 84.13447460685429]
+
+# Poisson(1) quantiles of 2^16 uniform 16-bit integers: drawing the counts by table lookup is several
+# times faster than rng.poisson, the probabilities being exact to 1/2^16 (counts above 8 are not drawn)
+_POISSON_CDF = np.cumsum([math.exp(-1.) / math.factorial(k) for k in range(20)])
+_POISSON_TABLE = np.searchsorted(_POISSON_CDF, (np.arange(1 << 16) + 0.5) / (1 << 16), side='right').astype(np.uint8)
+
+def poisson_replicas(n_entries, n_replicas, rng):
+    '''
+    Poisson(1) weights of the entries in each replica
+
+    Returns:
+        np.ndarray: uint8 array of shape (n_replicas, n_entries)
+    '''
+    return _POISSON_TABLE[rng.integers(0, 1 << 16, (n_replicas, n_entries), dtype=np.uint16)]
+
+def bootstrap_histograms(dca, phi, weights, phi_edges, n_bins, xmin, xmax, n_replicas=200, seed=42,
+                         chunk_size=10_000_000):
+    '''
+    sWeighted d0xy histograms of the phi slices in each bootstrap replica, only for the bins of the
+    d0xy binning of fit_reso (n_bins in [-0.8, 0.8]) whose centres are in the fit range [xmin, xmax].
+    The candidates on the phi edges are excluded, as in fit_reso. The replica weights of each chunk
+    of candidates are drawn from a generator seeded by (seed, chunk), so the replicas are reproducible,
+    and chunk_size bounds the size of the (replica x candidate) weight matrix of a chunk.
+
+    Returns:
+        tuple: (bin centres, sumw and sumw2 of shape (n_replicas, nphibins, bins in the fit range))
+    '''
+    nphibins = len(phi_edges) - 1
+    dca_edges = np.linspace(-0.8, 0.8, n_bins + 1)
+    centers = 0.5 * (dca_edges[1:] + dca_edges[:-1])
+    fit_bins = np.flatnonzero((centers >= xmin) & (centers <= xmax)) + 1
+    n_fit_bins = len(fit_bins)
+
+    # only the candidates in the fitted bins are resampled
+    dca_idx = uniform_bin_index(dca, n_bins, -0.8, 0.8)
+    phi_idx = np.where(np.isin(phi, phi_edges), 0, variable_bin_index(phi, phi_edges))
+    selected = (phi_idx > 0) & (phi_idx <= nphibins) & np.isin(dca_idx, fit_bins)
+    cells = (phi_idx[selected] - 1) * n_fit_bins + dca_idx[selected] - (fit_bins[0] if n_fit_bins else 0)
+    sel_weights = np.asarray(weights, dtype=np.float64)[selected]
+
+    n_cells = nphibins * n_fit_bins
+    sumw = np.zeros(n_replicas * n_cells)
+    sumw2 = np.zeros(n_replicas * n_cells)
+    replica_offsets = (np.arange(n_replicas) * n_cells)[:, None]
+    for ichunk, chunk in enumerate(chunk_slices(len(cells), max(chunk_size // max(n_replicas, 1), 1))):
+        rng = np.random.default_rng([seed, ichunk])
+        replica_weights = np.multiply(poisson_replicas(chunk.stop - chunk.start, n_replicas, rng), sel_weights[chunk])
+        flat_idx = (replica_offsets + cells[chunk]).ravel()
+        sumw += np.bincount(flat_idx, weights=replica_weights.ravel(), minlength=n_replicas * n_cells)
+        replica_weights *= replica_weights
+        sumw2 += np.bincount(flat_idx, weights=replica_weights.ravel(), minlength=n_replicas * n_cells)
+    shape = (n_replicas, nphibins, n_fit_bins)
+    return centers[fit_bins - 1], sumw.reshape(shape), sumw2.reshape(shape)
+
+def get_robust_spread(values):
+    '''
+    Robust spread of the replicas (first axis), ignoring the NaN ones (e.g. failed fits):
+    half width of the central 68% interval, its bounds, the median and the number of valid replicas
+
+    Returns:
+        dict: err, low, median, high and n_valid arrays
+    '''
+    valid = np.isfinite(values)
+    with warnings.catch_warnings():
+        # slices without any valid replica are NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, median, high = (np.nanpercentile(np.where(valid, values, np.nan), ROBUST_QUANTILES, axis=0)
+                             if values.size else np.full((3,) + values.shape[1:], np.nan))
+    return {'err': 0.5 * (high - low), 'low': low, 'median': median, 'high': high, 'n_valid': valid.sum(axis=0)}
+
+def bootstrap_reso(dca, phi, weights, phi_edges, n_bins, xmin, xmax, init, n_replicas=200, seed=42,
+                   chunk_size=10_000_000):
+    '''
+    Bootstrap uncertainties of the Gaussian fits of fit_reso: the replicas of all the phi slices are
+    fitted in one batch, starting from the nominal parameters (init, shape (nphibins, 3))
+
+    Returns:
+        dict: number of replicas, robust spread (get_robust_spread) of mu, sigma and sigma/mu in each phi
+        slice, and the fraction of converged replica fits
+    '''
+    nphibins = len(phi_edges) - 1
+    centers, sumw, sumw2 = bootstrap_histograms(dca, phi, weights, phi_edges, n_bins, xmin, xmax,
+                                                n_replicas, seed, chunk_size)
+    init = np.nan_to_num(np.asarray(init, dtype=np.float64))
+    fit = fit_gaus_batched(centers, sumw.reshape(n_replicas * nphibins, -1), sumw2.reshape(n_replicas * nphibins, -1),
+                           xmin, xmax, np.tile(init, (n_replicas, 1)))
+    converged = fit['converged'].reshape(n_replicas, nphibins)
+    mu = np.where(converged, fit['mu'].reshape(n_replicas, nphibins), np.nan)
+    sigma = np.where(converged, fit['sigma'].reshape(n_replicas, nphibins), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reso = sigma / mu
+    return {'n_replicas': n_replicas, 'mu': get_robust_spread(mu), 'sigma': get_robust_spread(sigma),
+            'reso': get_robust_spread(reso), 'converged_frac': converged.mean(axis=0)}
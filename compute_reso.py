@@ -1,128 +1,307 @@
 #!/usr/bin/env python
-import ROOT
-from ROOT import gStyle
-import pandas as pd
+import argparse
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import yaml
 
-from plot_utils import LoadGraphAndSyst, GetCanvas, GetLegend, GetCanvas3sub, SaveCanvas, SetGlobalStyle, SetObjectStyle
+from plot_utils import LoadGraphAndSyst, GetCanvas, GetLegend, GetCanvas3sub, SaveCanvas, SetGlobalStyle, SetObjectStyle, FillHistFromArrays, SetBatchMode
+from hist_utils import uniform_bin_index, variable_bin_index, stacked_histogram, stacked_stats, weighted_stats
+from stats_utils import get_moments
+from fit_utils import fit_gaus_batched, chunk_slices
+from bootstrap_utils import bootstrap_reso
+from fit_cache import get_file_identity
+from store_utils import read_bins, get_bin_files, get_bin_partitions, get_path_partition, get_store_dir
+from export_utils import get_inputs_hash
+from manifest_utils import is_up_to_date, write_manifest, save_arrays, load_arrays
+from cube_utils import check_binning, get_cells, get_cube_config, get_cube_files, load_cubes
+from maps_utils import build_maps, get_slice_values, save_maps
 
 
-SetGlobalStyle(padleftmargin=0.16, padrightmargin=0.16, padbottommargin=0.14, padtopmargin=0.08,
-               opttitle=1, titleoffsety=1.6, labelsize=0.05, titlesize=0.05,
-               labeloffset=0.01, titleoffset=1.2, labelfont=42, titlefont=42)
+# ROOT colours of the pT bins in the summaries, as (colour, offset), resolved when drawing
+COLORS = [('kRed', -4), ('kAzure', -2), ('kOrange', 1), ('kSpring', 2), ('kViolet', 1), ('kTeal', 3), ('kMagenta', 1), ('kGray', 2)]
+_STYLE = {'set': False}
 
-# Alternative: RGB format
-cols = [
-    ROOT.kRed-4,
-    ROOT.kAzure-2,
-    ROOT.kOrange+1,
-    ROOT.kSpring+2
-]
+def set_reso_style():
+    '''
+    Global ROOT style of the resolution plots, set once per process before the first histogram is built
+    (ROOT is only loaded when something is drawn, so that the fits and the CLI start without it)
+    '''
+    if not _STYLE['set']:
+        SetGlobalStyle(padleftmargin=0.16, padrightmargin=0.16, padbottommargin=0.14, padtopmargin=0.08,
+                       opttitle=1, titleoffsety=1.6, labelsize=0.05, titlesize=0.05,
+                       labeloffset=0.01, titleoffset=1.2, labelfont=42, titlefont=42)
+        _STYLE['set'] = True
 
-def compute_reso(infile, ptmin, ptmax):
-    # Load the DataFrame from a .parquet file
-    # Replace 'data.parquet' with your actual file name if different.
-    df = pd.read_parquet(infile)
-    suffix = f'pt_{ptmin}_{ptmax}'
-    #label = "3 < #it{p}_{T} < 5 GeV/#it{c}"
-    latex = ROOT.TLatex()
-    latex.SetTextFont(42)
-    latex.SetTextSize(0.05)
+def get_color(index):
+    '''
+    ROOT colour of the index-th pT bin, cycling over COLORS
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    name, offset = COLORS[index % len(COLORS)]
+    return getattr(ROOT, name) + offset
+
+def fill_reso(dca, phi, weights, phi_edges, n_bins, weights2=None, counts=None):
+    '''
+    Histogram arrays of fit_reso for a chunk of candidates; the arrays of consecutive chunks add up.
+    The entries can also be the cells of a finer histogram, with their sums of squared weights
+    (weights2) and their number of entries (counts)
+
+    Returns:
+        dict: th2_* and dca_* histogram arrays and statistics
+    '''
+    nphibins = len(phi_edges) - 1
+    phi_idx = variable_bin_index(phi, phi_edges)
+
+    th2_dca_idx = uniform_bin_index(dca, 60, -0.015, 0.015)
+    th2_sumw, th2_sumw2 = stacked_histogram(th2_dca_idx, phi_idx, 60, nphibins, weights, weights2)
+    th2_in_range = (phi_idx > 0) & (phi_idx <= nphibins) & (th2_dca_idx > 0) & (th2_dca_idx <= 60)
+    th2_stats = weighted_stats(weights[th2_in_range], phi[th2_in_range], dca[th2_in_range],
+                               None if weights2 is None else weights2[th2_in_range])
 
+    # per-phi histograms only take candidates strictly inside the phi bin
+    phi_strict_idx = np.where(np.isin(phi, phi_edges), 0, phi_idx)
+    dca_idx = uniform_bin_index(dca, n_bins, -0.8, 0.8)
+    dca_sumw, dca_sumw2 = stacked_histogram(phi_strict_idx, dca_idx, nphibins, n_bins, weights, weights2)
+    dca_in_range = (dca_idx > 0) & (dca_idx <= n_bins)
+    dca_stats = stacked_stats(phi_strict_idx[dca_in_range], nphibins, weights[dca_in_range], dca[dca_in_range],
+                              None if weights2 is None else weights2[dca_in_range])
+    dca_entries = np.bincount(phi_strict_idx, weights=counts, minlength=nphibins + 2)
+    if counts is not None:
+        dca_entries = dca_entries.astype(np.int64)
+    return {
+        'th2_sumw': th2_sumw, 'th2_sumw2': th2_sumw2, 'th2_stats': th2_stats,
+        'dca_sumw': dca_sumw, 'dca_sumw2': dca_sumw2, 'dca_stats': dca_stats, 'dca_entries': dca_entries
+    }
+
+def fit_reso(df, fit_backend='numpy', nphibins=16, n_bins=1600, xmin=-0.005, xmax=0.005, chunk_size=1_000_000,
+             n_replicas=0, seed=42):
+    '''
+    Histogram the sWeighted d0xy of the candidates in phi slices and fit each slice with a Gaussian.
+    No ROOT object is kept: the result can be rendered (or not) afterwards with draw_reso.
+    The columns are read as (float32) views and histogrammed chunk by chunk, so that the
+    float64 temporaries of the binning are bounded by chunk_size. With n_replicas > 0 the
+    uncertainties of mu, sigma and sigma/mu are also estimated with Poisson-bootstrap replicas
+    of the candidates (see bootstrap_utils)
+
+    Returns:
+        dict: phi edges, histogram arrays (ROOT layout, flow bins included), fit results
+        and, with replicas, their bootstrap uncertainties
+    '''
     # Specify the column to use (change "data" if your column has a different name)
     data_col = "fImpactParameterXY"
     data_weight = "sgn_sweights"
 
     # Determine histogram parameters based on the data
-    nphibins = 16
     phi_edges = np.linspace(0, 2 * np.pi, nphibins + 1)  # +1 to define bin edges correctly
 
-    n_bins = 1600 
-    xmin = -0.005
-    xmax = 0.005
+    # Fill all the histograms in a vectorised pass over each chunk of candidates
+    dca = df[data_col].to_numpy()
+    phi = df['fPhi'].to_numpy()
+    weights = df[data_weight].to_numpy()
+    hists = fill_reso(dca[:0], phi[:0], weights[:0], phi_edges, n_bins)
+    for chunk in chunk_slices(len(dca), chunk_size):
+        chunk_hists = fill_reso(dca[chunk], phi[chunk], weights[chunk], phi_edges, n_bins)
+        hists = {key: hists[key] + chunk_hists[key] for key in hists}
+
+    res = {'phi_edges': phi_edges, 'n_bins': n_bins, 'xmin': xmin, 'xmax': xmax, 'entries': float(len(dca)), **hists}
+    res['fit'] = fit_slices(res, fit_backend)
+    if n_replicas > 0:
+        init = np.stack([res['fit'][par] for par in ['norm', 'mu', 'sigma']], axis=1)
+        res['bootstrap'] = bootstrap_reso(dca, phi, weights, phi_edges, n_bins, xmin, xmax, init, n_replicas, seed)
+    return res
+
+def fit_reso_cube(cube, fit_backend='numpy', nphibins=16, n_bins=1600, xmin=-0.005, xmax=0.005):
+    '''
+    Same as fit_reso, from the histogram cube of the candidates (see cube_utils) instead of the candidates:
+    the phi and d0xy binnings must have edges on the cube edges, the cells are filled at the centres of their
+    bins (which only approximates the mean and RMS statistics) and entries on the phi edges are not excluded
 
-    # Draw results
-    canvas = ROOT.TCanvas("canvas", "Gaussian Fit with Tail Correction", 1600, 1600)
-    canvas.Divide(4, 4)
+    Returns:
+        dict: phi edges, histogram arrays (ROOT layout, flow bins included) and fit results
+    '''
+    phi_edges = np.linspace(0, 2 * np.pi, nphibins + 1)
+    check_binning(cube, 'phi', nphibins, 0, 2 * np.pi)
+    check_binning(cube, 'd0xy', n_bins, -0.8, 0.8)
+    check_binning(cube, 'd0xy', 60, -0.015, 0.015)
+    phi, dca = get_cells(cube, ['phi', 'd0xy'])
+    hists = fill_reso(dca, phi, cube['sumw'], phi_edges, n_bins, cube['sumw2'], cube['entries'])
+
+    res = {'phi_edges': phi_edges, 'n_bins': n_bins, 'xmin': xmin, 'xmax': xmax,
+           'entries': float(cube['entries'].sum()), **hists}
+    res['fit'] = fit_slices(res, fit_backend)
+    return res
+
+def fit_slices(res, fit_backend='numpy'):
+    '''
+    Gaussian fits of the d0xy histograms of the phi slices of a fit_reso result
+
+    Returns:
+        dict: fit parameters, errors and quality of each slice
+    '''
+    n_bins, xmin, xmax = res['n_bins'], res['xmin'], res['xmax']
+    dca_sumw, dca_sumw2, dca_stats = res['dca_sumw'], res['dca_sumw2'], res['dca_stats']
+
+    # Gaussian fits of all the phi slices at once, initialised as the per-slice TF1 prefit
+    # (maximum, mean and RMS of the histogram); the ROOT backend fits each slice with TH1::Fit
+    if fit_backend == 'numpy':
+        dca_edges = np.linspace(-0.8, 0.8, n_bins + 1)
+        dca_mean, dca_var = get_moments(dca_stats[1:-1, 0], dca_stats[1:-1, 2], dca_stats[1:-1, 3])
+        dca_rms = np.sqrt(dca_var)
+        fit_init = np.stack([dca_sumw[1:-1, 1:-1].max(axis=1), dca_mean, dca_rms], axis=1)
+        return fit_gaus_batched(0.5 * (dca_edges[1:] + dca_edges[:-1]), dca_sumw[1:-1, 1:-1],
+                                dca_sumw2[1:-1, 1:-1], xmin, xmax, fit_init)
+    return fit_gaus_root(res)
+
+def fit_gaus_root(res):
+    '''
+    Per-slice TH1::Fit of the phi slices of a fit_reso result, in the format of fit_gaus_batched
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    nphibins = len(res['phi_edges']) - 1
+    fit_res = {key: np.full(nphibins, np.nan) for key in ['norm', 'mu', 'sigma', 'norm_err', 'mu_err', 'sigma_err', 'chi2']}
+    fit_res['ndf'] = np.zeros(nphibins, dtype=np.int64)
+    fit_res['converged'] = np.zeros(nphibins, dtype=bool)
+    for iphi in range(1, nphibins + 1):
+        hist = ROOT.TH1F(f"hist_fit{iphi}", "", res['n_bins'], -0.8, 0.8)
+        FillHistFromArrays(hist, res['dca_sumw'][iphi], res['dca_sumw2'][iphi], res['dca_stats'][iphi],
+                           float(res['dca_entries'][iphi]))
+        fit = ROOT.TF1(f"gaus_fit{iphi}", "gaus", res['xmin'], res['xmax'])
+        fit.SetParameters(hist.GetMaximum(), hist.GetMean(), hist.GetRMS())
+        status = int(hist.Fit(fit, 'RQ0'))
+        for ipar, par in enumerate(['norm', 'mu', 'sigma']):
+            fit_res[par][iphi-1] = fit.GetParameter(ipar)
+            fit_res[f'{par}_err'][iphi-1] = fit.GetParError(ipar)
+        fit_res['chi2'][iphi-1] = fit.GetChisquare()
+        fit_res['ndf'][iphi-1] = fit.GetNDF()
+        fit_res['converged'][iphi-1] = status == 0
+    return fit_res
+
+def get_fit_hists(res, name_suffix=''):
+    '''
+    Histograms vs phi of the mean, width and width/mean of the Gaussian fits of a fit_reso result
+
+    Returns:
+        tuple: (hmu, hrms, hreso)
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    set_reso_style()
+    phi_edges = np.array(res['phi_edges'], dtype=np.float64)
+    nphibins = len(phi_edges) - 1
+    fit_res = res['fit']
+    hmu = ROOT.TH1F(f"histmu{name_suffix}", ";#varphi; #mu(#it{d^{0}_{xy}})", nphibins, phi_edges)
+    hrms = ROOT.TH1F(f"histsigma{name_suffix}", ";#varphi; #sigma(#it{d^{0}_{xy}})", nphibins, phi_edges)
+    # bootstrap uncertainties if available, otherwise the fit errors
+    boot = res.get('bootstrap')
+    slice_values = get_slice_values(res)
+    mu_err, sigma_err = slice_values['mu_err'], slice_values['sigma_err']
+    for iphi in range(1, nphibins+1):
+        hmu.SetBinContent(iphi, fit_res['mu'][iphi-1])
+        hrms.SetBinContent(iphi, fit_res['sigma'][iphi-1])
+        hmu.SetBinError(iphi, mu_err[iphi-1])
+        hrms.SetBinError(iphi, sigma_err[iphi-1])
+
+    SetObjectStyle(hrms, markerstyle=ROOT.kFullCircle, color=ROOT.kRed-4)
+    hreso = hrms.Clone(f'hreso{name_suffix}')
+    hreso.Divide(hmu)
+    if boot is not None:
+        # the replicas include the correlation of mu and sigma, which Divide neglects
+        for iphi in range(1, nphibins+1):
+            hreso.SetBinError(iphi, boot['reso']['err'][iphi-1])
+    hrms.GetYaxis().SetRangeUser(0.0018, 0.0024)
+    hrms.GetYaxis().SetDecimals()
+    hrms.GetYaxis().SetMaxDigits(2)
+    hmu.GetYaxis().SetDecimals()
+    hmu.GetYaxis().SetMaxDigits(2)
+    return hmu, hrms, hreso
+
+def draw_reso(res, ptmin, ptmax, outdir, outfile, formats=('pdf', 'png'), inputs_hash=None):
+    '''
+    Build the ROOT histograms and fit functions of a fit_reso result and write them to the
+    pt_<min>_<max> directory of outfile. The canvases are drawn, written and saved only if image
+    formats are requested; with an inputs_hash, images already saved from the same inputs are not painted again.
+
+    Returns:
+        tuple: (hmu, hrms, hreso)
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    set_reso_style()
+    suffix = f'pt_{ptmin}_{ptmax}'
+    phi_edges = res['phi_edges']
+    nphibins = len(phi_edges) - 1
+    n_bins = res['n_bins']
+    fit_res = res['fit']
 
     hists, fits = [], []
     th2s = ROOT.TH2F(f"histsd", ";#varphi; #it{d^{0}}_{xy}", nphibins,
                      np.array(phi_edges,dtype=np.float64), 60, -0.015, 0.015)
-    hmu = ROOT.TH1F("histmu", ";#varphi; #mu(#it{d^{0}_{xy}})", nphibins,
-                    np.array(phi_edges, dtype=np.float64))
-    hrms = ROOT.TH1F("histsigma", ";#varphi; #sigma(#it{d^{0}_{xy}})", nphibins,
-                     np.array(phi_edges, dtype=np.float64))
     th2_mean = ROOT.TH1F(f"hist2dmean", ";#varphi; #it{d^{0}}_{xy}", nphibins,
                          np.array(phi_edges, dtype=np.float64))
-    hreso = ROOT.TH1F("histreso", ";#varphi; #sigma(#it{d^{0}_{xy}})/#mu(#it{d^{0}_{xy}})", nphibins,
-                      np.array(phi_edges, dtype=np.float64))
     SetObjectStyle(th2_mean, markerstyle=ROOT.kFullCircle, color=ROOT.kRed-4)
+    FillHistFromArrays(th2s, res['th2_sumw'], res['th2_sumw2'], res['th2_stats'], res['entries'])
 
-    for iphi in range(1, th2s.GetNbinsX()+1):
-        phimin = phi_edges[iphi-1]
-        phimax = phi_edges[iphi]
-        hists.append(ROOT.TH1F(f"hist{iphi}", ";#it{d^{0}}_{xy};Entries", n_bins, -0.8, 0.8))
+    for ibin in range(1, th2s.GetNbinsX()+1):
+        hist_proj_dummy = th2s.ProjectionY(f'proj_{ibin}_mean_deltacent',
+                                                ibin,
+                                                ibin)
+        th2_mean.SetBinContent(ibin, hist_proj_dummy.GetMean())
+        th2_mean.SetBinError(ibin, 1.e-9)
 
-        # Fill the histogram with data from the specified column
-        for _, (dca, phi, w) in enumerate(zip(df[data_col], df['fPhi'], df[data_weight])):
-            if phi > phimin and phi < phimax:
-                hists[-1].Fill(dca, w)
-            if iphi-1 == 0:  th2s.Fill(phi, dca, w)
-
-        if iphi-1 == 0:      
-            for ibin in range(1, th2s.GetNbinsX()+1):
-                hist_proj_dummy = th2s.ProjectionY(f'proj_{ibin}_mean_deltacent',
-                                                        ibin,
-                                                        ibin)
-                th2_mean.SetBinContent(ibin, hist_proj_dummy.GetMean())
-                th2_mean.SetBinError(ibin, 1.e-9)
-            canv_dxy_phi, hframe = GetCanvas('canv_dxy_phi', ';#varphi; #it{d^{0}}_{xy}', ymin=-0.015, ymax=0.015, xmin=0, xmax=np.pi*2)
-            hframe.GetYaxis().SetMaxDigits(1)
-            th2s.Draw('COLZ same')
-            th2_mean.Draw('hist pe same')
-            latex.DrawLatexNDC(0.22, 0.8, suffix)
-            SaveCanvas(canv_dxy_phi, f'{outdir}/canv_dxy_phi', suffix)
+    for iphi in range(1, nphibins+1):
+        hists.append(ROOT.TH1F(f"hist{iphi}", ";#it{d^{0}}_{xy};Entries", n_bins, -0.8, 0.8))
+        FillHistFromArrays(hists[-1], res['dca_sumw'][iphi], res['dca_sumw2'][iphi], res['dca_stats'][iphi],
+                           float(res['dca_entries'][iphi]))
+        hists[-1].GetXaxis().SetRangeUser(-0.02, 0.02)
+        hists[-1].GetXaxis().SetNdivisions(505)
+        hists[-1].GetYaxis().SetRangeUser(-0.02, hists[-1].GetMaximum()*1.6)
 
         # Define exclusion region (central region: -0.008 < x < 0.008)
-        fits.append(ROOT.TF1("gaus_prefit", "gaus", xmin, xmax))
-        fits[-1].SetParameters(hists[-1].GetMaximum(), hists[-1].GetMean(), hists[-1].GetRMS())
+        fits.append(ROOT.TF1("gaus_prefit", "gaus", res['xmin'], res['xmax']))
+        fits[-1].SetParameters(fit_res['norm'][iphi-1], fit_res['mu'][iphi-1], fit_res['sigma'][iphi-1])
+        fits[-1].SetParErrors(np.array([fit_res['norm_err'][iphi-1], fit_res['mu_err'][iphi-1],
+                                        fit_res['sigma_err'][iphi-1]], dtype=np.float64))
+        fits[-1].SetChisquare(fit_res['chi2'][iphi-1])
+        fits[-1].SetNDF(int(fit_res['ndf'][iphi-1]))
         SetObjectStyle(fits[-1], linecolor=ROOT.kRed-4)
+    hmu, hrms, hreso = get_fit_hists(res)
 
-        canvas.cd(iphi)
-        latex.DrawLatexNDC(0.22, 0.80, f'{ptmin} < #it{{p}}_{{T}} < {ptmax} (GeV/{{c}})')
-        hists[-1].GetXaxis().SetRangeUser(-0.02, 0.02)
-        hists[-1].GetXaxis().SetNdivisions(505)
-        hists[-1].GetYaxis().SetRangeUser(-0.02, hists[-1].GetMaximum()*1.6)
-        hists[-1].Fit(fits[-1], 'R')    
-        hists[-1].Draw('same')
-        fits[-1].Draw('same')
-        latex.DrawLatexNDC(0.22, 0.80, f'{phimin:.2f} < #varphi < {phimax:.2f}')
-        latex.DrawLatexNDC(0.22, 0.74, f'#mu = {fits[-1].GetParameter(1):.8f} +-{fits[-1].GetParError(1):.8f}')
-        latex.DrawLatexNDC(0.22, 0.68, f'#sigma = {fits[-1].GetParameter(2):.8f} +-{fits[-1].GetParError(2):.8f}')
-        canvas.Update()
-
-        hmu.SetBinContent(iphi, fits[-1].GetParameter(1))
-        hrms.SetBinContent(iphi, fits[-1].GetParameter(2))
-        hmu.SetBinError(iphi, fits[-1].GetParError(1))
-        hrms.SetBinError(iphi, fits[-1].GetParError(2))
-        canvas.cd(16)
-
-        if phimax > 6: break
-    
-    SetObjectStyle(hrms, markerstyle=ROOT.kFullCircle, color=ROOT.kRed-4)
-    hreso = hrms.Clone('hreso')
-    hreso.Divide(hmu)
-    hrms.GetYaxis().SetRangeUser(0.0018, 0.0024)
-    hrms.GetYaxis().SetDecimals()
-    hrms.GetYaxis().SetMaxDigits(2)
-    hmu.GetYaxis().SetDecimals()
-    hmu.GetYaxis().SetMaxDigits(2)
+    canvases = []
+    if formats:
+        latex = ROOT.TLatex()
+        latex.SetTextFont(42)
+        latex.SetTextSize(0.05)
+
+        canv_dxy_phi, hframe = GetCanvas('canv_dxy_phi', ';#varphi; #it{d^{0}}_{xy}', ymin=-0.015, ymax=0.015, xmin=0, xmax=np.pi*2)
+        hframe.GetYaxis().SetMaxDigits(1)
+        th2s.Draw('COLZ same')
+        th2_mean.Draw('hist pe same')
+        latex.DrawLatexNDC(0.22, 0.8, suffix)
+        SaveCanvas(canv_dxy_phi, f'{outdir}/canv_dxy_phi', suffix, formats, inputs_hash)
 
-    outFile = ROOT.TFile(f'{outdir}/dxy_phi_{suffix}.root', 'recreate')
-    canv_dxy_phi.Write()
+        canvas = ROOT.TCanvas("canvas", "Gaussian Fit with Tail Correction", 1600, 1600)
+        ncols = int(np.ceil(np.sqrt(nphibins)))
+        canvas.Divide(ncols, int(np.ceil(nphibins / ncols)))
+        for iphi, (hist, fit) in enumerate(zip(hists, fits), 1):
+            canvas.cd(iphi)
+            latex.DrawLatexNDC(0.22, 0.80, f'{ptmin} < #it{{p}}_{{T}} < {ptmax} (GeV/{{c}})')
+            hist.Draw('same')
+            fit.Draw('same')
+            latex.DrawLatexNDC(0.22, 0.80, f'{phi_edges[iphi-1]:.2f} < #varphi < {phi_edges[iphi]:.2f}')
+            latex.DrawLatexNDC(0.22, 0.74, f'#mu = {fit.GetParameter(1):.8f} +-{fit.GetParError(1):.8f}')
+            latex.DrawLatexNDC(0.22, 0.68, f'#sigma = {fit.GetParameter(2):.8f} +-{fit.GetParError(2):.8f}')
+        SaveCanvas(canvas, f'{outdir}/canv_sigma_dxy_phi', suffix, formats, inputs_hash)
+        canvases = [canv_dxy_phi, canvas]
+        if not ROOT.gROOT.IsBatch():
+            # keep the canvases on screen after returning
+            for canv in canvases:
+                ROOT.SetOwnership(canv, False)
+
+    outfile.mkdir(suffix).cd()
+    for canv in canvases:
+        canv.Write()
     th2s.Write()
     th2_mean.Write()
-    canvas.Write()
     for h in hists:
         h.Write()
     for f in fits:
@@ -130,35 +309,147 @@ def compute_reso(infile, ptmin, ptmax):
     hrms.Write()
     hmu.Write()
     hreso.Write()
-
-    SaveCanvas(canvas, f'{outdir}/canv_sigma_dxy_phi', suffix)
+    ROOT.gROOT.cd()
 
     return hmu, hrms, hreso
 
-if __name__ == "__main__":
+def compute_reso(store_dir, selection, outdir, outfile, fit_backend='numpy', formats=('pdf', 'png'), only_if_changed=False,
+                 incremental=False, cube_dir=None, nphibins=16, n_bins=1600, xmin=-0.005, xmax=0.005, n_replicas=0, seed=42):
+    '''
+    Fit the d0xy vs phi of the store bins matching selection (partition columns, with pt_min and
+    pt_max) and render the requested outputs. With a cube_dir the histograms are projected from the
+    histogram cubes of the bins (see cube_utils) instead of being filled from the candidates.
+    With n_replicas > 0 the uncertainties are estimated with bootstrap replicas of the candidates
+    (not available from the cubes). In incremental mode the fit result is kept in outdir/pt_<min>_<max> with a manifest of its
+    input files and settings, and the bins are only read and re-fitted if they changed
 
-    infiles = ['/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/output_testPP_22Pass7/cent_0_100/pt_2_3/bkg_0_0.0300_sig_0.0000_1/df_sel.parquet',
-               '/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/output_testPP_22Pass7/cent_0_100/pt_3_5/bkg_0_0.0300_sig_0.0000_1/df_sel.parquet',
-               '/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/output_testPP_22Pass7/cent_0_100/pt_8_12/bkg_0_0.0300_sig_0.0000_1/df_sel.parquet'
-               ]
-    outdir = '/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/d0xy_vs_phi'
-    ptmins = [2, 3, 8]
-    ptmaxs = [3, 5, 12]
-    hmus, hrms, hresos = [], [], []
+    Returns:
+        dict: fit_reso result
+    '''
+    input_files = get_bin_files(store_dir, **selection) if cube_dir is None else get_cube_files(cube_dir, **selection)
+    res_dir = os.path.join(outdir, f"pt_{selection['pt_min']}_{selection['pt_max']}")
+    res_file = os.path.join(res_dir, 'fit_reso.npz')
+    if cube_dir is not None and n_replicas > 0:
+        raise ValueError('The bootstrap uncertainties need the candidates, they cannot be computed from the cubes')
+    binning = {'nphibins': nphibins, 'n_bins': n_bins, 'xmin': xmin, 'xmax': xmax}
+    bootstrap = {'n_replicas': n_replicas, 'seed': seed} if n_replicas > 0 else {}
+    deps = {'selection': selection, 'fit_backend': fit_backend, 'cube': cube_dir is not None, **binning, **bootstrap}
+    if incremental and is_up_to_date(res_dir, deps, input_files, [res_file]) is not None:
+        print(f'{res_dir}: input files unchanged, fit result reused')
+        res = load_arrays(res_file)
+    else:
+        if cube_dir is not None:
+            res = fit_reso_cube(load_cubes(cube_dir, **selection), fit_backend, **binning)
+        else:
+            df = read_bins(store_dir, columns=['fPhi', 'fImpactParameterXY', 'sgn_sweights'], **selection)
+            res = fit_reso(df, fit_backend, **binning, **bootstrap)
+        if incremental:
+            os.makedirs(res_dir, exist_ok=True)
+            save_arrays(res_file, res)
+            write_manifest(res_dir, deps, input_files)
+    inputs_hash = None
+    if only_if_changed:
+        inputs_hash = get_inputs_hash([[get_file_identity(file_name) for file_name in input_files], fit_backend, selection,
+                                      {**binning, **bootstrap}])
+    draw_reso(res, selection['pt_min'], selection['pt_max'], outdir, outfile, formats, inputs_hash)
+    return res
 
-    creso = ROOT.TCanvas("creso", "", 1600, 600)
-    creso.Divide(2, 1)
+def get_reso_config(cfg):
+    '''
+    Output directory, binning and bootstrap settings of the resolution fits of a configuration, from its reso block
+
+    Returns:
+        tuple: (output directory, dict with nphibins, n_bins, xmin, xmax, n_replicas and seed)
+    '''
+    reso_cfg = cfg.get('reso') or {}
+    outdir = reso_cfg.get('dir') or os.path.join(cfg['output']['dir'] + cfg['output']['suffix'], 'd0xy_vs_phi')
+    xmin, xmax = reso_cfg.get('fit_range') or (-0.005, 0.005)
+    return outdir, {'nphibins': int(reso_cfg.get('nphibins') or 16), 'n_bins': int(reso_cfg.get('n_bins') or 1600),
+                    'xmin': float(xmin), 'xmax': float(xmax), 'n_replicas': int(reso_cfg.get('n_replicas') or 0),
+                    'seed': int(reso_cfg.get('seed', 42))}
+
+def get_reso_groups(store_dir, cube_dir=None):
+    '''
+    Bins of the store (or of the cubes, if a cube_dir is given) grouped by centrality and BDT working point,
+    each group being summarised vs pT in its cent_<min>_<max>/bkg_0_<max>_sig_<min>_1 directory
+
+    Returns:
+        dict: group directory -> selections of its bins (partition columns), sorted by pT
+    '''
+    if cube_dir is None:
+        partitions = get_bin_partitions(store_dir)
+    else:
+        partitions = [get_path_partition(file_name, cube_dir) for file_name in get_cube_files(cube_dir)]
+    groups = {}
+    for partition in partitions:
+        selection = {key: float(value) for key, value in partition.items()}
+        for key in ['cent_min', 'cent_max', 'pt_min', 'pt_max']:
+            if selection[key].is_integer():
+                selection[key] = int(selection[key])
+        group = f"cent_{partition['cent_min']}_{partition['cent_max']}/bkg_0_{partition['bkg_max']}_sig_{partition['sig_min']}_1"
+        groups.setdefault(group, []).append(selection)
+    return {group: sorted(selections, key=lambda sel: (sel['pt_min'], sel['pt_max']))
+            for group, selections in sorted(groups.items())}
+
+def run_reso_bin(store_dir, selection, outdir, fit_backend='numpy', formats=('pdf', 'png'), only_if_changed=False,
+                 incremental=False, cube_dir=None, settings=None, batch=True):
+    '''
+    compute_reso of a bin, writing its ROOT objects to its own outdir/pt_<min>_<max>/dxy_phi.root,
+    so that the bins can run in separate processes (the ROOT objects and styles are per process);
+    settings are the binning and bootstrap arguments of compute_reso
+
+    Returns:
+        dict: fit_reso result
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    if batch:
+        SetBatchMode()
+    res_dir = os.path.join(outdir, f"pt_{selection['pt_min']}_{selection['pt_max']}")
+    os.makedirs(res_dir, exist_ok=True)
+    outfile = ROOT.TFile(os.path.join(res_dir, 'dxy_phi.root'), 'recreate')
+    ROOT.gROOT.cd() # the histograms are owned by Python, not by the file
+    res = compute_reso(store_dir, selection, outdir, outfile, fit_backend, formats, only_if_changed, incremental,
+                       cube_dir, **(settings or {}))
+    outfile.Close()
+    return res
+
+def merge_root_files(out_name, file_names):
+    '''
+    Merge the ROOT files of the bins (distinct pt_<min>_<max> directories) into out_name
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    merger = ROOT.TFileMerger(False)
+    merger.SetPrintLevel(0)
+    merger.OutputFile(out_name, 'RECREATE')
+    for file_name in file_names:
+        merger.AddFile(file_name)
+    if not merger.Merge():
+        raise RuntimeError(f'Merging {len(file_names)} files into {out_name} failed')
+
+def draw_summary(results, selections, outdir, formats=('pdf', 'png'), inputs_hash=None):
+    '''
+    Mean and width of d0xy vs phi of the pT bins of a group, saved as outdir/dxy_vphi_vpt
+
+    Returns:
+        tuple: (canvas, histograms and legend), to be kept alive while the canvas is shown
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    set_reso_style()
+    first = selections[0]
+    label = f"cent_{first['cent_min']}_{first['cent_max']}_bkg_{first['bkg_max']}_sig_{first['sig_min']}"
+    hmus, hrms = [], []
     leg = GetLegend(header='', xmax=0.5, ncolumns=1, ymin=0.7, ymax=0.85)
-    for i, (infile, ptmin, ptmax) in enumerate(zip(infiles, ptmins, ptmaxs)):
-        hmu, hrm, hreso = compute_reso(infile, ptmin, ptmax)
+    for i, (res, selection) in enumerate(zip(results, selections)):
+        ptmin, ptmax = selection['pt_min'], selection['pt_max']
+        hmu, hrm, _ = get_fit_hists(res, f'_{label}_pt_{ptmin}_{ptmax}')
         hmus.append(hmu)
         hrms.append(hrm)
-        hresos.append(hreso)
-        SetObjectStyle(hmus[-1], markerstyle=ROOT.kFullCircle, color=cols[i])
-        SetObjectStyle(hrms[-1], markerstyle=ROOT.kFullCircle, color=cols[i])
-        SetObjectStyle(hresos[-1], markerstyle=ROOT.kFullCircle, color=cols[i])
+        SetObjectStyle(hmus[-1], markerstyle=ROOT.kFullCircle, color=get_color(i))
+        SetObjectStyle(hrms[-1], markerstyle=ROOT.kFullCircle, color=get_color(i))
         leg.AddEntry(hmus[-1], f'{ptmin} < #it{{p}}_{{T}} < {ptmax} (GeV/#it{{c}})', 'p')
 
+    creso = ROOT.TCanvas(f"creso_{label}", "", 1600, 600)
+    creso.Divide(2, 1)
     creso.cd(1)
     hmus[0].GetYaxis().SetRangeUser(-0.002, 0.002)
     hmus[0].GetYaxis().SetTitle('#mu(#it{d^{0}_{xy}})')
@@ -170,7 +461,93 @@ if __name__ == "__main__":
     hrms[0].GetYaxis().SetTitle('#sigma(#it{d^{0}_{xy}})')
     for h in hrms:
         h.Draw('same')
-    creso.Update()
-    SaveCanvas(creso, f'{outdir}/dxy_vphi_vpt', '')
+    SaveCanvas(creso, f'{outdir}/dxy_vphi_vpt', '', formats, inputs_hash)
+    return creso, (hmus, hrms, leg)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute the d0xy resolution vs phi of the store bins of a configuration')
+    parser.add_argument('config', help='Path to the YAML configuration file of splot_fit.py')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of bins fitted in parallel, each in its own process')
+    parser.add_argument('--fit-backend', choices=['numpy', 'root'], default='numpy',
+                        help='Batched NumPy Gaussian fits or per-slice ROOT fits (cross-check)')
+    parser.add_argument('--batch', '-b', action='store_true',
+                        help='Run ROOT in batch mode (no graphics) and exit at the end instead of waiting')
+    parser.add_argument('--formats', nargs='*', default=['pdf', 'png'],
+                        help='Image formats of the canvases, none to only write the ROOT files')
+    parser.add_argument('--only-if-changed', action='store_true',
+                        help='Do not save again the images whose input files and settings are unchanged')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only re-fit the bins whose store files or settings changed since the last run')
+    parser.add_argument('--cubes', action='store_true',
+                        help='Project the histograms from the cubes of cube_utils.py of the configuration instead of the store')
+    parser.add_argument('--nphibins', type=int, default=None, help='Number of phi slices, overrides the configuration')
+    parser.add_argument('--n-bins', type=int, default=None,
+                        help='Number of d0xy bins in [-0.8, 0.8] of the fitted histograms, overrides the configuration')
+    parser.add_argument('--fit-range', type=float, nargs=2, default=None, metavar=('XMIN', 'XMAX'),
+                        help='d0xy range of the Gaussian fits, overrides the configuration')
+    parser.add_argument('--n-replicas', type=int, default=None,
+                        help='Bootstrap replicas for the uncertainties of mu, sigma and sigma/mu, 0 for the fit errors; '
+                             'overrides the configuration')
+    args = parser.parse_args()
+    if args.batch:
+        SetBatchMode()
+
+    with open(args.config, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+    store_dir = get_store_dir(cfg)
+    cube_dir = get_cube_config(cfg)[0] if args.cubes else None
+    outdir, settings = get_reso_config(cfg)
+    if args.nphibins is not None:
+        settings['nphibins'] = args.nphibins
+    if args.n_bins is not None:
+        settings['n_bins'] = args.n_bins
+    if args.fit_range is not None:
+        settings['xmin'], settings['xmax'] = args.fit_range
+    if args.n_replicas is not None:
+        settings['n_replicas'] = args.n_replicas
+    if cube_dir is not None and settings['n_replicas'] > 0:
+        parser.error('the bootstrap uncertainties need the candidates, set --n-replicas 0 to fit the cubes')
+
+    groups = get_reso_groups(store_dir, cube_dir)
+    bins_args = [(store_dir, selection, os.path.join(outdir, group), args.fit_backend, args.formats,
+                  args.only_if_changed, args.incremental, cube_dir, settings)
+                 for group, selections in groups.items() for selection in selections]
+    print(f'{len(bins_args)} bins in {len(groups)} centrality and BDT working-point groups, {args.jobs} jobs')
+    if args.jobs <= 1:
+        results = [run_reso_bin(*bin_args, batch=args.batch) for bin_args in bins_args]
+    else:
+        # spawned workers, each with its own ROOT state; the summaries are drawn here once all the bins are done
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(run_reso_bin, *zip(*bins_args)))
+
+    summaries = []
+    working_points = {}
+    ibin = 0
+    for group, selections in groups.items():
+        group_dir = os.path.join(outdir, group)
+        group_results = results[ibin:ibin + len(selections)]
+        ibin += len(selections)
+        wp_results, wp_selections = working_points.setdefault(group.split('/')[-1], ([], []))
+        wp_results.extend(group_results)
+        wp_selections.extend(selections)
+        merge_root_files(os.path.join(group_dir, 'dxy_phi.root'),
+                         [os.path.join(group_dir, f"pt_{selection['pt_min']}_{selection['pt_max']}", 'dxy_phi.root')
+                          for selection in selections])
+        if args.formats:
+            creso_hash = None
+            if args.only_if_changed:
+                input_files = [file_name for selection in selections for file_name in
+                               (get_bin_files(store_dir, **selection) if cube_dir is None
+                                else get_cube_files(cube_dir, **selection))]
+                creso_hash = get_inputs_hash([[get_file_identity(file_name) for file_name in input_files],
+                                              args.fit_backend, selections, settings])
+            summaries.append(draw_summary(group_results, selections, group_dir, args.formats, creso_hash))
+    print(f'Resolution vs phi of {len(groups)} groups written to {outdir}')
+
+    # phi x pT x centrality maps of each BDT working point, for the lookups of maps_utils
+    for working_point, (wp_results, wp_selections) in working_points.items():
+        save_maps(os.path.join(outdir, f'maps_{working_point}.npz'), build_maps(wp_results, wp_selections))
+    print(f"Resolution and acceptance maps of {len(working_points)} working points written to {outdir}/maps_*.npz")
 
-    input("Press Enter to exit...")
\ No newline at end of file
+    if not args.batch:
+        input("Press Enter to exit...")
@@ -0,0 +1,225 @@
+'''
+Histogram cubes of the results store, to redraw and refit the distributions without the candidates.
+For each store bin (centrality, pT and BDT working point, see store_utils) a sparse histogram over
+phi x d0xy x mass keeps, for each non-empty cell, the unweighted entries and the sWeighted sums
+(sumw, sumw2). The cubes are filled in one streaming pass over the row groups of the bin files, and
+any binning whose edges are edges of the cube axes is projected from the cells alone. The axes follow
+the ROOT conventions of hist_utils (bin 0 is the underflow, bin nbins+1 the overflow).
+
+    python cube_utils.py <config> [--incremental]
+'''
+import argparse
+import os
+import glob
+import numpy as np
+import pyarrow.parquet as pq
+import yaml
+
+from hist_utils import uniform_bin_index
+from store_utils import PARTITION_KEYS, get_bin_files, get_filters, get_path_partition, get_store_dir
+from manifest_utils import is_up_to_date, write_manifest
+
+CUBE_FILE = 'cube.npz'
+# candidate column of each axis, in the order of the cube cells
+CUBE_COLUMNS = {'phi': 'fPhi', 'd0xy': 'fImpactParameterXY', 'mass': 'fM'}
+# bins, min and max of each axis; 3600 phi bins can be projected to 16, 18 or 100 bins
+DEFAULT_AXES = {'phi': (3600, 0., 2 * np.pi), 'd0xy': (3200, -0.8, 0.8), 'mass': (40, 1.7, 2.1)}
+
+def get_cube_config(cfg):
+    '''
+    Directory and axes of the cubes of a configuration, from its cube block
+
+    Returns:
+        tuple: (cube directory, dict axis name -> (bins, min, max))
+    '''
+    cube_cfg = cfg.get('cube') or {}
+    cube_dir = cube_cfg.get('dir') or os.path.join(cfg['output']['dir'] + cfg['output']['suffix'], 'cubes')
+    axes = dict(DEFAULT_AXES)
+    if cube_cfg.get('phi_bins'):
+        axes['phi'] = (int(cube_cfg['phi_bins']), 0., 2 * np.pi)
+    for name in ['d0xy', 'mass']:
+        if cube_cfg.get(f'{name}_bins'):
+            nbins, xmin, xmax = cube_cfg[f'{name}_bins']
+            axes[name] = (int(nbins), float(xmin), float(xmax))
+    return cube_dir, axes
+
+def get_shape(axes):
+    '''
+    Number of bins of each axis, flow bins included
+    '''
+    return tuple(nbins + 2 for nbins, _, _ in axes.values())
+
+def merge_cells(cells, sums):
+    '''
+    Add up the sums (one column per entry) of the entries with the same cell index
+
+    Returns:
+        tuple: (sorted unique cell indices, sums of each cell)
+    '''
+    unique_cells, inverse = np.unique(cells, return_inverse=True)
+    return unique_cells, np.stack([np.bincount(inverse, weights=row, minlength=len(unique_cells)) for row in sums])
+
+def fill_cube(batches, axes):
+    '''
+    Fill a sparse cube from batches of candidates (dicts of arrays with the axis columns and sgn_sweights),
+    merging the non-empty cells of each batch into the running sums
+
+    Returns:
+        dict: axes, flat cell indices (sorted, ROOT global-bin order with the last axis running fastest),
+        entries, sumw and sumw2 of the non-empty cells
+    '''
+    shape = get_shape(axes)
+    cells, sums = np.zeros(0, dtype=np.int64), np.zeros((3, 0))
+    for batch in batches:
+        weights = np.asarray(batch['sgn_sweights'], dtype=np.float64)
+        flat_idx = np.zeros(len(weights), dtype=np.int64)
+        for (name, (nbins, xmin, xmax)), size in zip(axes.items(), shape):
+            flat_idx = flat_idx * size + uniform_bin_index(batch[CUBE_COLUMNS[name]], nbins, xmin, xmax)
+        cells, sums = merge_cells(np.concatenate([cells, flat_idx]),
+                                  np.concatenate([sums, np.stack([np.ones_like(weights), weights, weights * weights])], axis=1))
+    return {'axes': dict(axes), 'cells': cells, 'entries': sums[0].astype(np.int64), 'sumw': sums[1], 'sumw2': sums[2]}
+
+def add_cubes(cubes):
+    '''
+    Sum of cubes with the same axes (e.g. the bins of a selection spanning several store bins)
+    '''
+    axes = cubes[0]['axes']
+    if any(cube['axes'] != axes for cube in cubes):
+        raise ValueError('Only cubes with the same axes can be added')
+    cells, sums = merge_cells(np.concatenate([cube['cells'] for cube in cubes]),
+                              np.concatenate([np.stack([cube['entries'], cube['sumw'], cube['sumw2']]) for cube in cubes], axis=1))
+    return {'axes': dict(axes), 'cells': cells, 'entries': sums[0].astype(np.int64), 'sumw': sums[1], 'sumw2': sums[2]}
+
+def build_cube(bin_file, axes, batch_size=1_000_000):
+    '''
+    Cube of a store bin, read batch by batch with the needed columns only
+    '''
+    columns = [CUBE_COLUMNS[name] for name in axes] + ['sgn_sweights']
+    parquet_file = pq.ParquetFile(bin_file, memory_map=True)
+    batches = ({col: array.to_numpy() for col, array in zip(columns, batch.columns)}
+               for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns))
+    return fill_cube(batches, axes)
+
+def save_cube(file_name, cube):
+    '''
+    Save a cube as a compressed .npz file, atomically (temporary file + rename)
+    '''
+    tmp_file_name = f'{file_name}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp_file_name, names=np.array(list(cube['axes'])),
+                        axes=np.array(list(cube['axes'].values()), dtype=np.float64),
+                        cells=cube['cells'], entries=cube['entries'], sumw=cube['sumw'], sumw2=cube['sumw2'])
+    os.replace(tmp_file_name, file_name)
+
+def load_cube(file_name):
+    '''
+    Load a cube saved with save_cube
+    '''
+    with np.load(file_name) as entry:
+        axes = {str(name): (int(nbins), float(xmin), float(xmax)) for name, (nbins, xmin, xmax) in zip(entry['names'], entry['axes'])}
+        return {'axes': axes, **{key: entry[key] for key in ['cells', 'entries', 'sumw', 'sumw2']}}
+
+def get_cube_file(cube_dir, store_dir, bin_file):
+    '''
+    Cube file of a store bin, in the same partition directories as in the store
+    '''
+    sub_dir = os.path.relpath(os.path.dirname(os.path.abspath(bin_file)), os.path.abspath(store_dir))
+    return os.path.join(cube_dir, sub_dir, CUBE_FILE)
+
+def get_cube_files(cube_dir, **selection):
+    '''
+    Cube files of the bins matching the selection on the partition columns (as store_utils.read_bins)
+    '''
+    filters = get_filters(**selection) or []
+    file_names = []
+    for file_name in sorted(glob.glob(os.path.join(cube_dir, *['*'] * len(PARTITION_KEYS), CUBE_FILE))):
+        partition = get_path_partition(file_name, cube_dir)
+        if all(partition.get(key) in values for key, _, values in filters):
+            file_names.append(file_name)
+    return file_names
+
+def load_cubes(cube_dir, **selection):
+    '''
+    Sum of the cubes of the bins matching the selection on the partition columns
+    '''
+    file_names = get_cube_files(cube_dir, **selection)
+    if not file_names:
+        raise FileNotFoundError(f'No cube in {cube_dir} matches {selection}, fill them with python cube_utils.py <config>')
+    return add_cubes([load_cube(file_name) for file_name in file_names])
+
+def build_cubes(cfg, incremental=False):
+    '''
+    Fill the cube of each bin of the store of a configuration; in incremental mode only the bins whose
+    store file or cube axes changed since the last run are filled again
+
+    Returns:
+        list: cube files
+    '''
+    store_dir = get_store_dir(cfg)
+    cube_dir, axes = get_cube_config(cfg)
+    deps = {'axes': axes}
+    cube_files, n_up_to_date = [], 0
+    for bin_file in get_bin_files(store_dir):
+        cube_file = get_cube_file(cube_dir, store_dir, bin_file)
+        cube_files.append(cube_file)
+        if incremental and is_up_to_date(os.path.dirname(cube_file), deps, [bin_file], [cube_file]) is not None:
+            n_up_to_date += 1
+            continue
+        cube = build_cube(bin_file, axes)
+        os.makedirs(os.path.dirname(cube_file), exist_ok=True)
+        save_cube(cube_file, cube)
+        write_manifest(os.path.dirname(cube_file), deps, [bin_file],
+                       {'entries': int(cube['entries'].sum()), 'cells': len(cube['cells'])})
+    print(f'Cubes of {len(cube_files)} bins in {cube_dir} ({n_up_to_date} up to date)')
+    return cube_files
+
+def get_centers(axis):
+    '''
+    Centres of the bins of an axis, flow bins included (-inf for the underflow, +inf for the overflow)
+    '''
+    nbins, xmin, xmax = axis
+    centers = xmin + (np.arange(nbins + 2) - 0.5) * (xmax - xmin) / nbins
+    centers[0], centers[-1] = -np.inf, np.inf
+    return centers
+
+def get_cells(cube, names):
+    '''
+    Centre of the bin of each non-empty cell along the axes in names: the cells are the entries
+    (weights sumw, squared weights sumw2) of the histograms with a binning compatible with the cube
+
+    Returns:
+        list: array of bin centres of the cells for each axis in names
+    '''
+    idx = dict(zip(cube['axes'], np.unravel_index(cube['cells'], get_shape(cube['axes']))))
+    return [get_centers(cube['axes'][name])[idx[name]] for name in names]
+
+def check_binning(cube, name, nbins, xmin, xmax):
+    '''
+    Raise a ValueError if the edges of a binning of an axis are not edges of the cube axis
+    '''
+    cube_nbins, cube_min, cube_max = cube['axes'][name]
+    pos = (np.linspace(xmin, xmax, nbins + 1) - cube_min) * cube_nbins / (cube_max - cube_min)
+    if pos[0] < -1.e-6 or pos[-1] > cube_nbins + 1.e-6 or not np.allclose(pos, np.round(pos), rtol=0, atol=1.e-6):
+        raise ValueError(f'{nbins} bins in [{xmin}, {xmax}] are not a rebinning of the {name} axis of the cube '
+                         f'({cube_nbins} bins in [{cube_min}, {cube_max}])')
+
+def project_histogram(cube, name, nbins, xmin, xmax):
+    '''
+    Histogram of an axis of the cube, with a binning whose edges are edges of the cube axis
+
+    Returns:
+        dict: edges, entries, sumw and sumw2 arrays of nbins+2 bins, flow bins included (as stats_utils.histogram)
+    '''
+    check_binning(cube, name, nbins, xmin, xmax)
+    idx = uniform_bin_index(get_cells(cube, [name])[0], nbins, xmin, xmax)
+    return {'edges': np.linspace(xmin, xmax, nbins + 1),
+            **{key: np.bincount(idx, weights=cube[key], minlength=nbins + 2) for key in ['entries', 'sumw', 'sumw2']}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fill the histogram cubes of the store bins of a configuration')
+    parser.add_argument('config', help='Path to the YAML configuration file of splot_fit.py')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only fill the cubes of the bins whose store files or axes changed since the last run')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as cfg_file:
+        build_cubes(yaml.safe_load(cfg_file), args.incremental)
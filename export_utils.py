@@ -0,0 +1,151 @@
+'''
+Image exports of the pipeline: formats, resolution and the "only if changed" rule come from the
+output.export block of the configuration. Each image is saved next to a hidden .sha256 file with
+the hash of its inputs, so that unchanged images are neither re-drawn nor re-saved. Matplotlib
+figures can be rendered and saved in a pool of worker processes.
+'''
+import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_EXPORT = {
+    'formats': ['png'], # image formats of each figure
+    'dpi': 300, # resolution of the raster formats
+    'only_if_changed': False, # skip the images whose inputs hash is unchanged
+    'jobs': 1 # processes rendering the matplotlib figures, 1 to render them in place
+}
+
+def get_export_config(cfg):
+    '''
+    Export settings of a configuration, defaults for the missing keys
+    '''
+    return {**DEFAULT_EXPORT, **(cfg.get('output', {}).get('export') or {})}
+
+def get_file_names(out_base, formats):
+    '''
+    Output file names of an image, one per format
+    '''
+    return [f'{out_base}.{form}' for form in formats]
+
+def get_hash_file_name(file_name):
+    '''
+    Hidden file storing the inputs hash of an image
+    '''
+    dir_name, base_name = os.path.split(file_name)
+    return os.path.join(dir_name, f'.{base_name}.sha256')
+
+def get_inputs_hash(inputs, export_cfg=None):
+    '''
+    Hash of everything an image depends on; the export resolution is included if given
+    '''
+    key = {'inputs': inputs, 'dpi': export_cfg['dpi'] if export_cfg is not None else None}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def is_up_to_date(file_names, inputs_hash):
+    '''
+    True if all the files exist and were produced from the same inputs
+    '''
+    for file_name in file_names:
+        hash_file_name = get_hash_file_name(file_name)
+        if not os.path.isfile(file_name) or not os.path.isfile(hash_file_name):
+            return False
+        with open(hash_file_name, 'r') as hash_file:
+            if hash_file.read().strip() != inputs_hash:
+                return False
+    return True
+
+def mark_up_to_date(file_names, inputs_hash):
+    '''
+    Record the inputs hash of saved files
+    '''
+    for file_name in file_names:
+        with open(get_hash_file_name(file_name), 'w') as hash_file:
+            hash_file.write(inputs_hash)
+
+def is_exported(out_base, inputs, export_cfg):
+    '''
+    True if the image was saved in all the formats from the same inputs, whatever the only_if_changed rule
+    '''
+    return is_up_to_date(get_file_names(out_base, export_cfg['formats']), get_inputs_hash(inputs, export_cfg))
+
+def needs_export(out_base, inputs, export_cfg):
+    '''
+    False if the image can be skipped according to the only_if_changed rule
+    '''
+    if not export_cfg['only_if_changed']:
+        return True
+    return not is_exported(out_base, inputs, export_cfg)
+
+def get_figure(fig):
+    '''
+    Render function of an already built figure
+    '''
+    return fig
+
+def render_and_save(render, args, file_names, dpi):
+    '''
+    Build a matplotlib figure with render(*args) and save it in all the formats
+    '''
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+    fig = render(*args)
+    for file_name in file_names:
+        fig.savefig(file_name, dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+    return file_names
+
+class FigureExporter:
+    '''
+    Save matplotlib figures according to the export settings, in place or in a process pool
+
+    Each task is (out_base, inputs, render, args): the figure is built with render(*args) only if it
+    needs to be exported and saved as out_base.<format>; inputs (JSON-serialisable) determine its hash.
+    '''
+    def __init__(self, export_cfg):
+        self.export_cfg = export_cfg
+        self.executor = None
+        self.pending = []
+        if export_cfg['jobs'] > 1:
+            self.executor = ProcessPoolExecutor(max_workers=export_cfg['jobs'],
+                                                mp_context=multiprocessing.get_context('spawn'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, out_base, inputs, render, args=()):
+        import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+        file_names = get_file_names(out_base, self.export_cfg['formats'])
+        inputs_hash = get_inputs_hash(inputs, self.export_cfg)
+        if self.export_cfg['only_if_changed'] and is_up_to_date(file_names, inputs_hash):
+            for arg in args:
+                if isinstance(arg, plt.Figure):
+                    plt.close(arg)
+            return
+        if self.executor is None:
+            render_and_save(render, args, file_names, self.export_cfg['dpi'])
+            mark_up_to_date(file_names, inputs_hash)
+            return
+        self.pending.append((self.executor.submit(render_and_save, render, args, file_names,
+                                                  self.export_cfg['dpi']), inputs_hash))
+        for arg in args:
+            if isinstance(arg, plt.Figure):
+                plt.close(arg) # detach from pyplot, the worker owns the pickled copy
+
+    def submit_all(self, tasks):
+        for task in tasks:
+            self.submit(*task)
+
+    def close(self):
+        '''
+        Wait for the pending exports and record their hashes
+        '''
+        for future, inputs_hash in self.pending:
+            mark_up_to_date(future.result(), inputs_hash)
+        self.pending = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,96 @@
+'''
+Content-addressed cache of the mass-fit results (fit parameters, fit status and sWeights).
+Each entry is a .npz file named after the hash of everything that determines the fit:
+input files identity, tree name, selection, fit configuration and flarefly version.
+'''
+import os
+import json
+import hashlib
+from importlib import metadata
+import numpy as np
+from io_utils import get_input_files
+
+# bumped whenever the content of the stored fit info changes
+FIT_INFO_VERSION = 7
+
+def get_flarefly_version():
+    '''
+    Installed flarefly version, part of the cache key
+    '''
+    try:
+        return metadata.version('flarefly')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+def get_file_identity(file_name):
+    '''
+    Identity of an input file (absolute path, size and modification time)
+    '''
+    stat = os.stat(file_name)
+    return [os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns]
+
+def get_fit_key(cfg, selection):
+    '''
+    Hash identifying the fit of a bin
+    '''
+    key = {
+        'input': [get_file_identity(file_name) for file_name in get_input_files(cfg)],
+        'tree': cfg['inputs']['fTreeDmeson'],
+        'selection': selection,
+        'fit_config': cfg['fit_config'],
+        'flarefly': get_flarefly_version(),
+        'version': FIT_INFO_VERSION
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_fit(cache_dir, key, n_cand):
+    '''
+    Load a cached fit, invalid entries (unreadable or with a wrong number of sWeights) are dropped
+
+    Returns:
+        tuple: (fit info dict, sWeights) or None if not cached
+    '''
+    file_name = os.path.join(cache_dir, f'{key}.npz')
+    if not os.path.isfile(file_name):
+        return None
+    try:
+        with np.load(file_name) as entry:
+            fit_info = json.loads(str(entry['fit_info']))
+            sgn_sweights = entry['sgn_sweights']
+    except (OSError, KeyError, ValueError):
+        os.remove(file_name)
+        return None
+    if len(sgn_sweights) != n_cand:
+        os.remove(file_name)
+        return None
+    os.utime(file_name) # mark as recently used for the LRU eviction
+    return fit_info, sgn_sweights
+
+def store_fit(cache_dir, key, fit_info, sgn_sweights):
+    '''
+    Store the result of a fit, written to a temporary file and renamed to be safe with parallel writers
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    file_name = os.path.join(cache_dir, f'{key}.npz')
+    tmp_file_name = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp.npz')
+    np.savez(tmp_file_name, fit_info=np.array(json.dumps(fit_info)),
+             sgn_sweights=np.asarray(sgn_sweights, dtype=np.float32))
+    os.replace(tmp_file_name, file_name)
+
+def evict(cache_dir, max_size_mb):
+    '''
+    Remove the least recently used entries until the cache is smaller than max_size_mb
+    '''
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith('.npz') and not file_name.endswith('.tmp.npz'):
+            stat = os.stat(os.path.join(cache_dir, file_name))
+            entries.append((stat.st_mtime_ns, stat.st_size, file_name))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, file_name in sorted(entries):
+        if total_size <= max_size_mb * 1024**2:
+            break
+        os.remove(os.path.join(cache_dir, file_name))
+        total_size -= size
@@ -0,0 +1,162 @@
+'''
+Structured log of the mass fits: one JSON line per bin with the bin keys, the candidate count,
+the fit quality (status, valid, converged, EDM, minimizer calls), the wall time of each stage and
+the peak memory, plus one line for the whole run with the peak memory of the input reading.
+Run as a script to rank the bins by cost:
+
+    python fit_monitor.py <output dir>/fit_log.jsonl [--top N] [--sort STAGE]
+'''
+import argparse
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+import pandas as pd
+
+# wall-time columns of a bin record, in pipeline order
+STAGES = ['select_time', 'fit_time', 'sweights_time', 'write_time', 'plot_time', 'export_time']
+BIN_KEYS = ['cent_min', 'cent_max', 'pt_min', 'pt_max', 'bkg_max', 'sig_min']
+
+_peak_rss_before_reset = 0. # peak of the process before the last reset of the high-water mark, in MB
+
+def get_peak_rss_mb():
+    '''
+    Peak resident memory of the current process, in MB
+    '''
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    peak_rss = peak_rss / 1024**2 if sys.platform == 'darwin' else peak_rss / 1024
+    return max(peak_rss, _peak_rss_before_reset)
+
+def reset_peak_rss():
+    '''
+    Reset the high-water mark of the resident memory to the current usage (Linux only), so that the next
+    reading is the peak of the following stage; get_peak_rss_mb still returns the peak of the whole process
+
+    Returns:
+        bool: False if the high-water mark cannot be reset (the stage peaks are then process peaks)
+    '''
+    global _peak_rss_before_reset # pylint: disable=global-statement
+    peak_rss = get_peak_rss_mb()
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        return False
+    _peak_rss_before_reset = peak_rss
+    return True
+
+def get_stage_peak_rss_mb():
+    '''
+    Peak resident memory since the last reset_peak_rss, in MB
+    '''
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024**2 if sys.platform == 'darwin' else peak_rss / 1024
+
+@contextmanager
+def timed(timings, stage):
+    '''
+    Add the wall time spent in the block to timings[stage]
+    '''
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.) + time.perf_counter() - start_time
+
+@contextmanager
+def peak_rss(record, key):
+    '''
+    Store in record[key] the peak resident memory reached in the block, in MB
+    '''
+    reset_peak_rss()
+    try:
+        yield
+    finally:
+        record[key] = get_stage_peak_rss_mb()
+
+def get_fit_record(out_dir, fit_info, from_cache=False, timings=None):
+    '''
+    Record of the fit of a bin, the bin keys, candidate count and the other stages are added by the caller
+    '''
+    return {
+        'out_dir': out_dir,
+        'from_cache': from_cache,
+        'skipped': False,
+        'n_fit': fit_info.get('n_fit', -1),
+        'mode': fit_info.get('mode', 'unbinned'),
+        'seed': fit_info.get('seed', 'config'),
+        'valid': fit_info['valid'],
+        'status': fit_info['status'],
+        'converged': fit_info['converged'],
+        'sweights': fit_info.get('sweights', 'none'),
+        'edm': fit_info.get('edm', float('nan')),
+        'n_eval': fit_info.get('n_eval', -1),
+        **{stage: 0. for stage in STAGES},
+        **(timings or {})
+    }
+
+def write_fit_log(file_name, records, run_record):
+    '''
+    Write the records of the bins and of the run as JSON lines, atomically (temporary file + rename)
+    '''
+    tmp_file_name = f'{file_name}.tmp'
+    with open(tmp_file_name, 'w') as file:
+        for record in records:
+            file.write(json.dumps({'record': 'bin', **record}) + '\n')
+        file.write(json.dumps({'record': 'run', **run_record}) + '\n')
+    os.replace(tmp_file_name, file_name)
+
+def load_fit_log(file_name):
+    '''
+    Read a fit log
+
+    Returns:
+        tuple: (pd.DataFrame with one row per bin, dict of the run record)
+    '''
+    with open(file_name, 'r') as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    run_record = next((record for record in records if record['record'] == 'run'), {})
+    df_bins = pd.DataFrame([record for record in records if record['record'] == 'bin'])
+    if not df_bins.empty:
+        df_bins['total_time'] = df_bins[STAGES].sum(axis=1)
+    return df_bins, run_record
+
+def summarise(df_bins, run_record, top=20, sort='total_time'):
+    '''
+    Text summary of a fit log: run totals, wall time per stage and the most expensive bins
+    '''
+    lines = [f"Run: {len(df_bins)} bins, read {run_record.get('read_time', 0.):.1f} s, "
+             f"total {run_record.get('total_time', 0.):.1f} s, "
+             f"peak RSS {run_record.get('peak_rss_mb', 0.):.0f} MB (read {run_record.get('read_peak_rss_mb', 0.):.0f} MB)"]
+    if df_bins.empty:
+        return '\n'.join(lines)
+    # the records of the skipped (up-to-date) bins come from the run that computed them
+    skipped = df_bins['skipped'] if 'skipped' in df_bins else pd.Series(False, index=df_bins.index)
+    stage_times = df_bins.loc[~skipped, STAGES + ['total_time']].sum()
+    lines.append(f'Wall time per stage (summed over the {int((~skipped).sum())} recomputed bins):')
+    for stage, stage_time in stage_times.items():
+        lines.append(f'  {stage:>14}: {stage_time:9.2f} s ({100 * stage_time / max(stage_times["total_time"], 1e-9):5.1f}%)')
+    failed = df_bins[~(df_bins['valid'] & df_bins['converged'])]
+    lines.append(f'Failed fits: {len(failed)}/{len(df_bins)}, from cache: {int(df_bins["from_cache"].sum())}, '
+                 f'skipped (up to date): {int(skipped.sum())}')
+    columns = BIN_KEYS + ['n_cand', 'mode', 'status', 'edm', 'n_eval', 'skipped'] + STAGES + ['total_time', 'peak_rss_mb']
+    ranked = df_bins.sort_values(sort, ascending=False).head(top)
+    lines.append(f'Most expensive bins by {sort}:')
+    lines.append(ranked[[col for col in columns if col in ranked]].to_string(index=False, float_format='{:.4g}'.format))
+    if not failed.empty:
+        lines.append('Failed fits:')
+        lines.append(failed[BIN_KEYS + ['status', 'valid', 'converged', 'edm', 'n_eval']].to_string(index=False))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rank the bins of a fit log by cost')
+    parser.add_argument('fit_log', help='Path to the fit_log.jsonl file written by splot_fit.py')
+    parser.add_argument('--top', type=int, default=20, help='Number of bins shown')
+    parser.add_argument('--sort', default='total_time', choices=STAGES + ['total_time', 'n_cand', 'n_eval', 'peak_rss_mb'],
+                        help='Column used to rank the bins')
+    args = parser.parse_args()
+
+    print(summarise(*load_fit_log(args.fit_log), top=args.top, sort=args.sort))
@@ -0,0 +1,151 @@
+'''
+Batched Gaussian fits of stacked histograms: all the slices (e.g. phi or pT bins) are fitted
+at once with a vectorised Levenberg-Marquardt chi2 minimisation, using the same conventions as
+a ROOT TH1::Fit with the "gaus" formula and the "R" option (bin centres inside the fit range,
+bin errors sqrt(sumw2), empty bins skipped, parameter errors from the chi2 curvature),
+and chunked sPlot helpers (yields, covariance and sWeights from the fitted component shapes)
+'''
+import numpy as np
+
+def gaus(x, norm, mu, sigma):
+    '''
+    Gaussian with the ROOT "gaus" parametrisation, broadcast over the leading (slice) dimension
+    '''
+    return norm[..., None] * np.exp(-0.5 * ((x - mu[..., None]) / sigma[..., None])**2)
+
+def _gaus_jacobian(x, params):
+    norm, mu, sigma = params[:, 0, None], params[:, 1, None], params[:, 2, None]
+    delta = (x - mu) / sigma
+    shape = np.exp(-0.5 * delta**2)
+    values = norm * shape
+    jac = np.stack([shape, values * delta / sigma, values * delta**2 / sigma], axis=-1)
+    return values, jac
+
+def fit_gaus_batched(centers, sumw, sumw2, fit_min, fit_max, init, max_iter=200, tol=1.e-9):
+    '''
+    Fit a Gaussian to each histogram of a stack.
+
+    Args:
+        centers (np.ndarray): bin centres, shape (nbins,).
+        sumw (np.ndarray): bin contents, shape (nslices, nbins).
+        sumw2 (np.ndarray): sum of squared weights, shape (nslices, nbins).
+        fit_min, fit_max (float): fit range.
+        init (np.ndarray): initial (norm, mu, sigma), shape (nslices, 3).
+        max_iter (int): maximum number of iterations.
+        tol (float): relative chi2 change at which a fit is considered converged.
+
+    Returns:
+        dict: arrays of shape (nslices,) with norm, mu, sigma, their errors
+        (norm_err, mu_err, sigma_err), chi2, ndf and converged
+    '''
+    in_range = (centers >= fit_min) & (centers <= fit_max)
+    x = np.asarray(centers, dtype=np.float64)[in_range]
+    y = np.asarray(sumw, dtype=np.float64)[:, in_range]
+    err2 = np.asarray(sumw2, dtype=np.float64)[:, in_range]
+    weights = np.divide(1., err2, out=np.zeros_like(err2), where=err2 > 0)
+    ndf = np.count_nonzero(weights, axis=1) - 3
+    fittable = ndf >= 0
+
+    params = np.array(init, dtype=np.float64, copy=True)
+    params[:, 2] = np.where(params[:, 2] > 0, params[:, 2], (fit_max - fit_min) / 4)
+    lam = np.full(len(params), 1.e-3)
+    converged = np.zeros(len(params), dtype=bool)
+    values, jac = _gaus_jacobian(x, params)
+    chi2 = np.sum(weights * (y - values)**2, axis=1)
+    eye = np.eye(3)
+
+    for _ in range(max_iter):
+        # only the slices still being fitted are updated, so that a few slow ones do not cost a full pass
+        active = np.flatnonzero(fittable & ~converged)
+        if len(active) == 0:
+            break
+        jac_w = jac[active] * weights[active, :, None]
+        hess = np.einsum('sbi,sbj->sij', jac_w, jac[active])
+        grad = np.einsum('sbi,sb->si', jac_w, y[active] - values[active])
+        damped = hess + lam[active, None, None] * hess * eye
+        # pseudo-inverse, so that a degenerate slice (e.g. too few filled bins) does not stop the others
+        step = np.einsum('sij,sj->si', np.linalg.pinv(damped), grad)
+        new_params = params[active] + step
+        new_values, new_jac = _gaus_jacobian(x, new_params)
+        new_chi2 = np.sum(weights[active] * (y[active] - new_values)**2, axis=1)
+
+        accept = np.isfinite(new_chi2) & (new_chi2 <= chi2[active])
+        converged[active[accept & (chi2[active] - new_chi2 <= tol * np.maximum(new_chi2, 1.))]] = True
+        accepted = active[accept]
+        params[accepted] = new_params[accept]
+        values[accepted] = new_values[accept]
+        jac[accepted] = new_jac[accept]
+        chi2[accepted] = new_chi2[accept]
+        lam[active] = np.where(accept, lam[active] * 0.1, lam[active] * 10.)
+        converged[active[lam[active] > 1.e10]] = True
+
+    hess = np.einsum('sbi,sbj->sij', jac * weights[..., None], jac)
+    hess[~fittable] = eye
+    cov = np.linalg.pinv(hess)
+    errors = np.sqrt(np.abs(np.diagonal(cov, axis1=1, axis2=2)))
+    params[~fittable] = np.nan
+    errors[~fittable] = np.nan
+
+    return {
+        'norm': params[:, 0], 'mu': params[:, 1], 'sigma': np.abs(params[:, 2]),
+        'norm_err': errors[:, 0], 'mu_err': errors[:, 1], 'sigma_err': errors[:, 2],
+        'chi2': chi2, 'ndf': ndf, 'converged': converged & fittable
+    }
+
+def chunk_slices(n_entries, chunk_size):
+    '''
+    Slices of consecutive chunks of at most chunk_size entries
+    '''
+    return [slice(start, min(start + chunk_size, n_entries)) for start in range(0, n_entries, chunk_size)]
+
+def fit_yields(pdf_values, yields, chunk_size=1_000_000, max_iter=200, tol=1.e-8):
+    '''
+    Maximum-likelihood yields of an extended mixture with fixed (normalised) component shapes,
+    by fixed-point (EM) iterations accumulated over chunks of candidates.
+
+    Args:
+        pdf_values (np.ndarray): pdf of each component at each candidate, shape (ncand, ncomp).
+        yields (np.ndarray): initial yields, shape (ncomp,).
+
+    Returns:
+        np.ndarray: yields, shape (ncomp,)
+    '''
+    yields = np.asarray(yields, dtype=np.float64)
+    for _ in range(max_iter):
+        new_yields = np.zeros_like(yields)
+        for chunk in chunk_slices(len(pdf_values), chunk_size):
+            values = np.asarray(pdf_values[chunk], dtype=np.float64)
+            resp = values * yields / (values @ yields)[:, None]
+            new_yields += resp.sum(axis=0)
+        converged = np.all(np.abs(new_yields - yields) <= tol * np.maximum(np.abs(new_yields), 1.))
+        yields = new_yields
+        if converged:
+            break
+    return yields
+
+def sweights_covariance(pdf_values, yields, chunk_size=1_000_000):
+    '''
+    Covariance matrix of the yields used by the sPlot, inverse of
+    sum_n f_i(m_n) f_j(m_n) / (sum_k N_k f_k(m_n))^2 accumulated over chunks of candidates
+    '''
+    yields = np.asarray(yields, dtype=np.float64)
+    inv_cov = np.zeros((len(yields), len(yields)))
+    for chunk in chunk_slices(len(pdf_values), chunk_size):
+        values = np.asarray(pdf_values[chunk], dtype=np.float64)
+        values_norm = values / (values @ yields)[:, None]
+        inv_cov += values_norm.T @ values_norm
+    return np.linalg.inv(inv_cov)
+
+def compute_sweights(pdf_values, yields, cov, comp=0, chunk_size=1_000_000):
+    '''
+    sWeights of one component, computed chunk by chunk into a float32 array
+
+    Returns:
+        np.ndarray: sWeights, shape (ncand,)
+    '''
+    yields = np.asarray(yields, dtype=np.float64)
+    sweights = np.empty(len(pdf_values), dtype=np.float32)
+    for chunk in chunk_slices(len(pdf_values), chunk_size):
+        values = np.asarray(pdf_values[chunk], dtype=np.float64)
+        sweights[chunk] = (values @ cov[comp]) / (values @ yields)
+    return sweights
@@ -0,0 +1,85 @@
+'''
+NumPy histogramming helpers following the ROOT TH1/TH2 binning conventions
+(bin 0 is the underflow, bin nbins+1 the overflow), so that the arrays can be
+copied bin for bin into ROOT histograms. The values are binned and summed in double precision,
+as ROOT does, so that float32 inputs are only upcast in the (chunk-sized) temporaries of a call.
+'''
+import numpy as np
+
+def uniform_bin_index(values, nbins, xmin, xmax):
+    '''
+    ROOT bin index of each value for a fixed-width axis (same rounding as TAxis::FindBin)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    idx = np.where(values < xmin, 0, nbins + 1)
+    in_range = (values >= xmin) & (values < xmax)
+    idx[in_range] = 1 + (nbins * (values[in_range] - xmin) / (xmax - xmin)).astype(np.int64)
+    return idx
+
+def variable_bin_index(values, edges):
+    '''
+    ROOT bin index of each value for a variable-width axis defined by its edges
+    '''
+    return np.searchsorted(np.asarray(edges, dtype=np.float64),
+                           np.asarray(values, dtype=np.float64), side='right')
+
+def stacked_histogram(outer_idx, inner_idx, n_outer, n_inner, weights, weights2=None):
+    '''
+    Fill in a single pass a stack of weighted histograms, one per outer bin.
+
+    Args:
+        outer_idx (np.ndarray): ROOT bin index along the outer (stacking) axis.
+        inner_idx (np.ndarray): ROOT bin index along the histogrammed axis.
+        n_outer, n_inner (int): number of regular bins of the two axes.
+        weights (np.ndarray): per-entry weights.
+        weights2 (np.ndarray): per-entry sums of squared weights, weights**2 if None
+            (entries that are the bins of a finer histogram).
+
+    Returns:
+        tuple: (sumw, sumw2) arrays of shape (n_outer+2, n_inner+2), flow bins included.
+        The flattened array follows the ROOT global-bin ordering of a TH2 with
+        the inner axis as x and the outer axis as y.
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    weights2 = weights * weights if weights2 is None else np.asarray(weights2, dtype=np.float64)
+    flat_idx = np.asarray(outer_idx) * (n_inner + 2) + np.asarray(inner_idx)
+    size = (n_outer + 2) * (n_inner + 2)
+    sumw = np.bincount(flat_idx, weights=weights, minlength=size)
+    sumw2 = np.bincount(flat_idx, weights=weights2, minlength=size)
+    return sumw.reshape(n_outer + 2, n_inner + 2), sumw2.reshape(n_outer + 2, n_inner + 2)
+
+def stacked_stats(outer_idx, n_outer, weights, values, weights2=None):
+    '''
+    TH1 statistics (sumw, sumw2, sumwx, sumwx2) for each outer bin, computed from
+    the entries that fall in the regular bins of the histogrammed axis
+    (weights2 as in stacked_histogram).
+
+    Returns:
+        np.ndarray: array of shape (n_outer+2, 4)
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    weights2 = weights * weights if weights2 is None else np.asarray(weights2, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    size = n_outer + 2
+    return np.stack([
+        np.bincount(outer_idx, weights=weights, minlength=size),
+        np.bincount(outer_idx, weights=weights2, minlength=size),
+        np.bincount(outer_idx, weights=weights * values, minlength=size),
+        np.bincount(outer_idx, weights=weights * values * values, minlength=size)
+    ], axis=1)
+
+def weighted_stats(weights, xvalues, yvalues=None, weights2=None):
+    '''
+    TH1 (sumw, sumw2, sumwx, sumwx2) or TH2 (..., sumwy, sumwy2, sumwxy) statistics
+    of the entries passed, which are expected to be inside the regular bins
+    (weights2 as in stacked_histogram).
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    xvalues = np.asarray(xvalues, dtype=np.float64)
+    stats = [weights.sum(), (weights * weights).sum() if weights2 is None else np.asarray(weights2, dtype=np.float64).sum(),
+             (weights * xvalues).sum(), (weights * xvalues * xvalues).sum()]
+    if yvalues is not None:
+        yvalues = np.asarray(yvalues, dtype=np.float64)
+        stats += [(weights * yvalues).sum(), (weights * yvalues * yvalues).sum(),
+                  (weights * xvalues * yvalues).sum()]
+    return np.array(stats, dtype=np.float64)
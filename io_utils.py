@@ -0,0 +1,128 @@
+'''
+Input layer for the AO2D candidate trees: reads only the needed branches, chunk by chunk,
+and applies the loosest selection of the configuration before building the DataFrame.
+The input can span several AO2D files (paths or glob patterns), each with several DF_* folders:
+all the trees matching the configured name are read concurrently, sharing a decompression thread pool.
+'''
+import os
+import glob
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# branches used by the fits and by the downstream plotting/resolution steps
+CANDIDATE_COLUMNS = ['fM', 'fPt', 'fPhi', 'fImpactParameterXY', 'fMlScoreBkg', 'fMlScoreNonPrompt']
+
+def get_columns(cfg):
+    '''
+    Branches to be read from the input tree for a given configuration
+    '''
+    columns = list(CANDIDATE_COLUMNS)
+    if cfg['cuts'].get('key') is not None and cfg['cuts']['key'] not in columns:
+        columns.append(cfg['cuts']['key'])
+    if cfg['inputs'].get('cent_key') is not None and cfg['inputs']['cent_key'] not in columns:
+        columns.append(cfg['inputs']['cent_key'])
+    return columns
+
+def get_preselection(cfg):
+    '''
+    Loosest (open) interval for each variable that contains the selections of all the bins
+
+    Returns:
+        dict: variable -> (min, max)
+    '''
+    n_bins = len(cfg['pt_mins'])
+    presel = {
+        'fPt': (min(cfg['pt_mins']), max(cfg['pt_maxs'])),
+        'fMlScoreBkg': (0, max(cfg['bdt_bkg_bins'][:n_bins])),
+        'fMlScoreNonPrompt': (min(cfg['bdt_sgn_bins'][:n_bins]), 1),
+    }
+    if cfg.get('mass_mins') and cfg.get('mass_maxs'):
+        presel['fM'] = (min(cfg['mass_mins'][:n_bins]), max(cfg['mass_maxs'][:n_bins]))
+    if cfg['inputs'].get('cent_key') is not None:
+        presel[cfg['inputs']['cent_key']] = (min(cfg['cent_bins']), max(cfg['cent_bins']))
+    if cfg['cuts'].get('key') is not None:
+        presel[cfg['cuts']['key']] = (min(cfg['cuts']['bins_min'][:n_bins]), max(cfg['cuts']['bins_max'][:n_bins]))
+    return presel
+
+def preselection_mask(arrays, presel):
+    '''
+    Boolean mask of the candidates passing the preselection
+    '''
+    mask = np.ones(len(next(iter(arrays.values()))), dtype=bool)
+    for var, (var_min, var_max) in presel.items():
+        mask &= (arrays[var] > var_min) & (arrays[var] < var_max)
+    return mask
+
+def get_input_files(cfg):
+    '''
+    Input files of a configuration: inputs.data is a path, a glob pattern or a list of them
+
+    Returns:
+        list: file names, in the order given (glob matches sorted), without duplicates
+    '''
+    patterns = cfg['inputs']['data']
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    file_names = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise FileNotFoundError(f'No input file matches {pattern}')
+        file_names.extend(matches)
+    return list(dict.fromkeys(file_names))
+
+def get_tree_names(file_name, tree_pattern):
+    '''
+    Trees of a file matching the configured tree name, which can be a pattern (e.g. DF_*/O2hfcharmcandlite)
+    '''
+    import uproot as up # pylint: disable=import-outside-toplevel
+    with up.open(file_name) as infile:
+        return sorted(key for key in infile.keys(cycle=False, filter_classname='TTree') if fnmatch(key, tree_pattern))
+
+def read_tree(file_name, tree_name, columns, presel, step_size, executor=None):
+    '''
+    Read the needed branches of a tree in chunks, keeping only the candidates passing the preselection
+
+    Returns:
+        dict: column -> list of arrays of the preselected candidates, one per chunk
+    '''
+    import uproot as up # pylint: disable=import-outside-toplevel
+    chunks = {col: [] for col in columns}
+    # the executor is given to iterate, not to the file, which shuts its executors down when closed
+    with up.open(file_name) as infile:
+        for arrays in infile[tree_name].iterate(columns, step_size=step_size, library='np',
+                                                decompression_executor=executor):
+            mask = preselection_mask(arrays, presel)
+            for col in columns:
+                chunks[col].append(arrays[col][mask])
+    return chunks
+
+def read_candidates(cfg):
+    '''
+    Read the candidate trees in chunks keeping only the needed branches (with their native dtypes)
+    and the candidates passing the preselection, so that the memory scales with the selected sample.
+    The trees of all the input files are read by inputs.threads threads (all the cores if not set),
+    the baskets being decompressed in a shared thread pool; the candidates are in file and tree order.
+    '''
+    columns = get_columns(cfg)
+    presel = get_preselection(cfg)
+    step_size = cfg['inputs'].get('step_size', '100 MB')
+    n_threads = cfg['inputs'].get('threads') or os.cpu_count()
+    file_names = get_input_files(cfg)
+
+    with ThreadPoolExecutor(n_threads) as executor, ThreadPoolExecutor(n_threads) as readers:
+        tree_names = readers.map(get_tree_names, file_names, [cfg['inputs']['fTreeDmeson']] * len(file_names))
+        trees = [(file_name, tree_name) for file_name, names in zip(file_names, tree_names) for tree_name in names]
+        if not trees:
+            raise ValueError(f"No tree {cfg['inputs']['fTreeDmeson']} in {file_names}")
+        print(f"Reading {len(trees)} trees from {len(file_names)} files with {n_threads} threads")
+        tree_chunks = list(readers.map(lambda tree: read_tree(*tree, columns, presel, step_size, executor), trees))
+
+    # one column at a time, releasing its chunks, so that the peak is the table plus one column;
+    # the DataFrame wraps the concatenated float32 arrays without copying or consolidating them
+    data = {}
+    for col in columns:
+        data[col] = np.concatenate([chunk for chunks in tree_chunks for chunk in chunks.pop(col)])
+    return pd.DataFrame(data, copy=False)
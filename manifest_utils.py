@@ -0,0 +1,135 @@
+'''
+Dependency manifests of the per-bin outputs, for the incremental re-runs. Each output directory
+keeps a manifest.json with the identity (path, size, modification time and SHA-256) of its input
+files, the settings it was produced with and the results needed to rebuild the logs and summaries;
+a bin is up to date if its settings are unchanged and its inputs have the same content.
+'''
+import os
+import json
+import hashlib
+import numpy as np
+
+MANIFEST_FILE = 'manifest.json'
+
+_file_hashes = {} # SHA-256 of the files already hashed in this process, by (path, size, mtime)
+
+def get_file_hash(file_name, block_size=1 << 24):
+    '''
+    SHA-256 of the content of a file, computed once per process for each version of the file
+    '''
+    stat = os.stat(file_name)
+    key = (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        file_hash = hashlib.sha256()
+        with open(file_name, 'rb') as file:
+            for block in iter(lambda: file.read(block_size), b''):
+                file_hash.update(block)
+        _file_hashes[key] = file_hash.hexdigest()
+    return _file_hashes[key]
+
+def get_input_identity(file_name, with_hash=True):
+    '''
+    Identity of an input file: absolute path, size, modification time and (optionally) content hash
+    '''
+    stat = os.stat(file_name)
+    identity = {'path': os.path.abspath(file_name), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        identity['sha256'] = get_file_hash(file_name)
+    return identity
+
+def is_same_input(identity, file_name):
+    '''
+    True if file_name is the recorded input; the content is only hashed if the modification time changed
+    '''
+    if not os.path.isfile(file_name):
+        return False
+    current = get_input_identity(file_name, with_hash=False)
+    if current['path'] != identity['path'] or current['size'] != identity['size']:
+        return False
+    return current['mtime_ns'] == identity['mtime_ns'] or get_file_hash(file_name) == identity.get('sha256')
+
+def normalise(deps):
+    '''
+    Settings as they read back from JSON (tuples become lists, numbers and strings are kept)
+    '''
+    return json.loads(json.dumps(deps, sort_keys=True, default=str))
+
+def load_manifest(out_dir):
+    '''
+    Manifest of an output directory, None if missing or unreadable
+    '''
+    file_name = os.path.join(out_dir, MANIFEST_FILE)
+    if not os.path.isfile(file_name):
+        return None
+    try:
+        with open(file_name, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def is_up_to_date(out_dir, deps, input_files, outputs=()):
+    '''
+    True if the output directory was produced with the same settings from the same inputs
+    and all its outputs still exist
+
+    Returns:
+        dict: the manifest if up to date, None otherwise
+    '''
+    manifest = load_manifest(out_dir)
+    if manifest is None or manifest.get('deps') != normalise(deps):
+        return None
+    if len(manifest.get('inputs', [])) != len(input_files):
+        return None
+    if not all(is_same_input(identity, file_name) for identity, file_name in zip(manifest['inputs'], input_files)):
+        return None
+    if not all(os.path.isfile(file_name) for file_name in outputs):
+        return None
+    return manifest
+
+def write_manifest(out_dir, deps, input_files, result=None):
+    '''
+    Record the settings, the inputs and the (JSON-serialisable) result of an output directory,
+    atomically (temporary file + rename)
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    file_name = os.path.join(out_dir, MANIFEST_FILE)
+    manifest = {
+        'deps': normalise(deps),
+        'inputs': [get_input_identity(input_file) for input_file in input_files],
+        'result': result
+    }
+    tmp_file_name = f'{file_name}.{os.getpid()}.tmp'
+    with open(tmp_file_name, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True, default=float)
+    os.replace(tmp_file_name, file_name)
+
+def save_arrays(file_name, res):
+    '''
+    Save a (possibly nested) dict of arrays and numbers as a .npz file, nested keys joined by "."
+    '''
+    flat = {}
+    def flatten(prefix, value):
+        if isinstance(value, dict):
+            for key, sub_value in value.items():
+                flatten(f'{prefix}{key}.', sub_value)
+        else:
+            flat[prefix[:-1]] = np.asarray(value)
+    flatten('', res)
+    tmp_file_name = f'{file_name}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_file_name, **flat)
+    os.replace(tmp_file_name, file_name)
+
+def load_arrays(file_name):
+    '''
+    Load a dict saved with save_arrays, 0-d arrays are returned as numbers
+    '''
+    res = {}
+    with np.load(file_name) as entry:
+        for flat_key in entry.files:
+            value = entry[flat_key]
+            keys = flat_key.split('.')
+            node = res
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = value.item() if value.ndim == 0 else value
+    return res
@@ -0,0 +1,143 @@
+'''
+Resolution and acceptance maps of the d0xy vs phi fits of compute_reso, as dense arrays over
+phi x pT x centrality, to correct the candidates without the ROOT files. For each working point the
+maps keep the mean (mu) and width (sigma) of the Gaussian fits of the d0xy in each phi slice, their
+ratio sigma/mu, the errors (from the bootstrap replicas if available, as in the histograms of
+compute_reso) and the phi acceptance, i.e. the sWeighted yield of each phi slice relative to the
+average slice. Cells without a fitted bin are NaN. The maps are looked up for arrays of candidates
+at once: the pT and centrality bins are found with a binary search on the edges, and phi is
+interpolated linearly (and periodically) between the centres of the slices.
+'''
+import numpy as np
+
+from manifest_utils import save_arrays, load_arrays
+
+MAP_KEYS = ['mu', 'mu_err', 'sigma', 'sigma_err', 'reso', 'reso_err', 'acceptance', 'acceptance_err']
+
+def get_slice_values(res):
+    '''
+    Fit results, errors and acceptance of the phi slices of a fit_reso result
+
+    Returns:
+        dict: array of nphibins values for each key of MAP_KEYS, and whether the fits converged
+    '''
+    fit_res = res['fit']
+    boot = res.get('bootstrap')
+    mu, sigma = np.asarray(fit_res['mu'], dtype=np.float64), np.asarray(fit_res['sigma'], dtype=np.float64)
+    mu_err = fit_res['mu_err'] if boot is None else boot['mu']['err']
+    sigma_err = fit_res['sigma_err'] if boot is None else boot['sigma']['err']
+    # sWeighted yield of each slice, all d0xy bins included
+    yields = np.asarray(res['dca_sumw'], dtype=np.float64)[1:-1].sum(axis=1)
+    yields2 = np.asarray(res['dca_sumw2'], dtype=np.float64)[1:-1].sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reso = sigma / mu
+        # the replicas include the correlation of mu and sigma, otherwise uncorrelated errors (as TH1::Divide)
+        reso_err = np.sqrt((sigma_err / mu)**2 + (sigma * mu_err / mu**2)**2) if boot is None else boot['reso']['err']
+        mean_yield = yields.mean()
+        acceptance, acceptance_err = yields / mean_yield, np.sqrt(yields2) / mean_yield
+    return {'mu': mu, 'mu_err': mu_err, 'sigma': sigma, 'sigma_err': sigma_err, 'reso': reso, 'reso_err': reso_err,
+            'acceptance': acceptance, 'acceptance_err': acceptance_err,
+            'converged': np.asarray(fit_res['converged'], dtype=bool)}
+
+def build_maps(results, selections):
+    '''
+    Maps of the fit_reso results of the bins of a working point (selections with cent_min, cent_max,
+    pt_min and pt_max). The pT and centrality edges are those of all the bins: a bin spanning several
+    of them fills all the cells it covers, and the bins must not overlap
+
+    Returns:
+        dict: phi_edges, pt_edges and cent_edges, and an array of shape (nphibins, npt, ncent) for each
+        key of MAP_KEYS and for converged
+    '''
+    phi_edges = np.asarray(results[0]['phi_edges'], dtype=np.float64)
+    if any(not np.array_equal(res['phi_edges'], phi_edges) for res in results):
+        raise ValueError('Only results with the same phi slices can be put in the same maps')
+    pt_edges = np.unique([sel[key] for sel in selections for key in ['pt_min', 'pt_max']]).astype(np.float64)
+    cent_edges = np.unique([sel[key] for sel in selections for key in ['cent_min', 'cent_max']]).astype(np.float64)
+    shape = (len(phi_edges) - 1, len(pt_edges) - 1, len(cent_edges) - 1)
+    maps = {key: np.full(shape, np.nan) for key in MAP_KEYS}
+    maps['converged'] = np.zeros(shape, dtype=bool)
+    filled = np.zeros(shape[1:], dtype=bool)
+    for res, sel in zip(results, selections):
+        pt_cells = slice(np.searchsorted(pt_edges, sel['pt_min']), np.searchsorted(pt_edges, sel['pt_max']))
+        cent_cells = slice(np.searchsorted(cent_edges, sel['cent_min']), np.searchsorted(cent_edges, sel['cent_max']))
+        if filled[pt_cells, cent_cells].any():
+            raise ValueError(f'The bin {sel} overlaps another bin of the maps')
+        filled[pt_cells, cent_cells] = True
+        for key, values in get_slice_values(res).items():
+            maps[key][:, pt_cells, cent_cells] = np.asarray(values)[:, None, None]
+    return {'phi_edges': phi_edges, 'pt_edges': pt_edges, 'cent_edges': cent_edges, **maps}
+
+def save_maps(file_name, maps):
+    '''
+    Save maps of build_maps as a .npz file
+    '''
+    save_arrays(file_name, maps)
+
+def load_maps(file_name):
+    '''
+    Load maps saved with save_maps
+    '''
+    return load_arrays(file_name)
+
+def find_bins(edges, values):
+    '''
+    Bin of each value (0 for the first bin) and whether it is inside the edges
+    '''
+    idx = np.searchsorted(edges, values, side='right') - 1
+    inside = (values >= edges[0]) & (values < edges[-1])
+    return np.clip(idx, 0, len(edges) - 2), inside
+
+def lookup_maps(maps, phi, pt, cent=None, keys=('mu', 'sigma'), interpolate=True):
+    '''
+    Values of the maps for arrays of candidates. The pT and centrality bins are found once for all
+    the keys; phi is taken modulo the phi range and, if interpolate, the float maps are interpolated
+    linearly between the centres of the two closest phi slices (across 0 = 2pi), otherwise the value of
+    the slice is taken. Flags (converged) hold if they hold in the slices interpolated, the other
+    integer maps take the value of the slice. cent can be omitted for maps with a single centrality bin
+
+    Returns:
+        dict: key -> array of the values of the candidates, with the dtype of the map, and inside: whether
+        each candidate is inside the pT and centrality edges. Outside of them the float maps are NaN and
+        the integer maps 0 (False for the flags)
+    '''
+    phi_edges, pt_edges, cent_edges = maps['phi_edges'], maps['pt_edges'], maps['cent_edges']
+    nphibins = len(phi_edges) - 1
+    pt_idx, inside = find_bins(pt_edges, np.asarray(pt, dtype=np.float64))
+    if cent is None:
+        if len(cent_edges) != 2:
+            raise ValueError(f'The maps have {len(cent_edges) - 1} centrality bins, the centrality is needed')
+        cent_idx = np.zeros_like(pt_idx)
+    else:
+        cent_idx, cent_inside = find_bins(cent_edges, np.asarray(cent, dtype=np.float64))
+        inside &= cent_inside
+    period = phi_edges[-1] - phi_edges[0]
+    phi = np.mod(np.asarray(phi, dtype=np.float64) - phi_edges[0], period) + phi_edges[0]
+    slice_idx, _ = find_bins(phi_edges, phi)
+    if interpolate:
+        # centres of the slices, with the last and first ones repeated one period before and after
+        centers = 0.5 * (phi_edges[1:] + phi_edges[:-1])
+        ext_centers = np.concatenate([[centers[-1] - period], centers, [centers[0] + period]])
+        pos = np.clip(np.searchsorted(ext_centers, phi, side='right') - 1, 0, nphibins)
+        frac = (phi - ext_centers[pos]) / (ext_centers[pos + 1] - ext_centers[pos])
+        low_idx, high_idx = (pos - 1) % nphibins, pos % nphibins
+    # flat indices of the cells in the (phi, pT, centrality) arrays, shared by all the keys
+    n_cells = (len(pt_edges) - 1) * (len(cent_edges) - 1)
+    cells = pt_idx * (len(cent_edges) - 1) + cent_idx
+    values = {'inside': inside}
+    for key in keys:
+        flat_map = np.ravel(maps[key])
+        if not np.issubdtype(flat_map.dtype, np.floating):
+            value = np.take(flat_map, slice_idx * n_cells + cells)
+            if interpolate and value.dtype == bool:
+                value = np.take(flat_map, low_idx * n_cells + cells) & \
+                    (np.take(flat_map, high_idx * n_cells + cells) | (frac == 0))
+            values[key] = np.where(inside, value, np.zeros((), dtype=value.dtype))
+            continue
+        if interpolate:
+            value = np.take(flat_map, low_idx * n_cells + cells)
+            value += frac * (np.take(flat_map, high_idx * n_cells + cells) - value)
+        else:
+            value = np.take(flat_map, slice_idx * n_cells + cells)
+        values[key] = np.where(inside, value, np.nan)
+    return values
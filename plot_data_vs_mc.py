@@ -1,37 +1,135 @@
-import pandas as pd
+'''
+Comparison of the sPlot phi distribution of the data (results store of splot_fit or histogram cubes of
+cube_utils) with the selected MC candidates, in each pT bin. Both are streamed in Arrow record batches
+with only the needed columns, the MC selection being pushed down to the Parquet reader (row groups are
+skipped from their statistics), and filled into histograms with the same binning. The pT bins are
+compared concurrently and the chi2 and Kolmogorov-Smirnov compatibility of each bin is reported.
+'''
+import re
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-input_data = ['/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/output_testPP_22Pass7/cent_0_100/pt_2_3/bkg_0_0.0300_sig_0.0000_1/df_sel.parquet',
-              '/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/output_testPP_22Pass7/cent_0_100/pt_3_5/bkg_0_0.0300_sig_0.0000_1/df_sel.parquet',
-              '/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/output_testPP_22Pass7/cent_0_100/pt_8_12/bkg_0_0.0300_sig_0.0000_1/df_sel.parquet',
-              ]
-input_mc = ['/home/stefano/Desktop/cernbox/checks/dmeson_phi/download/pt2_3/Prompt_pT_2_3_ModelApplied.parquet.gzip',
-            '/home/stefano/Desktop/cernbox/checks/dmeson_phi/download/pt3_5/Prompt_pT_3_5_ModelApplied.parquet.gzip',
-            '/home/stefano/Desktop/cernbox/checks/dmeson_phi/download/pt8_12/Prompt_pT_8_12_ModelApplied.parquet.gzip']
-
-sels = ['ML_output_Bkg < 0.03', 'ML_output_Bkg < 0.03', 'ML_output_Bkg < 0.03']
-labels = ['pt_2_3', 'pt3_5', 'pt8_12']
-
-for idf, (data, mc, sel, label) in enumerate(zip(input_data, input_mc, sels, labels)):
-    
-    df_data = pd.read_parquet(data, engine='pyarrow')
-    df_mc = pd.read_parquet(mc, engine='pyarrow')
-    df_mc_sel = df_mc.query(sel, inplace=False)
-    
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from store_utils import iter_bins
+from cube_utils import load_cubes, project_histogram
+from stats_utils import compare_histograms, fill_histogram, get_density
+
+MC_COLUMN = 'fPhi'
+_SELECTION_TERM = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$')
+
+def get_mc_filters(sel):
+    '''
+    Parquet filters of an MC selection, either already as a list of (column, op, value) tuples or
+    as a query string of comparisons joined by & or and (e.g. 'ML_output_Bkg < 0.03')
+    '''
+    if not isinstance(sel, str):
+        return list(sel)
+    filters = []
+    for term in re.split(r'\s*(?:&|\band\b)\s*', sel.strip()):
+        match = _SELECTION_TERM.match(term)
+        if match is None:
+            raise ValueError(f'Cannot push down "{term}" of the MC selection "{sel}": use comparisons '
+                             'of a column with a number joined by & (or a list of Parquet filters)')
+        filters.append((match.group(1), match.group(2), float(match.group(3))))
+    return filters
+
+def iter_mc(mc, sel, columns=(MC_COLUMN,), batch_size=1_000_000):
+    '''
+    Record batches of the MC candidates passing the selection, one or several Parquet files
+
+    Returns:
+        iterator: dicts column -> numpy array, one per batch
+    '''
+    dataset = ds.dataset(mc, format='parquet')
+    batches = dataset.to_batches(columns=list(columns), filter=pq.filters_to_expression(get_mc_filters(sel)),
+                                 batch_size=batch_size)
+    for batch in batches:
+        yield {col: array.to_numpy(zero_copy_only=False) for col, array in zip(columns, batch.columns)}
+
+def read_data_vs_mc(store_dir, data, mc, sel, nbins=100, cube_dir=None):
+    '''
+    Phi histograms (nbins in [0, 2pi]) of the data in a store bin, sWeighted, projected from the histogram
+    cube of the bin if a cube_dir is given (see cube_utils), and of the selected MC candidates
+
+    Returns:
+        tuple: (data histogram, MC histogram) as stats_utils.histogram
+    '''
+    if cube_dir is not None:
+        data_hist = project_histogram(load_cubes(cube_dir, **data), 'phi', nbins, 0, 2*np.pi)
+    else:
+        data_hist = fill_histogram(iter_bins(store_dir, ['fPhi', 'sgn_sweights'], **data),
+                                   'fPhi', nbins, 0, 2*np.pi, weight_column='sgn_sweights')
+    mc_hist = fill_histogram(iter_mc(mc, sel), MC_COLUMN, nbins, 0, 2*np.pi)
+    return data_hist, mc_hist
+
+def compare_data_vs_mc(store_dir, data, mc, sel, nbins=100, cube_dir=None):
+    '''
+    Histograms and chi2/Kolmogorov-Smirnov compatibility of the data and MC phi distributions of a bin
+
+    Returns:
+        dict: data and mc histograms, and the metrics of stats_utils.compare_histograms
+    '''
+    data_hist, mc_hist = read_data_vs_mc(store_dir, data, mc, sel, nbins, cube_dir)
+    return {'data': data_hist, 'mc': mc_hist, **compare_histograms(data_hist, mc_hist, 'sumw', 'entries')}
+
+def compare_bins(store_dir, inputs, nbins=100, cube_dir=None, jobs=1):
+    '''
+    compare_data_vs_mc on each (data selection, MC files, MC selection) of inputs, jobs bins at a time;
+    the reading and filling run in Arrow and NumPy, so threads are enough to overlap the bins
+
+    Returns:
+        list: results of compare_data_vs_mc, in the order of inputs
+    '''
+    if jobs <= 1:
+        return [compare_data_vs_mc(store_dir, data, mc, sel, nbins, cube_dir) for data, mc, sel in inputs]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda args: compare_data_vs_mc(store_dir, *args, nbins, cube_dir), inputs))
+
+def plot_data_vs_mc(comparison, label, outdir='.'):
+    '''
+    Normalised phi distributions of data (sPlot) and MC of a result of compare_data_vs_mc, with
+    the compatibility metrics, saved as outdir/phi_data_vs_mc_<label>.png
+    '''
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
     fig, ax = plt.subplots(figsize=(8, 6))
 
-    sgn_weights = df_data['sgn_sweights']
-    df_data['fPhi'].hist(bins=100, weights=sgn_weights, alpha=0.5, density=True, range=(0, 2*np.pi), color='r', label='Data (sPlot)')
-    ax.set_xlabel('fPhi')
-    df_mc_sel['fPhi'].hist(bins=100, alpha=0.1, density=True, range=(0, 2*np.pi), color='b', label='MC (Prompt)')
+    edges = comparison['data']['edges']
+    ax.hist(edges[:-1], bins=edges, weights=get_density(comparison['data'], 'sumw')[0], alpha=0.5, color='r', label='Data (sPlot)')
+    ax.hist(edges[:-1], bins=edges, weights=get_density(comparison['mc'], 'entries')[0], alpha=0.1, color='b', label='MC (Prompt)')
 
     ax.set_xlabel('fPhi')
     ax.set_ylabel('Counts')
-    ax.legend()
+    ax.legend(title=f"$\\chi^2$/ndf = {comparison['chi2']:.1f}/{comparison['ndf']}, KS prob. = {comparison['ks_prob']:.3f}")
+
+    fig.savefig(f'{outdir}/phi_data_vs_mc_{label}.png')
+    plt.close(fig)
+
+if __name__ == "__main__":
+    # selected candidates of splot_fit, only the bins used here are read
+    store_dir = '/home/stefano/Desktop/cernbox/checks/dmeson_phi/hf-hadron-phi-check/output_testPP_22Pass7/candidates'
+    input_data = [{'cent_min': 0, 'cent_max': 100, 'pt_min': 2, 'pt_max': 3, 'bkg_max': 0.03, 'sig_min': 0.},
+                  {'cent_min': 0, 'cent_max': 100, 'pt_min': 3, 'pt_max': 5, 'bkg_max': 0.03, 'sig_min': 0.},
+                  {'cent_min': 0, 'cent_max': 100, 'pt_min': 8, 'pt_max': 12, 'bkg_max': 0.03, 'sig_min': 0.},
+                  ]
+    input_mc = ['/home/stefano/Desktop/cernbox/checks/dmeson_phi/download/pt2_3/Prompt_pT_2_3_ModelApplied.parquet.gzip',
+                '/home/stefano/Desktop/cernbox/checks/dmeson_phi/download/pt3_5/Prompt_pT_3_5_ModelApplied.parquet.gzip',
+                '/home/stefano/Desktop/cernbox/checks/dmeson_phi/download/pt8_12/Prompt_pT_8_12_ModelApplied.parquet.gzip']
 
-    fig.savefig(f'./phi_data_vs_mc_{label}.png')
+    # histogram cubes of cube_utils, if set the data histograms are projected from them instead of the store
+    cube_dir = None
 
+    # MC selections, pushed down to the Parquet reader
+    sels = ['ML_output_Bkg < 0.03', 'ML_output_Bkg < 0.03', 'ML_output_Bkg < 0.03']
+    labels = ['pt_2_3', 'pt3_5', 'pt8_12']
+    # pT bins compared at the same time
+    jobs = len(labels)
 
-    
\ No newline at end of file
+    comparisons = compare_bins(store_dir, list(zip(input_data, input_mc, sels)), cube_dir=cube_dir, jobs=jobs)
+    for comparison, label in zip(comparisons, labels):
+        plot_data_vs_mc(comparison, label)
+    df_compat = pd.DataFrame([{**data, **{key: comparison[key] for key in ['chi2', 'ndf', 'chi2_prob', 'ks_distance', 'ks_prob']}}
+                              for data, comparison in zip(input_data, comparisons)])
+    print(df_compat.to_string(index=False))
+    df_compat.to_csv('phi_data_vs_mc_compatibility.csv', index=False)
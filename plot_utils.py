@@ -1,7 +1,9 @@
-import ROOT
-from ROOT import gStyle, gROOT
-import pandas as pd
-from scipy.interpolate import InterpolatedUnivariateSpline
+'''
+ROOT plotting helpers. ROOT is imported by the functions that use it, when something is drawn,
+so that importing this module (and the scripts using it) does not load ROOT.
+'''
+import numpy as np
+from export_utils import get_file_names, is_up_to_date, mark_up_to_date
 
 #_________________________________________________________________________________________________________________________________________
 # Utility functions
@@ -42,97 +44,113 @@ def SetGlobalStyle(**kwargs):
 
     - palette (int), default kBird
     '''
+    import ROOT # pylint: disable=import-outside-toplevel
 
     # pad margins
     if 'padrightmargin' in kwargs:
-        gStyle.SetPadRightMargin(kwargs['padrightmargin'])
+        ROOT.gStyle.SetPadRightMargin(kwargs['padrightmargin'])
     else:
-        gStyle.SetPadRightMargin(0.035)
+        ROOT.gStyle.SetPadRightMargin(0.035)
 
     if 'padleftmargin' in kwargs:
-        gStyle.SetPadLeftMargin(kwargs['padleftmargin'])
+        ROOT.gStyle.SetPadLeftMargin(kwargs['padleftmargin'])
     else:
-        gStyle.SetPadLeftMargin(0.12)
+        ROOT.gStyle.SetPadLeftMargin(0.12)
 
     if 'padtopmargin' in kwargs:
-        gStyle.SetPadTopMargin(kwargs['padtopmargin'])
+        ROOT.gStyle.SetPadTopMargin(kwargs['padtopmargin'])
     else:
-        gStyle.SetPadTopMargin(0.035)
+        ROOT.gStyle.SetPadTopMargin(0.035)
 
     if 'padbottommargin' in kwargs:
-        gStyle.SetPadBottomMargin(kwargs['padbottommargin'])
+        ROOT.gStyle.SetPadBottomMargin(kwargs['padbottommargin'])
     else:
-        gStyle.SetPadBottomMargin(0.1)
+        ROOT.gStyle.SetPadBottomMargin(0.1)
 
     # title sizes
     if 'titlesize' in kwargs:
-        gStyle.SetTitleSize(kwargs['titlesize'], 'xyz')
+        ROOT.gStyle.SetTitleSize(kwargs['titlesize'], 'xyz')
     else:
-        gStyle.SetTitleSize(0.050, 'xyz')
+        ROOT.gStyle.SetTitleSize(0.050, 'xyz')
 
     if 'titlesizex' in kwargs:
-        gStyle.SetTitleSize(kwargs['titlesizex'], 'x')
+        ROOT.gStyle.SetTitleSize(kwargs['titlesizex'], 'x')
     if 'titlesizey' in kwargs:
-        gStyle.SetTitleSize(kwargs['titlesizex'], 'y')
+        ROOT.gStyle.SetTitleSize(kwargs['titlesizex'], 'y')
     if 'titlesizez' in kwargs:
-        gStyle.SetTitleSize(kwargs['titlesizex'], 'z')
+        ROOT.gStyle.SetTitleSize(kwargs['titlesizex'], 'z')
 
     # label sizes
     if 'labelsize' in kwargs:
-        gStyle.SetLabelSize(kwargs['labelsize'], 'xyz')
+        ROOT.gStyle.SetLabelSize(kwargs['labelsize'], 'xyz')
     else:
-        gStyle.SetLabelSize(0.045, 'xyz')
+        ROOT.gStyle.SetLabelSize(0.045, 'xyz')
 
     if 'labelsizex' in kwargs:
-        gStyle.SetLabelSize(kwargs['labelsizex'], 'x')
+        ROOT.gStyle.SetLabelSize(kwargs['labelsizex'], 'x')
     if 'labelsizey' in kwargs:
-        gStyle.SetLabelSize(kwargs['labelsizey'], 'y')
+        ROOT.gStyle.SetLabelSize(kwargs['labelsizey'], 'y')
     if 'labelsizez' in kwargs:
-        gStyle.SetLabelSize(kwargs['labelsizez'], 'z')
+        ROOT.gStyle.SetLabelSize(kwargs['labelsizez'], 'z')
 
     # title offsets
     if 'titleoffset' in kwargs:
-        gStyle.SetTitleOffset(kwargs['titleoffset'], 'xyz')
+        ROOT.gStyle.SetTitleOffset(kwargs['titleoffset'], 'xyz')
     else:
-        gStyle.SetTitleOffset(1.2, 'xyz')
+        ROOT.gStyle.SetTitleOffset(1.2, 'xyz')
 
     if 'titleoffsetx' in kwargs:
-        gStyle.SetTitleOffset(kwargs['titleoffsetx'], 'x')
+        ROOT.gStyle.SetTitleOffset(kwargs['titleoffsetx'], 'x')
     if 'titleoffsety' in kwargs:
-        gStyle.SetTitleOffset(kwargs['titleoffsety'], 'y')
+        ROOT.gStyle.SetTitleOffset(kwargs['titleoffsety'], 'y')
     if 'titleoffsetz' in kwargs:
-        gStyle.SetTitleOffset(kwargs['titleoffsetz'], 'z')
+        ROOT.gStyle.SetTitleOffset(kwargs['titleoffsetz'], 'z')
 
     # other options
     if 'opttitle' in kwargs:
-        gStyle.SetOptTitle(kwargs['opttitle'])
+        ROOT.gStyle.SetOptTitle(kwargs['opttitle'])
     else:
-        gStyle.SetOptTitle(0)
+        ROOT.gStyle.SetOptTitle(0)
 
     if 'optstat' in kwargs:
-        gStyle.SetOptStat(kwargs['optstat'])
+        ROOT.gStyle.SetOptStat(kwargs['optstat'])
     else:
-        gStyle.SetOptStat(0)
+        ROOT.gStyle.SetOptStat(0)
 
     if 'padtickx' in kwargs:
-        gStyle.SetPadTickX(kwargs['padtickx'])
+        ROOT.gStyle.SetPadTickX(kwargs['padtickx'])
     else:
-        gStyle.SetPadTickX(1)
+        ROOT.gStyle.SetPadTickX(1)
 
     if 'padticky' in kwargs:
-        gStyle.SetPadTickY(kwargs['padticky'])
+        ROOT.gStyle.SetPadTickY(kwargs['padticky'])
     else:
-        gStyle.SetPadTickY(1)
+        ROOT.gStyle.SetPadTickY(1)
 
-    gStyle.SetLegendBorderSize(0)
+    ROOT.gStyle.SetLegendBorderSize(0)
 
     if 'maxdigits' in kwargs:
-        TGaxis.SetMaxDigits(kwargs['maxdigits'])
+        ROOT.TGaxis.SetMaxDigits(kwargs['maxdigits'])
 
     if 'palette' in kwargs:
-        gStyle.SetPalette(kwargs['palette'])
+        ROOT.gStyle.SetPalette(kwargs['palette'])
 
-    gROOT.ForceStyle()
+    ROOT.gROOT.ForceStyle()
+
+def SetBatchMode(batch=True):
+    '''
+    Method to run ROOT without graphics (e.g. on farm nodes): canvases are only
+    painted when they are saved, and the info messages of TCanvas::Print are muted.
+
+    Parameters
+    ----------
+
+    - batch (bool), default = True
+    '''
+    import ROOT # pylint: disable=import-outside-toplevel
+    ROOT.gROOT.SetBatch(batch)
+    if batch:
+        ROOT.gErrorIgnoreLevel = max(ROOT.gErrorIgnoreLevel, ROOT.kWarning)
 
 def SetObjectStyle(obj, **kwargs):
     '''
@@ -254,6 +272,7 @@ def PlotEmptyClone(graph, leg, msize):
         leg (ROOT.TLegend): Legend to add the entry to.
         msize (float): Marker size.
     """
+    import ROOT # pylint: disable=import-outside-toplevel
     clone = graph.Clone(graph.GetName() + '_clone')
 
     # Map filled markers to empty equivalents
@@ -280,6 +299,7 @@ def GetCanvas(name, axisname, xmin=0.4, xmax=40, ymin=-0.20, ymax=0.62):
     Returns:
         tuple: (canvas, frame)
     """
+    import ROOT # pylint: disable=import-outside-toplevel
     canv = ROOT.TCanvas(name, name, 800, 800)
     
     hframe = canv.DrawFrame(xmin, ymin, xmax, ymax, axisname)
@@ -299,6 +319,7 @@ def GetCanvas3sub(name, axisname, ymin=-0.015, ymax=0.015, xmin=0, xmax=6.34):
     Returns:
         tuple: (canvas, frames)
     """
+    import ROOT # pylint: disable=import-outside-toplevel
     canvas = ROOT.TCanvas(name, name, 1600, 600)
     canvas.Divide(3, 1, 0, 0)  # Remove spacing between pads
 
@@ -344,6 +365,7 @@ def GetCanvas2sub(name, xmins, xmaxs, ymins_mass, ymaxs_mass, ymins_v2, ymaxs_v2
     Returns:
         tuple: (canvas, frames)
     """
+    import ROOT # pylint: disable=import-outside-toplevel
     # Create canvas with 2 rows (top = mass, bottom = v2)
     canvas = ROOT.TCanvas(name, name, 600, 900)  
     canvas.Divide(1, 2, 0, 0.0)  # Small spacing between top and bottom
@@ -391,6 +413,7 @@ def GetLegend(xmin=0.19, ymin=0.62, xmax=0.75, ymax=0.77, textsize=0.04, ncolumn
     Returns:
         ROOT.TLegend: Configured legend.
     """
+    import ROOT # pylint: disable=import-outside-toplevel
     leg = ROOT.TLegend(xmin, ymin, xmax, ymax)
     leg.SetTextSize(textsize)
     leg.SetNColumns(ncolumns)
@@ -422,6 +445,7 @@ def LoadGraphAndSyst(path_to_file, graph_name, syst_name, syst_fd, color, marker
         tuple: (graph, syst, syst_fd) if both systematic uncertainties are provided,
                (graph, syst) if only one is provided, or (graph) otherwise.
     """
+    import ROOT # pylint: disable=import-outside-toplevel
     infile = ROOT.TFile.Open(path_to_file)
     graph = infile.Get(graph_name)
     SetObjectStyle(graph, markerstyle=marker, markercolor=color, markersize=markersize, linecolor=color, linewidth=2)
@@ -447,7 +471,7 @@ def DrawStatSystEmpty(graph, gsyst, gfd, leg, markersize=2):
     graph.Draw('PZ same')
     PlotEmptyClone(graph, leg, markersize)
 
-def SaveCanvas(canv, title, suffix='', formats=('pdf', 'png')):
+def SaveCanvas(canv, title, suffix='', formats=('pdf', 'png'), inputs_hash=None):
     """
     Saves canvas in multiple formats.
     
@@ -456,6 +480,31 @@ def SaveCanvas(canv, title, suffix='', formats=('pdf', 'png')):
         title (str): Output file name.
         suffix (str): Additional suffix.
         formats (tuple): File formats.
+        inputs_hash (str): Hash of the canvas inputs, if given the canvas is
+            only painted and saved when the existing files have a different one.
+    """
+    file_names = get_file_names(f'{title}{suffix}', formats)
+    if inputs_hash is not None and is_up_to_date(file_names, inputs_hash):
+        return
+    for file_name in file_names:
+        canv.SaveAs(file_name)
+    if inputs_hash is not None:
+        mark_up_to_date(file_names, inputs_hash)
+
+
+def FillHistFromArrays(hist, sumw, sumw2, stats, entries):
+    """
+    Sets the content of a ROOT histogram from NumPy arrays.
+
+    Args:
+        hist (ROOT.TH1): Histogram to fill.
+        sumw (np.ndarray): Bin contents, flow bins included, in ROOT global-bin order.
+        sumw2 (np.ndarray): Sum of squared weights, same layout as sumw.
+        stats (np.ndarray): Statistics as expected by TH1::PutStats.
+        entries (float): Number of entries.
     """
-    for form in formats:
-        canv.SaveAs(f'{title}{suffix}.{form}')
+    hist.SetContent(np.ascontiguousarray(sumw, dtype=np.float64).ravel())
+    hist.Sumw2()
+    hist.GetSumw2().Set(hist.GetNcells(), np.ascontiguousarray(sumw2, dtype=np.float64).ravel())
+    hist.PutStats(np.ascontiguousarray(stats, dtype=np.float64))
+    hist.SetEntries(entries)
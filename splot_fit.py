@@ -1,176 +1,799 @@
 
 import argparse
 import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
 os.environ["CUDA_VISIBLE_DEVICES"] = ""  # pylint: disable=wrong-import-position
 import numpy as np
-import uproot as up
-import seaborn as sns
-import matplotlib.pyplot as plt
-from flarefly.data_handler import DataHandler
-from flarefly.fitter import F2MassFitter
+import pandas as pd
 import yaml
+from io_utils import get_input_files, read_candidates
+from hist_utils import variable_bin_index
+from stats_utils import get_density, grouped_moments, histogram, weighted_quantiles
+from fit_utils import chunk_slices, fit_yields, sweights_covariance, compute_sweights
+from fit_cache import FIT_INFO_VERSION, get_fit_key, load_fit, store_fit, evict
+from store_utils import get_bin_file, get_partition, get_store_dir, write_bin
+from export_utils import FigureExporter, get_export_config, get_figure, is_exported, needs_export
+from fit_monitor import get_fit_record, get_peak_rss_mb, peak_rss, timed, write_fit_log
+from manifest_utils import is_up_to_date, write_manifest
 
 def get_distribution(df, var):
-    df = df[var]
-    if "sgn_sweights" in df.columns:
-        mean = np.average(df[var], weights=df['sgn_sweights'])
-        sigma = np.sqrt(np.average((df[var] - mean)**2, weights=df['sgn_sweights']))
-    else:
+    '''
+    Mean and standard deviation of a variable, sWeighted if the sPlot weights are in the DataFrame
+    '''
+    weights = df['sgn_sweights'].to_numpy() if "sgn_sweights" in df.columns else None
+    if weights is None:
         print(f"Warning: sPlot weights not found in the dataframe. Using standard mean and sigma")
-        mean = np.average(df[var])
-        sigma = df[var].std()
-    return mean, sigma
+    moments = grouped_moments({var: df[var].to_numpy()}, weights)
+    return moments['mean'][0, 0], moments['std'][0, 0]
 
-def plot_distribution(df, var):
+def plot_distribution(df, var, nbins=100):
     '''
-    Plot the distribution of a variable applying the sPlot weights
+    Plot the distribution of a variable applying the sPlot weights, the sWeighted (signal) and
+    unweighted (data) densities being histogrammed together
     '''
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
     fig, ax = plt.subplots(figsize=(8, 6))
-    if var == 'fPhi':
-        # apply sPlot weights
-        if "sgn_sweights" in df.columns:
-            sgn_weights = df['sgn_sweights']
-            df[var].hist(bins=100, weights=sgn_weights, alpha=0.5, density=True, range=(0, 2*np.pi), color='r', label='Signal')
-            ax.set_xlabel(var)
-            df[var].hist(bins=100, alpha=0.1, density=True, range=(0, 2*np.pi), color='b', label='Data')
+    if "sgn_sweights" in df.columns:
+        values = df[var].to_numpy()
+        if var == 'fPhi':
+            xmin, xmax = 0, 2*np.pi
         else:
-            print(f"Warning: sPlot weights not found in the dataframe. Plotting data without weights")
-            sns.histplot(df[var], bins=100, kde=True, ax=ax, color='b', label='Data')
-    elif var == 'fImpactParameterXY':
-        # apply sPlot weights
-        if "sgn_sweights" in df.columns:
-            sgn_weights = df['sgn_sweights']
-            df[var].hist(bins=100, weights=sgn_weights, alpha=0.5, density=True, color='r', label='Signal')
-            ax.set_xlabel(var)
-            df[var].hist(bins=100, alpha=0.1, density=True, color='b', label='Data')
-            # set log y
+            # full range of the values, the maximum included
+            xmin, xmax = (float(values.min()), float(np.nextafter(values.max(), np.inf))) if len(values) else (-1, 1)
+        hist = histogram(values, nbins, xmin, xmax, weights=df['sgn_sweights'].to_numpy())
+        edges = hist['edges']
+        ax.hist(edges[:-1], bins=edges, weights=get_density(hist, 'sumw')[0], alpha=0.5, color='r', label='Signal')
+        ax.hist(edges[:-1], bins=edges, weights=get_density(hist, 'entries')[0], alpha=0.1, color='b', label='Data')
+        if var == 'fImpactParameterXY':
             ax.set_yscale('log')
-            # set x range
             ax.set_xlim(-1, 1)
-        else:
-            print(f"Warning: sPlot weights not found in the dataframe. Plotting data without weights")
-            sns.histplot(df[var], bins=100, kde=True, ax=ax, color='b', label='Data')
+    else:
+        print(f"Warning: sPlot weights not found in the dataframe. Plotting data without weights")
+        import seaborn as sns # pylint: disable=import-outside-toplevel
+        sns.histplot(df[var], bins=nbins, kde=True, ax=ax, color='b', label='Data')
     ax.set_xlabel(var)
     ax.set_ylabel('Counts')
     ax.legend()
     return fig
 
-def fit_mass(df, suffix, pt_min, pt_max, cfg, sub_dir):
-    # Create the data handler
-    data_handler = DataHandler(df, "fM")
-    sgn_func = [cfg["fit_config"]["sgn_func"]] if cfg["fit_config"].get('sgn_func') else ["doublecb"]
-    bkg_func = [cfg["fit_config"]["bkg_func"]] if cfg["fit_config"].get('bkg_func') else ["nobkg"]
-    fitter_name = f"{sub_dir.split('/')[0]}_{suffix}_pt_{pt_min}_{pt_max}"
+def get_pdf_values(fitter, mass, limits, chunk_size):
+    '''
+    Fitted signal and (if any) background pdfs at each candidate mass, normalised over the mass limits
+    and evaluated chunk by chunk. The zfit pdfs are those of a flarefly 0.1 fitter, for binned fits too.
 
-    fitter = F2MassFitter(data_handler, sgn_func, bkg_func, verbosity=0, name=fitter_name)
-    fitter.set_signal_initpar(0, "mu", cfg["fit_config"]["mean"])
-    fitter.set_signal_initpar(0, "sigma", cfg["fit_config"]["sigma"])
-    fit_res = fitter.mass_zfit()
-    sgn_sweights = fitter.get_sweights(sig_par_name=f'{fitter_name}_sgn', bkg_par_name=f'{fitter_name}_bkg')['signal']
-    df.loc[:, 'sgn_sweights'] = sgn_sweights.astype(np.float32)
-    
-    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
-    with open(f"{out_dir_path}/failed_fits.txt", "a") as f:
-        computed_sweights = True if sgn_sweights is not None else False
-        f.write(
-                f"{fitter_name}: fit_res.valid -> {fit_res.valid}, "
-                f"fit_res.status -> {fit_res.status}, "
-                f"fit_res.converged -> {fit_res.converged}, "
-                f"sweights computed -> {computed_sweights} \n"
-               )
-
-    loc = ["lower left", "upper left"]
-    ax_title = '$\mathit{M}$ (K$\pi\pi$) (GeV/$\mathit{c}^{2})$'
-
-    fig, _ = fitter.plot_mass_fit(
-        style="ATLAS",
-        show_extra_info = fitter._name_background_pdf_[0] != "nobkg" and fitter.get_background()[1] != 0,
-        figsize=(8, 8), extra_info_loc=loc,
-        axis_title=ax_title,
-        logy=False
-    )
+    Returns:
+        np.ndarray: pdf values, shape (ncand, ncomp), float32
+    '''
+    pdfs = [fitter._signal_pdfs_[0].pdf]
+    if not fitter.no_background:
+        pdfs.append(fitter._background_pdfs_[0].pdf)
+    pdf_values = np.empty((len(mass), len(pdfs)), dtype=np.float32)
+    for chunk in chunk_slices(len(mass), chunk_size):
+        for ipdf, pdf in enumerate(pdfs):
+            pdf_values[chunk, ipdf] = np.asarray(pdf.pdf(mass[chunk].astype(np.float64), norm=limits)).ravel()
+    return pdf_values
+
+def get_chunked_sweights(fitter, mass, n_fit, limits, chunk_size):
+    '''
+    Signal sWeights of all the candidates from a binned fit or a fit to a subsample of n_fit of them:
+    with the fitted shapes fixed, the yields of the full sample and their sPlot covariance matrix are
+    accumulated over chunks of candidates, and the sWeights are then computed chunk by chunk. The
+    returned yield is the one the sWeights sum to.
+
+    Returns:
+        tuple: (sWeights as float32, signal yield, its uncertainty)
+    '''
+    if fitter.no_background:
+        return np.ones(len(mass), dtype=np.float32), float(len(mass)), float(np.sqrt(len(mass)))
+    pdf_values = get_pdf_values(fitter, mass, limits, chunk_size)
+    sgn_yield = min(fitter.get_raw_yield(0)[0] * len(mass) / n_fit, 0.99 * len(mass))
+    yields = fit_yields(pdf_values, [sgn_yield, len(mass) - sgn_yield], chunk_size)
+    cov = sweights_covariance(pdf_values, yields, chunk_size)
+    return compute_sweights(pdf_values, yields, cov, 0, chunk_size), float(yields[0]), float(np.sqrt(cov[0, 0]))
+
+def get_binned_data_handler(mass, nbins, limits):
+    '''
+    Data handler of the mass histogram of the candidates
+    '''
+    import zfit # pylint: disable=import-outside-toplevel
+    from flarefly.data_handler import DataHandler # pylint: disable=import-outside-toplevel
+    counts, _ = np.histogram(mass, bins=nbins, range=limits)
+    obs = zfit.Space("fM", binning=zfit.binned.RegularBinning(nbins, limits[0], limits[1], name="fM"))
+    binned_data = zfit.data.BinnedData.from_tensor(obs, counts.astype(np.float64), counts.astype(np.float64))
+    return DataHandler(binned_data, "fM", limits=list(limits))
 
+def get_fit_mode(cfg, n_fit):
+    '''
+    Binned or unbinned fit for a number of fitted candidates: fit_config.mode is unbinned (default),
+    binned, or auto (binned from fit_config.binned_min_cand candidates)
+    '''
+    mode = cfg["fit_config"].get('mode', 'unbinned')
+    if mode == 'auto':
+        return 'binned' if n_fit >= cfg["fit_config"].get('binned_min_cand', 100_000) else 'unbinned'
+    return mode
+
+def get_empty_fit_info(init_pars):
+    '''
+    Fit info of a bin without candidates, a failed fit
+    '''
+    return {
+        'valid': False,
+        'status': -1,
+        'converged': False,
+        'sweights': 'none',
+        'n_fit': 0,
+        'mode': 'empty',
+        'seed': init_pars['seed'],
+        'n_eval': 0,
+        'edm': float('nan'),
+        'raw_yield': [0., 0.],
+        'mean': [float('nan'), float('nan')],
+        'sigma': [float('nan'), float('nan')],
+        'significance': [0., 0.]
+    }
+
+def fit_mass(df, suffix, pt_min, pt_max, cfg, sub_dir, init_pars=None):
+    '''
+    Mass fit and signal sWeights of a bin. Above fit_config.max_fit_cand candidates, the fit is done on
+    a random subsample; the fit is binned (fit_config.nbins mass bins) according to get_fit_mode.
+    For binned or subsample fits the sWeights of the candidates are computed in chunks (see get_chunked_sweights).
+    The fit starts from init_pars (see get_init_pars) if given, otherwise from fit_config.mean and sigma.
+    Bins without candidates are not fitted and recorded as failed fits. The fit info records how the
+    sWeights were computed: full (by flarefly), streamed or binned (in chunks, from the shapes of a
+    subsample or binned fit), none (unit weights without background, or no candidates).
+
+    Returns:
+        tuple: (fit record, fit info dict, signal sWeights as float32, image exports)
+    '''
+    timings = {}
+    fitter_name = f"{sub_dir.split('/')[0]}_{suffix}_pt_{pt_min}_{pt_max}"
+    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
     output_dir = os.path.join(out_dir_path, f'{sub_dir}')
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    fig.savefig(
-        os.path.join(
-            output_dir,
-            f'mass_fit_{suffix}.png'
-        ),
-        dpi=300, bbox_inches="tight"
-    )
+    if init_pars is None:
+        init_pars = {'mean': cfg["fit_config"]["mean"], 'sigma': cfg["fit_config"]["sigma"], 'seed': 'config'}
+
+    # empty bins (e.g. no candidate passing the cuts) are recorded as failed fits, without sWeights
+    if len(df) == 0:
+        print(f"Warning: no candidates in {sub_dir}, the mass fit is skipped")
+        fit_info = get_empty_fit_info(init_pars)
+        return get_fit_record(sub_dir, fit_info, timings=timings), fit_info, np.empty(0, dtype=np.float32), []
+
+    # unchanged bins are taken from the fit cache, unless their mass-fit image is missing or outdated:
+    # the fitted shapes are not cached, so the bin is refitted to draw it again
+    cache_dir = cfg.get('cache', {}).get('dir')
+    out_base = os.path.join(output_dir, f'mass_fit_{suffix}')
+    cache_key = get_fit_key(cfg, suffix)
+    if cache_dir is not None:
+        with timed(timings, 'fit_time'):
+            cached_fit = load_fit(cache_dir, cache_key, len(df))
+        if cached_fit is not None and is_exported(out_base, [cache_key, cached_fit[0]], get_export_config(cfg)):
+            fit_info, sgn_sweights = cached_fit
+            return get_fit_record(sub_dir, fit_info, from_cache=True, timings=timings), fit_info, sgn_sweights, []
+        if cached_fit is not None:
+            print(f"Mass-fit image of {sub_dir} missing or outdated, refitting the cached bin")
+
+    # flarefly and zfit (TensorFlow) are only loaded by the bins that are fitted, not taken from the cache
+    from flarefly.data_handler import DataHandler # pylint: disable=import-outside-toplevel
+    from flarefly.fitter import F2MassFitter # pylint: disable=import-outside-toplevel
+    # Create the data handler, on a subsample (with the limits of the full sample) for large bins
+    max_fit_cand = cfg["fit_config"].get('max_fit_cand')
+    chunk_size = cfg["fit_config"].get('chunk_size', 1_000_000)
+    streamed = max_fit_cand is not None and len(df) > max_fit_cand
+    n_fit = max_fit_cand if streamed else len(df)
+    mode = get_fit_mode(cfg, n_fit)
+    mass = df['fM'].to_numpy()
+    limits = (float(mass.min()), float(mass.max()))
+    fit_mass_values = mass[np.sort(np.random.default_rng(42).choice(len(df), n_fit, replace=False, shuffle=False))] \
+        if streamed else mass
+    if mode == 'binned':
+        data_handler = get_binned_data_handler(fit_mass_values, cfg["fit_config"].get('nbins', 200), limits)
+    elif streamed:
+        data_handler = DataHandler(pd.DataFrame({'fM': fit_mass_values}), "fM", limits=list(limits))
+    else:
+        data_handler = DataHandler(df[['fM']], "fM")
+    sgn_func = [cfg["fit_config"]["sgn_func"]] if cfg["fit_config"].get('sgn_func') else ["doublecb"]
+    bkg_func = [cfg["fit_config"]["bkg_func"]] if cfg["fit_config"].get('bkg_func') else ["nobkg"]
+
+    fitter = F2MassFitter(data_handler, sgn_func, bkg_func, verbosity=0, name=fitter_name)
+    fitter.set_signal_initpar(0, "mu", init_pars['mean'])
+    fitter.set_signal_initpar(0, "sigma", init_pars['sigma'])
+    with timed(timings, 'fit_time'):
+        fit_res = fitter.mass_zfit()
+    with timed(timings, 'sweights_time'):
+        # flarefly only computes the sWeights of the fitted candidates of unbinned (not truncated) fits with a
+        # background, the others are computed from the fitted shapes
+        full_sweights = None
+        if not (streamed or mode == 'binned' or fitter.no_background):
+            full_sweights = fitter.get_sweights().get('signal0')
+        if fitter.no_background:
+            sweights_method = 'none'
+        elif full_sweights is None:
+            sweights_method = 'binned' if mode == 'binned' else 'streamed'
+        else:
+            sweights_method = 'full'
+        if full_sweights is None:
+            sgn_sweights, sgn_yield, sgn_yield_unc = get_chunked_sweights(fitter, mass, n_fit, limits, chunk_size)
+            raw_yield = [sgn_yield, sgn_yield_unc]
+            # the significance of the subsample fit scales with the square root of the sample size
+            significance = [float(val) * np.sqrt(len(df) / n_fit) for val in fitter.get_significance(0)]
+        else:
+            sgn_sweights = full_sweights
+            raw_yield = [float(val) for val in fitter.get_raw_yield(0)]
+            significance = [float(val) for val in fitter.get_significance(0)]
+        sgn_sweights = np.asarray(sgn_sweights, dtype=np.float32)
+
+    fit_info = {
+        'valid': bool(fit_res.valid),
+        'status': int(fit_res.status),
+        'converged': bool(fit_res.converged),
+        'sweights': sweights_method,
+        'n_fit': n_fit,
+        'mode': mode,
+        'seed': init_pars['seed'],
+        'n_eval': int(fit_res.info.get('n_eval', -1)),
+        'edm': float(fit_res.edm),
+        'raw_yield': raw_yield,
+        'mean': [float(val) for val in fitter.get_mass(0)],
+        'sigma': [float(val) for val in fitter.get_sigma(0)],
+        'significance': significance
+    }
+    if cache_dir is not None:
+        store_fit(cache_dir, cache_key, fit_info, sgn_sweights)
+
+    # the figure is only drawn if it has to be exported, and saved by the exporter
+    exports = []
+    inputs = [cache_key, fit_info]
+    with timed(timings, 'plot_time'):
+        if needs_export(out_base, inputs, get_export_config(cfg)):
+            loc = ["lower left", "upper left"]
+            ax_title = '$\mathit{M}$ (K$\pi\pi$) (GeV/$\mathit{c}^{2})$'
+
+            fig, _ = fitter.plot_mass_fit(
+                style="ATLAS",
+                show_extra_info = not fitter.no_background and fitter.get_background()[1] != 0,
+                figsize=(8, 8), extra_info_loc=loc,
+                axis_title=ax_title,
+                logy=False
+            )
+            exports.append((out_base, inputs, get_figure, (fig,)))
 
     del fitter
 
-def process(cfg_file_name):
-    # Read the configuration file
-    with open(cfg_file_name, 'r') as cfg_file:
-        cfg = yaml.safe_load(cfg_file)
+    return get_fit_record(sub_dir, fit_info, timings=timings), fit_info, sgn_sweights, exports
+
+def fit_and_store(df_sel, selection, pt_min, pt_max, cfg, out_dir, partition, init_pars=None):
+    '''
+    Mass fit, sWeights, candidates in the results store and plots of a single bin.
+    The sWeights are kept as a separate array, the selected frame is not modified.
+
+    Returns:
+        tuple: (fit record, fit info dict, signal sWeights, image exports) of the bin
+    '''
+    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
+    export_cfg = get_export_config(cfg)
+
+    # fit
+    fit_record, fit_info, sgn_sweights, exports = fit_mass(df_sel, selection, pt_min, pt_max, cfg, out_dir, init_pars)
+    with timed(fit_record, 'write_time'):
+        write_bin(get_store_dir(cfg), df_sel, partition, sgn_sweights, cfg["fit_config"].get('chunk_size', 1_000_000))
+
+    # plot, drawn by the exporter from the needed columns only (nothing to draw for empty bins)
+    with timed(fit_record, 'plot_time'):
+        for var, name in zip(['fPhi', 'fImpactParameterXY'], ['phi_distribution', 'impact_parameter_distribution']):
+            if len(df_sel) == 0:
+                break
+            out_base = os.path.join(out_dir_path, f'{out_dir}/{name}')
+            inputs = [get_fit_key(cfg, selection), fit_info, var, len(df_sel)]
+            if needs_export(out_base, inputs, export_cfg):
+                df_plot = pd.DataFrame({var: df_sel[var].to_numpy(), 'sgn_sweights': sgn_sweights}, copy=False)
+                exports.append((out_base, inputs, plot_distribution, (df_plot, var)))
+
+    fit_record = {**{key: float(value) for key, value in partition.items()}, 'n_cand': len(df_sel), **fit_record}
+    # peak of the process running the bin, including the bins it ran before
+    fit_record['peak_rss_mb'] = get_peak_rss_mb()
+    return fit_record, fit_info, sgn_sweights, exports
+
+def process_bin(df_sel, selection, pt_min, pt_max, cfg, out_dir, partition, init_pars=None):
+    '''
+    Process a bin (see fit_and_store)
+
+    Returns:
+        tuple: (fit record, fit info dict, image exports) of the bin
+    '''
+    fit_record, fit_info, _, exports = fit_and_store(df_sel, selection, pt_min, pt_max, cfg, out_dir, partition, init_pars)
+    return fit_record, fit_info, exports
+
+def process_working_point(df_sel, selection, pt_min, pt_max, cfg, out_dir, partition, init_pars=None, nphibins=16):
+    '''
+    Process a bin of the BDT working-point scan and summarise it
 
+    Returns:
+        tuple: (fit record, dict with signal yield, significance and sigma(d0xy) vs phi, fit info dict, image exports).
+        sigma(d0xy) is given as the RMS and as the half width of the central 68% quantile interval, less
+        sensitive to the tails
+    '''
+    fit_record, fit_info, sgn_sweights, exports = fit_and_store(df_sel, selection, pt_min, pt_max, cfg, out_dir,
+                                                             partition, init_pars)
+
+    # sWeighted RMS of d0xy in the phi bins, within the range of the resolution fits
+    phi_edges = np.linspace(0, 2 * np.pi, nphibins + 1)
+    d0xy = df_sel['fImpactParameterXY'].to_numpy()
+    in_range = np.abs(d0xy) < 0.005
+    phi_idx = variable_bin_index(df_sel['fPhi'].to_numpy()[in_range], phi_edges)
+    rms_d0xy = grouped_moments([d0xy[in_range]], sgn_sweights[in_range], phi_idx, nphibins + 2)['std'][0, 1:-1]
+    # quantiles at -1 and +1 sigma of a Gaussian
+    quantiles_d0xy = weighted_quantiles(d0xy[in_range], [0.158655, 0.841345], sgn_sweights[in_range],
+                                        phi_idx, nphibins + 2)[1:-1]
+    sigma68_d0xy = 0.5 * (quantiles_d0xy[:, 1] - quantiles_d0xy[:, 0])
+
+    summary = {
+        'n_cand': len(df_sel),
+        'valid': fit_info['valid'],
+        'raw_yield': fit_info['raw_yield'][0],
+        'raw_yield_unc': fit_info['raw_yield'][1],
+        'significance': fit_info['significance'][0],
+        'significance_unc': fit_info['significance'][1],
+        'n_eval': fit_info['n_eval']
+    }
+    for iphi, rms in enumerate(rms_d0xy):
+        summary[f'sigma_d0xy_phi_{iphi}'] = rms
+    for iphi, sigma68 in enumerate(sigma68_d0xy):
+        summary[f'sigma68_d0xy_phi_{iphi}'] = sigma68
+    return fit_record, summary, fit_info, exports
+
+def run_and_export(func, export_cfg, args):
+    '''
+    Run func on the arguments of a bin and save its images in the same (worker) process, so that
+    only the results go back to the main process, without figures or candidates
+
+    Returns:
+        tuple: results of func, with no image exports left
+    '''
+    result = func(*args)
+    with timed(result[0], 'export_time'), FigureExporter({**export_cfg, 'jobs': 1}) as exporter:
+        exporter.submit_all(result[-1])
+    return result[:-1] + ([],)
+
+def run_bins(func, bins_args, exporter, jobs=1, on_result=None):
+    '''
+    Run func on the arguments of each bin. With jobs > 1 the bins run in separate processes,
+    each with its own zfit/TensorFlow state (spawned, not forked), otherwise they are consumed
+    one at a time. The image exports returned last by func are handed to the exporter as soon
+    as a bin is done, the other results are passed to on_result (if given) and returned in bin order.
+    With jobs > 1 at most jobs bins are in flight, the arguments of the next ones being generated as
+    the bins finish, and the images are saved by the processes running the bins (see run_and_export).
+    With jobs = 1, on_result is called before the arguments of the next bin are generated.
+    func returns the fit record first, the time spent exporting is added to it.
+    '''
+    def collect(result):
+        with timed(result[0], 'export_time'):
+            exporter.submit_all(result[-1])
+        if on_result is not None:
+            on_result(result[:-1])
+        return result[:-1]
+
+    if jobs <= 1:
+        return [collect(func(*args)) for args in bins_args]
+    results, finished, running = [], {}, {}
+
+    def harvest(return_when):
+        done, _ = wait(running, return_when=return_when)
+        for future in done:
+            finished[running.pop(future)] = future.result()
+        # results are collected in bin order
+        while len(results) in finished:
+            results.append(collect(finished.pop(len(results))))
+
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for ibin, args in enumerate(bins_args):
+            running[executor.submit(run_and_export, func, exporter.export_cfg, args)] = ibin
+            del args
+            if len(running) >= jobs:
+                harvest(FIRST_COMPLETED)
+        harvest(ALL_COMPLETED)
+    return results
+
+def get_seeds_file(cfg):
+    '''
+    File with the converged signal parameters of each (centrality, pT) bin, used to warm start the next runs
+    '''
+    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
+    return cfg['fit_config'].get('seeds_file') or os.path.join(out_dir_path, 'fit_seeds.json')
+
+def get_seed_key(out_dir):
+    '''
+    (Centrality, pT) part of the output sub-directory of a bin, shared by its BDT working points
+    '''
+    return '/'.join(out_dir.split('/')[:2])
+
+def load_seeds(file_name):
+    '''
+    Seeds of a previous run, empty if there are none
+    '''
+    if not os.path.isfile(file_name):
+        return {}
+    with open(file_name, 'r') as file:
+        return json.load(file)
+
+def write_seeds(file_name, seeds):
+    '''
+    Write the seeds atomically (temporary file + rename)
+    '''
+    tmp_file_name = f'{file_name}.tmp'
+    with open(tmp_file_name, 'w') as file:
+        json.dump(seeds, file, indent=1, sort_keys=True)
+    os.replace(tmp_file_name, file_name)
+
+def get_init_pars(cfg, seed_key, seeds, neighbour):
+    '''
+    Initial signal parameters of a bin. With fit_config.warm_start the converged parameters of the
+    same bin in the previous run are used or, if not available, those of the previously fitted
+    neighbouring bin of this run; otherwise fit_config.mean and sigma.
+
+    Returns:
+        dict: mean, sigma and seed (where they come from)
+    '''
+    if cfg['fit_config'].get('warm_start', False):
+        if seed_key in seeds:
+            return {**seeds[seed_key], 'seed': 'previous run'}
+        if neighbour is not None:
+            return {**neighbour, 'seed': 'neighbour'}
+    return {'mean': cfg["fit_config"]["mean"], 'sigma': cfg["fit_config"]["sigma"], 'seed': 'config'}
+
+def get_seed(fit_info):
+    '''
+    Converged signal parameters of a fit, None if the fit failed
+    '''
+    if not fit_info['valid'] or not fit_info['converged']:
+        return None
+    return {'mean': fit_info['mean'][0], 'sigma': fit_info['sigma'][0]}
+
+def run_warm_started_bins(func, bins_args, exporter, cfg, jobs=1):
+    '''
+    Run the bins (see run_bins) seeding each fit as in get_init_pars. bins_args yields
+    (icent, out_dir, args) and func is called with args + (init_pars,); func returns the fit info last.
+    Neighbouring bins are the bins consecutive in pT (or in working point) within a centrality
+    class, and can only be used when the bins run one at a time. With warm start, the converged parameters
+    are saved for the next runs. The number of minimizer calls of this run and of failed fits is printed.
+    '''
+    seeds_file = get_seeds_file(cfg)
+    seeds = load_seeds(seeds_file)
+    neighbours, bin_keys, new_seeds = {}, [], []
+
+    def seeded_args():
+        for icent, out_dir, args in bins_args:
+            seed_key = get_seed_key(out_dir)
+            bin_keys.append((icent, seed_key))
+            # with jobs > 1 the neighbour may or may not be done yet, it is not used for reproducible fits
+            neighbour = neighbours.get(icent) if jobs <= 1 else None
+            yield args + (get_init_pars(cfg, seed_key, seeds, neighbour),)
+
+    def on_result(result):
+        icent, seed_key = bin_keys[len(new_seeds)]
+        seed = get_seed(result[-1])
+        neighbours[icent] = seed
+        new_seeds.append((seed_key, seed))
+
+    results = run_bins(func, seeded_args(), exporter, jobs, on_result)
+    if cfg['fit_config'].get('warm_start', False):
+        for seed_key, seed in new_seeds:
+            if seed is not None:
+                seeds[seed_key] = seed
+        write_seeds(seeds_file, seeds)
+    fit_infos = [result[-1] for result in results]
+    # the fits taken from the cache did not call the minimizer in this run
+    n_eval = sum(max(result[-1]['n_eval'], 0) for result in results if not result[0]['from_cache'])
+    print(f"Minimizer calls: {n_eval}, "
+          f"failed fits: {sum(get_seed(fit_info) is None for fit_info in fit_infos)}/{len(fit_infos)}")
+    return results
+
+def write_run_log(out_dir_path, run_record, fit_records):
+    '''
+    Write the structured fit log of a run (see fit_monitor), with the peak memory of the main
+    process and of the largest bin process of this run
+    '''
+    run_record['total_time'] = run_record['read_time'] + run_record['bins_time']
+    run_record['peak_rss_mb'] = max([get_peak_rss_mb()] + [fit_record['peak_rss_mb'] for fit_record in fit_records
+                                                           if not fit_record['skipped']])
+    write_fit_log(os.path.join(out_dir_path, 'fit_log.jsonl'), fit_records, run_record)
+    print(f"Fit log written to {os.path.join(out_dir_path, 'fit_log.jsonl')}, "
+          f"summarise it with: python fit_monitor.py {os.path.join(out_dir_path, 'fit_log.jsonl')}")
+
+def get_bin_deps(cfg, func, selection, partition):
+    '''
+    Settings the outputs of a bin depend on, recorded in its manifest
+    '''
+    return {
+        'func': func.__name__,
+        'tree': cfg['inputs']['fTreeDmeson'],
+        'selection': selection,
+        'partition': partition,
+        'fit_config': cfg['fit_config'],
+        'export': get_export_config(cfg),
+        'store': os.path.abspath(get_store_dir(cfg)),
+        'version': FIT_INFO_VERSION
+    }
+
+def get_manifests(cfg, func, bin_list, incremental):
+    '''
+    Manifests of the bins (selection, out_dir, partition) that are up to date: same settings, same
+    input file content and candidates still in the store; none if not incremental
+
+    Returns:
+        dict: output sub-directory -> manifest
+    '''
+    if not incremental:
+        return {}
+    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
+    manifests = {}
+    for selection, out_dir, partition in bin_list:
+        manifest = is_up_to_date(os.path.join(out_dir_path, out_dir), get_bin_deps(cfg, func, selection, partition),
+                                 get_input_files(cfg), [get_bin_file(get_store_dir(cfg), partition)])
+        if manifest is not None:
+            manifests[out_dir] = manifest
+    print(f"Up-to-date bins: {len(manifests)}/{len(bin_list)}")
+    return manifests
+
+def merge_results(cfg, func, bin_list, manifests, results):
+    '''
+    Results of all the bins in bin order: those of the recomputed bins, whose manifests are written,
+    and those recorded in the manifests of the up-to-date bins, flagged as skipped in their fit record
+    '''
+    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
+    results = iter(results)
+    merged = []
+    for selection, out_dir, partition in bin_list:
+        if out_dir in manifests:
+            result = manifests[out_dir]['result']
+            result[0]['skipped'] = True
+        else:
+            result = next(results)
+            write_manifest(os.path.join(out_dir_path, out_dir), get_bin_deps(cfg, func, selection, partition),
+                           get_input_files(cfg), result)
+        merged.append(result)
+    return merged
+
+def partition_candidates(df, cent_key, cent_bins, pt_mins, pt_maxs):
+    '''
+    Sort the candidates once by centrality bin and pT and find, for each (centrality, pT) bin,
+    the contiguous range of the sorted DataFrame with cent_min < cent < cent_max and pt_min < fPt < pt_max
+
+    The columns are reordered one at a time, the input frame is modified and no copy of the whole table is made.
+
+    Returns:
+        tuple: (sorted DataFrame, dict (icent, ipt) -> (start, stop))
+    '''
+    pt = df['fPt'].to_numpy()
+    if cent_key is not None:
+        # candidates on the centrality bin edges do not belong to any bin
+        cent = df[cent_key].to_numpy()
+        cent_idx = np.where(np.isin(cent, cent_bins), 0, variable_bin_index(cent, cent_bins))
+        order = np.lexsort((pt, cent_idx))
+        cent_idx = cent_idx[order]
+    else:
+        order = np.argsort(pt, kind='stable')
+    del pt
+    for col in df.columns:
+        df[col] = df[col].to_numpy()[order]
+    df.index = pd.RangeIndex(len(df))
+    pt = df['fPt'].to_numpy()
+
+    bin_ranges = {}
+    for icent in range(len(cent_bins) - 1):
+        if cent_key is not None:
+            cent_start = np.searchsorted(cent_idx, icent + 1, side='left')
+            cent_stop = np.searchsorted(cent_idx, icent + 1, side='right')
+        else:
+            cent_start, cent_stop = 0, len(df)
+        pt_cent = pt[cent_start:cent_stop]
+        for ipt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+            start = cent_start + np.searchsorted(pt_cent, pt_min, side='right')
+            stop = cent_start + np.searchsorted(pt_cent, pt_max, side='left')
+            bin_ranges[(icent, ipt)] = (start, max(start, stop))
+    return df, bin_ranges
+
+def select_bin(df, bkg_max, sig_min, mass_min, mass_max, cut_key=None, cut_min=0, cut_max=1):
+    '''
+    Apply the BDT, mass and optional extra cuts of a bin to the candidates of its (centrality, pT) slice
+    '''
+    mask = (df['fMlScoreBkg'] > 0) & (df['fMlScoreBkg'] < bkg_max) & \
+           (df['fMlScoreNonPrompt'] > sig_min) & (df['fMlScoreNonPrompt'] < 1) & \
+           (df['fM'] > mass_min) & (df['fM'] < mass_max)
+    if cut_key is not None:
+        mask &= (df[cut_key] > cut_min) & (df[cut_key] < cut_max)
+    return df[mask]
+
+def get_selection(cfg, cent_min, cent_max, pt_min, pt_max, mass_min, mass_max, bkg_max, sig_min, cut_min, cut_max):
+    '''
+    Selection string and output sub-directory of a bin
+    '''
+    cent_key = cfg['inputs'].get('cent_key')
+    selection = f'{cent_min} < {cent_key} < {cent_max} and ' if cent_key is not None else ''
+    selection += f'0 < fMlScoreBkg < {bkg_max} and {sig_min} < fMlScoreNonPrompt < 1 and {pt_min} < fPt < {pt_max} and {mass_min} < fM < {mass_max}'
+    if cfg['cuts'].get('key') is not None:
+        selection += f' and {cfg["cuts"]["key"]} > {cut_min} and {cfg["cuts"]["key"]} < {cut_max}'
+    out_dir = f"cent_{cent_min}_{cent_max}/pt_{pt_min:.0f}_{pt_max:.0f}/bkg_0_{bkg_max:.4f}_sig_{sig_min:.4f}_1"
+    return selection, out_dir
+
+def get_bins(cfg):
+    '''
+    Per-pT-bin settings of a configuration: pt_min, pt_max, mass_min, mass_max, bkg_max, sig_min, cut_min, cut_max
+    '''
     pt_mins = cfg["pt_mins"]
     pt_maxs = cfg["pt_maxs"]
     mass_mins = cfg["mass_mins"] if cfg.get('mass_mins') else [-9999 for i in range(len(pt_mins))]
     mass_maxs = cfg["mass_maxs"] if cfg.get('mass_maxs') else [+9999 for i in range(len(pt_mins))]
-    cent_bins = cfg["cent_bins"]
-    bdt_bkg_bins = cfg["bdt_bkg_bins"]
-    bdt_sgn_bins = cfg["bdt_sgn_bins"]
-    # if cfg["fit_config"].get("sgn_func") is None:
     if cfg['cuts'].get('key') is not None:
         cuts_mins = cfg['cuts']['bins_min']
         cuts_maxs = cfg['cuts']['bins_max']
     else:
         cuts_mins = [0 for _ in range(len(pt_mins))]
         cuts_maxs = [1 for _ in range(len(pt_mins))]
+    return list(zip(pt_mins, pt_maxs, mass_mins, mass_maxs, cfg["bdt_bkg_bins"], cfg["bdt_sgn_bins"], cuts_mins, cuts_maxs))
+
+def process(cfg_file_name, jobs=1, incremental=False):
+    # Read the configuration file
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
 
-    # Read the input data
-    data_df = up.open(cfg["inputs"]["data"])[cfg["inputs"]["fTreeDmeson"]].arrays(library="pd")
-    print(f"Data file opened: {data_df.keys()}")
+    cent_bins = cfg["cent_bins"]
+    bins = get_bins(cfg)
 
-    # Create the file and write the first line
     out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
     if not os.path.exists(out_dir_path):
         os.makedirs(out_dir_path)
-    with open(f"{out_dir_path}/failed_fits.txt", "w") as file:
-        file.write("Failed fit configurations\n")
-
-    for _, (cent_min, cent_max) in enumerate(zip(cent_bins[:-1], cent_bins[1:])):
-        #selection = f'{cent_min} < fCentralityFT0C < {cent_max} and '
-        selection = ''
-        
-        for _, (pt_min, pt_max, mass_min, mass_max, bkg_max, sig_min, cut_min, cut_max) in enumerate(zip(pt_mins,
-                                                                                                         pt_maxs,
-                                                                                                         mass_mins,
-                                                                                                         mass_maxs,
-                                                                                                         bdt_bkg_bins,
-                                                                                                         bdt_sgn_bins,
-                                                                                                         cuts_mins,
-                                                                                                         cuts_maxs)):
-            selection += f'0 < fMlScoreBkg < {bkg_max} and {sig_min} < fMlScoreNonPrompt < 1 and {pt_min} < fPt < {pt_max} and {mass_min} < fM < {mass_max}'
-            if cfg['cuts'].get('key') is not None:
-                selection += f' and {cfg["cuts"]["key"]} > {cut_min} and {cfg["cuts"]["key"]} < {cut_max}'
-            print(f"Selection: {selection}")
-            out_dir = f"cent_{cent_min}_{cent_max}/pt_{pt_min:.0f}_{pt_max:.0f}/bkg_0_{bkg_max:.4f}_sig_{sig_min:.4f}_1"
-
-            # apply selection
-            df_sel = data_df.query(selection, inplace=False)
-            
-            # fit
-            fit_mass(df_sel, selection, pt_min, pt_max, cfg, out_dir)
-            df_sel.to_parquet(os.path.join(out_dir_path, f'{out_dir}/df_sel.parquet'), engine='pyarrow', index=False)
-
-            # plot
-            plot_distribution(df_sel, 'fPhi').savefig(
-                os.path.join(out_dir_path, f'{out_dir}/phi_distribution.png')
-            )
-            plot_distribution(df_sel, 'fImpactParameterXY').savefig(
-                os.path.join(out_dir_path, f'{out_dir}/impact_parameter_distribution.png')
-            )
-            selection = ''
+
+    # bins of the configuration, the up-to-date ones are skipped in incremental mode
+    bin_list = []
+    for icent, (cent_min, cent_max) in enumerate(zip(cent_bins[:-1], cent_bins[1:])):
+        for ipt, (pt_min, pt_max, mass_min, mass_max, bkg_max, sig_min, cut_min, cut_max) in enumerate(bins):
+            selection, out_dir = get_selection(cfg, cent_min, cent_max, pt_min, pt_max, mass_min, mass_max,
+                                               bkg_max, sig_min, cut_min, cut_max)
+            partition = get_partition(cent_min, cent_max, pt_min, pt_max, bkg_max, sig_min)
+            bin_list.append((selection, out_dir, partition))
+    manifests = get_manifests(cfg, process_bin, bin_list, incremental)
+
+    # Read the input data, only if some bins have to be recomputed
+    run_record = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': os.path.abspath(cfg_file_name),
+                  'jobs': jobs, 'read_time': 0.}
+    if len(manifests) < len(bin_list):
+        with peak_rss(run_record, 'read_peak_rss_mb'), timed(run_record, 'read_time'):
+            data_df = read_candidates(cfg)
+            print(f"Data file opened: {data_df.keys()}")
+            cent_key = cfg['inputs'].get('cent_key')
+            data_df, bin_ranges = partition_candidates(data_df, cent_key, cent_bins, cfg["pt_mins"], cfg["pt_maxs"])
+
+    select_times = []
+    def bins_args():
+        for icent in range(len(cent_bins) - 1):
+            for ipt, (pt_min, pt_max, mass_min, mass_max, bkg_max, sig_min, cut_min, cut_max) in enumerate(bins):
+                selection, out_dir, partition = bin_list[icent * len(bins) + ipt]
+                if out_dir in manifests:
+                    continue
+                print(f"Selection: {selection}")
+
+                # apply selection on the (centrality, pT) slice
+                select_times.append({})
+                with timed(select_times[-1], 'select_time'):
+                    start, stop = bin_ranges[(icent, ipt)]
+                    df_sel = select_bin(data_df.iloc[start:stop], bkg_max, sig_min, mass_min, mass_max,
+                                        cfg['cuts'].get('key'), cut_min, cut_max)
+                yield icent, out_dir, (df_sel, selection, pt_min, pt_max, cfg, out_dir, partition)
+
+    with timed(run_record, 'bins_time'):
+        with FigureExporter(get_export_config(cfg)) as exporter:
+            results = run_warm_started_bins(process_bin, bins_args(), exporter, cfg, jobs)
+    for (fit_record, _), select_time in zip(results, select_times):
+        fit_record.update(select_time)
+    results = merge_results(cfg, process_bin, bin_list, manifests, results)
+    write_run_log(out_dir_path, run_record, [fit_record for fit_record, _ in results])
+    if cfg.get('cache', {}).get('dir') is not None:
+        evict(cfg['cache']['dir'], cfg['cache'].get('max_size_mb', 2000))
+
+def process_scan(cfg_file_name, jobs=1, incremental=False):
+    '''
+    Scan of the BDT working points given, for each pT bin, as lists of thresholds in the scan block
+    of the configuration. The data are read and preselected once with the loosest working point, and
+    in each pT bin the candidates are ordered by background score so that each tighter cut is a prefix.
+    '''
+    with open(cfg_file_name, 'r') as cfg_file:
+        cfg = yaml.safe_load(cfg_file)
+
+    scan_bkg_bins = cfg['scan']['bdt_bkg_bins']
+    scan_sgn_bins = cfg['scan']['bdt_sgn_bins']
+    cfg['bdt_bkg_bins'] = [max(bkg_maxs) for bkg_maxs in scan_bkg_bins]
+    cfg['bdt_sgn_bins'] = [min(sig_mins) for sig_mins in scan_sgn_bins]
+    cent_bins = cfg["cent_bins"]
+    bins = get_bins(cfg)
+
+    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
+    if not os.path.exists(out_dir_path):
+        os.makedirs(out_dir_path)
+
+    # working points of the scan, the up-to-date ones are skipped in incremental mode
+    working_points, bin_list = [], []
+    for cent_min, cent_max in zip(cent_bins[:-1], cent_bins[1:]):
+        for ipt, (pt_min, pt_max, mass_min, mass_max, _, _, cut_min, cut_max) in enumerate(bins):
+            for bkg_max in sorted(scan_bkg_bins[ipt]):
+                for sig_min in sorted(scan_sgn_bins[ipt]):
+                    selection, out_dir = get_selection(cfg, cent_min, cent_max, pt_min, pt_max, mass_min, mass_max,
+                                                       bkg_max, sig_min, cut_min, cut_max)
+                    working_points.append({'cent_min': cent_min, 'cent_max': cent_max,
+                                           'pt_min': pt_min, 'pt_max': pt_max,
+                                           'bkg_max': bkg_max, 'sig_min': sig_min})
+                    partition = get_partition(cent_min, cent_max, pt_min, pt_max, bkg_max, sig_min)
+                    bin_list.append((selection, out_dir, partition))
+    manifests = get_manifests(cfg, process_working_point, bin_list, incremental)
+
+    run_record = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': os.path.abspath(cfg_file_name),
+                  'jobs': jobs, 'read_time': 0.}
+    if len(manifests) < len(bin_list):
+        with peak_rss(run_record, 'read_peak_rss_mb'), timed(run_record, 'read_time'):
+            data_df = read_candidates(cfg)
+            print(f"Data file opened: {data_df.keys()}")
+            cent_key = cfg['inputs'].get('cent_key')
+            data_df, bin_ranges = partition_candidates(data_df, cent_key, cent_bins, cfg["pt_mins"], cfg["pt_maxs"])
+
+    select_times = []
+    def bins_args():
+        ibin = 0
+        for icent in range(len(cent_bins) - 1):
+            for ipt, (pt_min, pt_max, mass_min, mass_max, _, _, cut_min, cut_max) in enumerate(bins):
+                n_wps = len(scan_bkg_bins[ipt]) * len(scan_sgn_bins[ipt])
+                wp_bins = bin_list[ibin:ibin + n_wps]
+                ibin += n_wps
+                if all(out_dir in manifests for _, out_dir, _ in wp_bins):
+                    continue
+                # the ordering of the pT slice is shared by its working points and not included in their select time
+                start, stop = bin_ranges[(icent, ipt)]
+                df_pt = data_df.iloc[start:stop]
+                df_pt = df_pt.iloc[np.argsort(df_pt['fMlScoreBkg'].to_numpy(), kind='stable')]
+                bkg_scores = df_pt['fMlScoreBkg'].to_numpy()
+                first = np.searchsorted(bkg_scores, 0, side='right')
+                wp_bins = iter(wp_bins)
+                for bkg_max in sorted(scan_bkg_bins[ipt]):
+                    last = max(first, np.searchsorted(bkg_scores, bkg_max, side='left'))
+                    for sig_min in sorted(scan_sgn_bins[ipt]):
+                        selection, out_dir, partition = next(wp_bins)
+                        if out_dir in manifests:
+                            continue
+                        print(f"Selection: {selection}")
+                        select_times.append({})
+                        with timed(select_times[-1], 'select_time'):
+                            df_sel = select_bin(df_pt.iloc[first:last], bkg_max, sig_min, mass_min, mass_max,
+                                                cfg['cuts'].get('key'), cut_min, cut_max)
+                        yield icent, out_dir, (df_sel, selection, pt_min, pt_max, cfg, out_dir, partition)
+
+    with timed(run_record, 'bins_time'):
+        with FigureExporter(get_export_config(cfg)) as exporter:
+            results = run_warm_started_bins(process_working_point, bins_args(), exporter, cfg, jobs)
+    for (fit_record, _, _), select_time in zip(results, select_times):
+        fit_record.update(select_time)
+    results = merge_results(cfg, process_working_point, bin_list, manifests, results)
+    write_run_log(out_dir_path, run_record, [fit_record for fit_record, _, _ in results])
+    summary = pd.DataFrame([{**working_point, **wp_summary}
+                            for working_point, (_, wp_summary, _) in zip(working_points, results)])
+    summary.to_csv(os.path.join(out_dir_path, 'bdt_scan_summary.csv'), index=False)
+    print(summary[['cent_min', 'cent_max', 'pt_min', 'pt_max', 'bkg_max', 'sig_min',
+                   'raw_yield', 'significance']].to_string(index=False))
+    if cfg.get('cache', {}).get('dir') is not None:
+        evict(cfg['cache']['dir'], cfg['cache'].get('max_size_mb', 2000))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Draw distributions')
     parser.add_argument('config_file', help='Path to the input configuration file')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of bins fitted in parallel')
+    parser.add_argument('--scan', action='store_true', help='Scan the BDT working points of the scan block of the configuration')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only recompute the bins whose inputs or settings changed since the last run')
     args = parser.parse_args()
 
-    process(args.config_file)
+    if args.scan:
+        process_scan(args.config_file, args.jobs, args.incremental)
+    else:
+        process(args.config_file, args.jobs, args.incremental)
@@ -0,0 +1,172 @@
+'''
+Weighted statistics of the candidates, for the plots and the resolution summaries: moments (mean,
+variance, effective entries), quantiles and histograms with sum-of-weights-squared errors, for
+several variables and several groups (e.g. phi slices or bins) in one pass over the entries, and the
+chi2 and Kolmogorov-Smirnov compatibility of two histograms.
+Weights can be negative (sWeights); the histograms follow the ROOT layout of hist_utils.
+'''
+import numpy as np
+
+from hist_utils import uniform_bin_index, stacked_histogram
+
+def get_moments(sumw, sumwx, sumwx2):
+    '''
+    Mean and variance from the weighted sums, NaN where the sum of weights is zero
+
+    Returns:
+        tuple: (mean, variance) arrays
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.asarray(sumwx) / sumw
+        var = np.maximum(np.asarray(sumwx2) / sumw - mean**2, 0)
+    return mean, var
+
+def grouped_moments(values, weights=None, groups=None, n_groups=1):
+    '''
+    Weighted moments of several variables in several groups, in one bincount per sum
+
+    Args:
+        values (dict or np.ndarray): variable name -> array, or array of shape (n_vars, n_entries)
+        weights (np.ndarray): per-entry weights, 1 if None
+        groups (np.ndarray): group index of each entry in [0, n_groups), a single group if None
+        n_groups (int): number of groups
+
+    Returns:
+        dict: sumw, sumw2, neff (effective entries) of shape (n_groups,) and sumwx, sumwx2, mean,
+        var, std of shape (n_vars, n_groups)
+    '''
+    values = np.stack([np.asarray(val, dtype=np.float64) for val in
+                       (values.values() if isinstance(values, dict) else values)])
+    n_vars, n_entries = values.shape
+    weights = np.ones(n_entries) if weights is None else np.asarray(weights, dtype=np.float64)
+    groups = np.zeros(n_entries, dtype=np.int64) if groups is None else np.asarray(groups)
+    sumw = np.bincount(groups, weights=weights, minlength=n_groups)
+    sumw2 = np.bincount(groups, weights=weights * weights, minlength=n_groups)
+    # one flat (variable, group) index for all the variables
+    flat_idx = (np.arange(n_vars)[:, None] * n_groups + groups).ravel()
+    weighted = weights * values
+    sumwx = np.bincount(flat_idx, weights=weighted.ravel(), minlength=n_vars * n_groups).reshape(n_vars, n_groups)
+    sumwx2 = np.bincount(flat_idx, weights=(weighted * values).ravel(),
+                         minlength=n_vars * n_groups).reshape(n_vars, n_groups)
+    mean, var = get_moments(sumw, sumwx, sumwx2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        neff = sumw**2 / sumw2
+    return {'sumw': sumw, 'sumw2': sumw2, 'neff': neff, 'sumwx': sumwx, 'sumwx2': sumwx2,
+            'mean': mean, 'var': var, 'std': np.sqrt(var)}
+
+def weighted_quantiles(values, quantiles, weights=None, groups=None, n_groups=1):
+    '''
+    Weighted quantiles of a variable in several groups: the smallest value at which the cumulative
+    weight of the group reaches the quantile (with negative weights, the first crossing)
+
+    Returns:
+        np.ndarray: array of shape (n_groups, n_quantiles), NaN for the groups with no positive weight
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype=np.float64))
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+    groups = np.zeros(len(values), dtype=np.int64) if groups is None else np.asarray(groups)
+    order = np.lexsort((values, groups))
+    values, weights, groups = values[order], weights[order], groups[order]
+    starts = np.searchsorted(groups, np.arange(n_groups), side='left')
+    stops = np.searchsorted(groups, np.arange(n_groups), side='right')
+    sumw = np.bincount(groups, weights=weights, minlength=n_groups)
+    # cumulative weight fraction within each group, made non-decreasing and shifted by group so
+    # that all the groups are searched at once in a single sorted array
+    cum_weights = np.cumsum(weights)
+    offsets = np.concatenate([[0.], cum_weights])[starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf = (cum_weights - offsets[groups]) / sumw[groups]
+    cdf = np.nan_to_num(cdf, nan=0., posinf=0., neginf=0.)
+    shift = np.abs(cdf).max(initial=0.) * 2 + 2
+    cdf = np.maximum.accumulate(cdf + groups * shift)
+    targets = np.arange(n_groups)[:, None] * shift + quantiles[None, :]
+    idx = np.searchsorted(cdf, targets - 1.e-12, side='left')
+    valid = (sumw[:, None] > 0) & (idx < stops[:, None]) & (stops > starts)[:, None]
+    return np.where(valid, values[np.minimum(idx, len(values) - 1)] if len(values) else np.nan, np.nan)
+
+def histogram(values, nbins, xmin, xmax, weights=None, groups=None, n_groups=1):
+    '''
+    Unweighted and weighted histograms of a variable, filled together (one histogram per group if
+    groups are given), with flow bins in the ROOT layout
+
+    Returns:
+        dict: edges, entries, sumw and sumw2 arrays of nbins+2 bins (or (n_groups, nbins+2) with groups)
+    '''
+    idx = uniform_bin_index(values, nbins, xmin, xmax)
+    outer_idx = np.zeros(len(idx), dtype=np.int64) if groups is None else np.asarray(groups)
+    n_outer = 1 if groups is None else n_groups
+    weights = np.ones(len(idx)) if weights is None else weights
+    # groups are stored as the regular bins 1..n_outer of the outer axis of the stack
+    flat_idx = (outer_idx + 1) * (nbins + 2) + idx
+    entries = np.bincount(flat_idx, minlength=(n_outer + 2) * (nbins + 2)).reshape(n_outer + 2, nbins + 2)[1:-1]
+    sumw, sumw2 = (hist[1:-1] for hist in stacked_histogram(outer_idx + 1, idx, n_outer, nbins, weights))
+    hist = {'edges': np.linspace(xmin, xmax, nbins + 1), 'entries': entries, 'sumw': sumw, 'sumw2': sumw2}
+    if groups is None:
+        hist.update({key: hist[key][0] for key in ['entries', 'sumw', 'sumw2']})
+    return hist
+
+def add_histograms(hists):
+    '''
+    Sum of histograms with the same binning
+    '''
+    if any(not np.array_equal(hist['edges'], hists[0]['edges']) for hist in hists):
+        raise ValueError('Only histograms with the same binning can be added')
+    return {'edges': hists[0]['edges'], **{key: sum(hist[key] for hist in hists) for key in ['entries', 'sumw', 'sumw2']}}
+
+def fill_histogram(batches, column, nbins, xmin, xmax, weight_column=None):
+    '''
+    Histogram of a column filled batch by batch (dicts of arrays, e.g. store_utils.iter_bins),
+    weighted by weight_column if given
+
+    Returns:
+        dict: edges, entries, sumw and sumw2 arrays as histogram
+    '''
+    hist = histogram(np.zeros(0), nbins, xmin, xmax)
+    for batch in batches:
+        weights = None if weight_column is None else np.asarray(batch[weight_column], dtype=np.float64)
+        hist = add_histograms([hist, histogram(batch[column], nbins, xmin, xmax, weights=weights)])
+    return hist
+
+def get_density(hist, key='sumw'):
+    '''
+    Probability density of the regular bins of a histogram (key sumw or entries) and its error
+
+    Returns:
+        tuple: (density, error) arrays
+    '''
+    counts = np.asarray(hist[key], dtype=np.float64)[..., 1:-1]
+    counts2 = counts if key == 'entries' else np.asarray(hist['sumw2'], dtype=np.float64)[..., 1:-1]
+    norm = counts.sum(axis=-1, keepdims=True) * np.diff(hist['edges'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return counts / norm, np.sqrt(counts2) / norm
+
+def compare_histograms(hist1, hist2, key1='sumw', key2='sumw'):
+    '''
+    Shape compatibility of two histograms with the same binning (key sumw or entries of each), on the
+    regular bins: chi2 of the difference of the normalised contents with the sum-of-weights-squared
+    errors, and Kolmogorov-Smirnov distance of the binned CDFs with the effective entries of each
+
+    Returns:
+        dict: chi2, ndf, chi2_prob, ks_distance, ks_prob (NaN if a histogram is empty)
+    '''
+    from scipy.special import chdtrc, kolmogorov # pylint: disable=import-outside-toplevel
+    if not np.array_equal(hist1['edges'], hist2['edges']):
+        raise ValueError('Only histograms with the same binning can be compared')
+    norms, variances, neffs = [], [], []
+    for hist, key in [(hist1, key1), (hist2, key2)]:
+        counts = np.asarray(hist[key], dtype=np.float64)[1:-1]
+        counts2 = counts if key == 'entries' else np.asarray(hist['sumw2'], dtype=np.float64)[1:-1]
+        total = counts.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norms.append(counts / total)
+            variances.append(counts2 / total**2)
+            neffs.append(total**2 / counts2.sum())
+    variance = variances[0] + variances[1]
+    used = variance > 0
+    chi2 = float(np.sum((norms[0][used] - norms[1][used])**2 / variance[used]))
+    ndf = max(int(used.sum()) - 1, 0)
+    ks_distance = float(np.abs(np.cumsum(norms[0]) - np.cumsum(norms[1])).max())
+    n_ks = neffs[0] * neffs[1] / (neffs[0] + neffs[1])
+    return {'chi2': chi2, 'ndf': ndf, 'chi2_prob': float(chdtrc(ndf, chi2)) if ndf > 0 else np.nan,
+            'ks_distance': ks_distance, 'ks_prob': float(kolmogorov(np.sqrt(n_ks) * ks_distance))}
@@ -0,0 +1,147 @@
+'''
+Results store of the selected candidates: a single Parquet dataset, hive-partitioned by
+centrality, pT and BDT working point, written by splot_fit (one file per bin, with the
+sWeights as float32) and read by the downstream steps loading only the bins they need
+'''
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+import pyarrow.parquet as pq
+
+PARTITION_KEYS = ['cent_min', 'cent_max', 'pt_min', 'pt_max', 'bkg_max', 'sig_min']
+PARTITION_FORMATS = {'cent_min': 'g', 'cent_max': 'g', 'pt_min': 'g', 'pt_max': 'g',
+                     'bkg_max': '.4f', 'sig_min': '.4f'}
+
+def get_partitioning():
+    '''
+    Hive partitioning of the store, with the partition values as strings so that selections are exact
+    '''
+    return ds.partitioning(pa.schema([(key, pa.string()) for key in PARTITION_KEYS]), flavor='hive')
+
+def format_partition_value(key, value):
+    '''
+    String value of a partition column, with the same format used to write the store
+    '''
+    return format(float(value), PARTITION_FORMATS[key])
+
+def get_partition(cent_min, cent_max, pt_min, pt_max, bkg_max, sig_min):
+    '''
+    Partition of a bin
+
+    Returns:
+        dict: partition column -> string value
+    '''
+    values = [cent_min, cent_max, pt_min, pt_max, bkg_max, sig_min]
+    return {key: format_partition_value(key, value) for key, value in zip(PARTITION_KEYS, values)}
+
+def get_store_dir(cfg):
+    '''
+    Directory of the store of a configuration, by default in the output directory
+    '''
+    out_dir_path = cfg['output']['dir'] + cfg['output']['suffix']
+    return cfg['output'].get('store') or os.path.join(out_dir_path, 'candidates')
+
+def get_bin_file(store_dir, partition):
+    '''
+    File of the store holding the candidates of a bin
+    '''
+    sub_dir = '/'.join(f'{key}={partition[key]}' for key in PARTITION_KEYS)
+    return os.path.join(store_dir, sub_dir, 'part-0.parquet')
+
+def write_bin(store_dir, df, partition, sgn_sweights=None, chunk_size=1_000_000):
+    '''
+    Write (or replace) the candidates of a bin, chunk by chunk (one row group per chunk) so that
+    no copy of the whole frame is made; the sWeights, if given as a separate array, are appended
+    to each chunk. The file goes through a temporary file and a rename so that parallel writers
+    and readers never see a partial file. The partition columns are only stored in the directory names.
+    '''
+    file_name = get_bin_file(store_dir, partition)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    # hidden name, skipped by the readers of the dataset
+    tmp_file_name = os.path.join(os.path.dirname(file_name), f'.part-0.{os.getpid()}.tmp')
+    writer = None
+    for start in range(0, max(len(df), 1), chunk_size):
+        table = pa.Table.from_pandas(df.iloc[start:start + chunk_size], preserve_index=False)
+        if sgn_sweights is not None:
+            table = table.append_column('sgn_sweights', pa.array(sgn_sweights[start:start + chunk_size], pa.float32()))
+        elif 'sgn_sweights' in table.column_names:
+            idx = table.column_names.index('sgn_sweights')
+            table = table.set_column(idx, 'sgn_sweights', table['sgn_sweights'].cast(pa.float32()))
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_file_name, table.schema, write_statistics=True)
+        writer.write_table(table)
+    writer.close()
+    os.replace(tmp_file_name, file_name)
+
+def get_filters(**selection):
+    '''
+    Parquet filters on the partition columns, each value can be a number or a list of numbers
+    '''
+    filters = []
+    for key, value in selection.items():
+        if key not in PARTITION_KEYS:
+            raise ValueError(f'{key} is not a partition column of the store, use one of {PARTITION_KEYS}')
+        values = value if isinstance(value, (list, tuple, np.ndarray)) else [value]
+        filters.append((key, 'in', [format_partition_value(key, val) for val in values]))
+    return filters or None
+
+def get_dataset(store_dir):
+    '''
+    Dataset of the store, with the files memory mapped
+    '''
+    return ds.dataset(store_dir, format='parquet', partitioning=get_partitioning(),
+                      filesystem=fs.LocalFileSystem(use_mmap=True))
+
+def get_bin_files(store_dir, **selection):
+    '''
+    Files of the bins matching the selection on the partition columns
+    '''
+    filters = get_filters(**selection)
+    expression = pq.filters_to_expression(filters) if filters else None
+    return sorted(fragment.path for fragment in get_dataset(store_dir).get_fragments(filter=expression))
+
+def get_path_partition(file_name, root_dir):
+    '''
+    Partition of a bin file of the store, or of a directory tree with the same layout (e.g. the cubes)
+
+    Returns:
+        dict: partition column -> string value
+    '''
+    sub_dir = os.path.relpath(os.path.dirname(os.path.abspath(file_name)), os.path.abspath(root_dir))
+    return dict(part.split('=', 1) for part in sub_dir.split(os.sep) if '=' in part)
+
+def get_bin_partitions(store_dir, **selection):
+    '''
+    Partitions of the bins of the store matching the selection on the partition columns
+    '''
+    return [get_path_partition(file_name, store_dir) for file_name in get_bin_files(store_dir, **selection)]
+
+def read_bins(store_dir, columns=None, **selection):
+    '''
+    Read the candidates of the bins matching the selection on the partition columns
+    (e.g. pt_min=2, pt_max=3, bkg_max=0.03); the other bins are not opened and the
+    row groups are read from memory-mapped files. The columns keep their stored dtypes (float32)
+
+    Returns:
+        pd.DataFrame: candidates, with the partition columns if columns is None
+    '''
+    filters = get_filters(**selection)
+    expression = pq.filters_to_expression(filters) if filters else None
+    # one block per column, zero-copy where possible, the Arrow buffers being released as they are converted
+    return get_dataset(store_dir).to_table(columns=columns, filter=expression).to_pandas(split_blocks=True,
+                                                                                        self_destruct=True)
+
+def iter_bins(store_dir, columns, batch_size=1_000_000, **selection):
+    '''
+    Record batches of the candidates of the bins matching the selection on the partition columns,
+    to fill histograms without holding the bins in memory
+
+    Returns:
+        iterator: dicts column -> numpy array, one per batch
+    '''
+    filters = get_filters(**selection)
+    expression = pq.filters_to_expression(filters) if filters else None
+    for batch in get_dataset(store_dir).to_batches(columns=columns, filter=expression, batch_size=batch_size):
+        yield {col: array.to_numpy(zero_copy_only=False) for col, array in zip(columns, batch.columns)}
@@ -0,0 +1,7 @@
+'''
+The modules of the repository are imported from its root directory, as the scripts do
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,110 @@
+'''
+Tests of the batched Gaussian fits against scipy and of the chunked sPlot helpers against
+a direct (per-candidate) sPlot on small fixed-seed samples
+'''
+import math
+import numpy as np
+import pytest
+
+from fit_utils import gaus, fit_gaus_batched, chunk_slices, fit_yields, sweights_covariance, compute_sweights
+
+scipy_optimize = pytest.importorskip('scipy.optimize')
+
+def get_histograms(n_slices=4, nbins=60, seed=5):
+    rng = np.random.default_rng(seed)
+    edges = np.linspace(-0.01, 0.01, nbins + 1)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    sumw, sumw2 = [], []
+    for islice in range(n_slices):
+        values = rng.normal(0.0005 * islice, 0.002 + 0.0005 * islice, 2000 + 500 * islice)
+        weights = rng.uniform(0.5, 1.5, len(values))
+        sumw.append(np.histogram(values, edges, weights=weights)[0])
+        sumw2.append(np.histogram(values, edges, weights=weights**2)[0])
+    return centers, np.array(sumw), np.array(sumw2)
+
+def test_gaus():
+    x = np.array([-1., 0., 2.])
+    np.testing.assert_allclose(gaus(x, np.array([2.]), np.array([0.]), np.array([1.]))[0],
+                               2. * np.exp(-0.5 * x**2))
+
+def test_fit_gaus_batched_vs_curve_fit():
+    centers, sumw, sumw2 = get_histograms()
+    fit_min, fit_max = -0.008, 0.008
+    init = np.column_stack([sumw.max(axis=1), np.zeros(len(sumw)), np.full(len(sumw), 0.003)])
+    res = fit_gaus_batched(centers, sumw, sumw2, fit_min, fit_max, init)
+    assert res['converged'].all()
+    in_range = (centers >= fit_min) & (centers <= fit_max)
+    for islice in range(len(sumw)):
+        filled = in_range & (sumw2[islice] > 0)
+        xvals, yvals, errs = centers[filled], sumw[islice, filled], np.sqrt(sumw2[islice, filled])
+        popt, pcov = scipy_optimize.curve_fit(lambda x, norm, mu, sigma: norm * np.exp(-0.5 * ((x - mu) / sigma)**2),
+                                              xvals, yvals, p0=init[islice], sigma=errs, absolute_sigma=True)
+        np.testing.assert_allclose([res['norm'][islice], res['mu'][islice], res['sigma'][islice]], popt,
+                                   rtol=1.e-4, atol=1.e-8)
+        np.testing.assert_allclose([res['norm_err'][islice], res['mu_err'][islice], res['sigma_err'][islice]],
+                                   np.sqrt(np.diag(pcov)), rtol=1.e-3)
+        chi2 = np.sum(((yvals - popt[0] * np.exp(-0.5 * ((xvals - popt[1]) / popt[2])**2)) / errs)**2)
+        np.testing.assert_allclose(res['chi2'][islice], chi2, rtol=1.e-6)
+        assert res['ndf'][islice] == len(xvals) - 3
+
+def test_fit_gaus_batched_unfittable_slice():
+    centers, sumw, sumw2 = get_histograms(n_slices=2)
+    sumw[1], sumw2[1] = 0., 0.
+    sumw[1, 30], sumw2[1, 30] = 5., 5.
+    init = np.column_stack([sumw.max(axis=1), np.zeros(2), np.full(2, 0.003)])
+    res = fit_gaus_batched(centers, sumw, sumw2, -0.008, 0.008, init)
+    assert res['converged'][0] and not res['converged'][1]
+    assert np.isnan(res['mu'][1]) and np.isfinite(res['mu'][0])
+
+def get_pdf_values(n_cand=3000, seed=6):
+    '''
+    Gaussian signal and linear background, normalised in [0, 1], at the candidates of a 30% signal sample
+    '''
+    rng = np.random.default_rng(seed)
+    n_sgn = int(0.3 * n_cand)
+    sgn = rng.normal(0.5, 0.05, 4 * n_sgn)
+    mass = np.concatenate([sgn[(sgn > 0) & (sgn < 1)][:n_sgn], 1. - np.sqrt(rng.uniform(size=n_cand - n_sgn))])
+    sgn_norm = math.erf(0.5 / 0.05 / np.sqrt(2)) # fraction of the Gaussian in [0, 1]
+    sgn_pdf = np.exp(-0.5 * ((mass - 0.5) / 0.05)**2) / (0.05 * np.sqrt(2 * np.pi)) / sgn_norm
+    bkg_pdf = 2. * (1. - mass)
+    return np.column_stack([sgn_pdf, bkg_pdf])
+
+def test_chunk_slices():
+    slices = chunk_slices(10, 4)
+    assert [(chunk.start, chunk.stop) for chunk in slices] == [(0, 4), (4, 8), (8, 10)]
+    assert not chunk_slices(0, 4)
+
+def test_fit_yields_vs_likelihood():
+    pdf_values = get_pdf_values()
+    yields = fit_yields(pdf_values, [1000., 2000.], chunk_size=700, tol=1.e-12, max_iter=5000)
+
+    def nll(pars):
+        return np.sum(pars) - np.sum(np.log(pdf_values @ pars))
+    ref = scipy_optimize.minimize(nll, [1000., 2000.], method='Nelder-Mead',
+                                  options={'xatol': 1.e-6, 'fatol': 1.e-10, 'maxiter': 10000}).x
+    np.testing.assert_allclose(yields, ref, rtol=1.e-4)
+    np.testing.assert_allclose(yields.sum(), len(pdf_values), rtol=1.e-8)
+
+def test_sweights_vs_direct_splot():
+    pdf_values = get_pdf_values()
+    yields = fit_yields(pdf_values, [1000., 2000.], tol=1.e-12, max_iter=5000)
+    cov = sweights_covariance(pdf_values, yields, chunk_size=700)
+
+    # per-candidate loops of the sPlot formulae
+    inv_cov = np.zeros((2, 2))
+    for values in pdf_values:
+        denom = values @ yields
+        for i in range(2):
+            for j in range(2):
+                inv_cov[i, j] += values[i] * values[j] / denom**2
+    ref_cov = np.linalg.inv(inv_cov)
+    np.testing.assert_allclose(cov, ref_cov, rtol=1.e-10)
+    ref_sweights = np.array([(ref_cov[0] @ values) / (values @ yields) for values in pdf_values])
+
+    sweights = compute_sweights(pdf_values, yields, cov, 0, chunk_size=700)
+    assert sweights.dtype == np.float32
+    np.testing.assert_allclose(sweights, ref_sweights, rtol=1.e-5, atol=1.e-6)
+    # the sWeights sum to the fitted yield, and the signal and background sWeights to one per candidate
+    np.testing.assert_allclose(sweights.sum(dtype=np.float64), yields[0], rtol=1.e-5)
+    bkg_sweights = compute_sweights(pdf_values, yields, cov, 1, chunk_size=700)
+    np.testing.assert_allclose(sweights + bkg_sweights, 1., atol=1.e-5)
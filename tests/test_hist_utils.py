@@ -0,0 +1,87 @@
+'''
+Tests of the ROOT-convention histogramming helpers against naive per-entry loops
+'''
+import numpy as np
+
+from hist_utils import uniform_bin_index, variable_bin_index, stacked_histogram, stacked_stats, weighted_stats
+
+def naive_bin_index(value, edges):
+    '''
+    ROOT bin of a value: 0 for the underflow, len(edges) for the overflow (upper edge excluded)
+    '''
+    if value < edges[0]:
+        return 0
+    for ibin in range(len(edges) - 1):
+        if edges[ibin] <= value < edges[ibin + 1]:
+            return ibin + 1
+    return len(edges)
+
+def test_uniform_bin_index_flow_bins():
+    values = np.array([-1.5, -1., -0.999, 0., 0.25, 0.2499, 0.9999, 1., 3.])
+    idx = uniform_bin_index(values, 8, -1., 1.)
+    assert idx.tolist() == [naive_bin_index(value, np.linspace(-1., 1., 9)) for value in values]
+    assert idx[0] == 0 and idx[1] == 1 and idx[-2] == 9 and idx[-1] == 9
+
+def test_uniform_bin_index_random():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(-0.3, 2.3, 2000).astype(np.float32)
+    edges = np.linspace(0., 2., 41)
+    idx = uniform_bin_index(values, 40, 0., 2.)
+    expected = [naive_bin_index(value, edges) for value in values.astype(np.float64)]
+    # the values at (float) edges can differ by rounding, as in TAxis::FindBin
+    assert np.mean(idx == np.array(expected)) > 0.999
+    assert np.all(np.abs(idx - np.array(expected)) <= 1)
+
+def test_variable_bin_index_flow_bins():
+    edges = np.array([0., 1., 2., 5., 10.])
+    values = np.array([-0.1, 0., 0.5, 1., 4.99, 5., 9.9, 10., 25.])
+    idx = variable_bin_index(values, edges)
+    assert idx.tolist() == [naive_bin_index(value, edges) for value in values]
+
+def test_stacked_histogram():
+    rng = np.random.default_rng(2)
+    n_outer, n_inner = 3, 5
+    outer = rng.integers(0, n_outer + 2, 500)
+    inner = rng.integers(0, n_inner + 2, 500)
+    weights = rng.normal(1., 0.5, 500)
+    sumw, sumw2 = stacked_histogram(outer, inner, n_outer, n_inner, weights)
+    ref_w = np.zeros((n_outer + 2, n_inner + 2))
+    ref_w2 = np.zeros((n_outer + 2, n_inner + 2))
+    for iout, iin, weight in zip(outer, inner, weights):
+        ref_w[iout, iin] += weight
+        ref_w2[iout, iin] += weight**2
+    np.testing.assert_allclose(sumw, ref_w, rtol=1.e-12, atol=1.e-12)
+    np.testing.assert_allclose(sumw2, ref_w2, rtol=1.e-12, atol=1.e-12)
+
+    # entries that are bins of a finer histogram carry their own sum of squared weights
+    weights2 = np.abs(weights) * 3.
+    _, sumw2 = stacked_histogram(outer, inner, n_outer, n_inner, weights, weights2)
+    np.testing.assert_allclose(sumw2.sum(), weights2.sum())
+
+def test_stacked_histogram_global_bin_order():
+    # flattened as a TH2 with the inner axis as x: global bin = outer * (n_inner + 2) + inner
+    sumw, _ = stacked_histogram(np.array([2]), np.array([1]), 3, 4, np.array([1.]))
+    assert np.flatnonzero(sumw.ravel()).tolist() == [2 * 6 + 1]
+
+def test_stacked_stats():
+    rng = np.random.default_rng(3)
+    n_outer = 4
+    outer = rng.integers(0, n_outer + 2, 300)
+    weights = rng.normal(1., 0.3, 300)
+    values = rng.normal(0., 2., 300).astype(np.float32)
+    stats = stacked_stats(outer, n_outer, weights, values)
+    assert stats.shape == (n_outer + 2, 4)
+    for iout in range(n_outer + 2):
+        sel = outer == iout
+        np.testing.assert_allclose(stats[iout], weighted_stats(weights[sel], values[sel]), rtol=1.e-10, atol=1.e-10)
+        xvals = values[sel].astype(np.float64)
+        ref = [sum(weights[sel]), sum(weights[sel]**2), sum(weights[sel] * xvals), sum(weights[sel] * xvals**2)]
+        np.testing.assert_allclose(stats[iout], ref, rtol=1.e-10, atol=1.e-10)
+
+def test_weighted_stats_2d():
+    rng = np.random.default_rng(4)
+    weights, xvals, yvals = rng.uniform(0.5, 1.5, 50), rng.normal(size=50), rng.normal(size=50)
+    stats = weighted_stats(weights, xvals, yvals)
+    assert len(stats) == 7
+    np.testing.assert_allclose(stats[4:], [np.sum(weights * yvals), np.sum(weights * yvals**2),
+                                           np.sum(weights * xvals * yvals)])
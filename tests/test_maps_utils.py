@@ -0,0 +1,57 @@
+'''
+Tests of the lookup of the resolution and acceptance maps
+'''
+import numpy as np
+
+from maps_utils import build_maps, save_maps, load_maps, lookup_maps
+
+def get_result(nphibins, sigma, converged):
+    '''
+    Minimal fit_reso result of a bin, with a flat phi acceptance
+    '''
+    return {
+        'phi_edges': np.linspace(0., 2 * np.pi, nphibins + 1),
+        'fit': {'mu': np.full(nphibins, 1.), 'sigma': np.asarray(sigma, dtype=np.float64),
+                'mu_err': np.full(nphibins, 0.1), 'sigma_err': np.full(nphibins, 0.1),
+                'converged': np.asarray(converged)},
+        'dca_sumw': np.full((nphibins + 2, 6), 10.), 'dca_sumw2': np.full((nphibins + 2, 6), 10.)
+    }
+
+def get_maps():
+    selections = [{'cent_min': 0, 'cent_max': 100, 'pt_min': 2, 'pt_max': 4},
+                  {'cent_min': 0, 'cent_max': 100, 'pt_min': 4, 'pt_max': 8}]
+    results = [get_result(4, [1., 2., 3., 4.], [True, True, False, True]),
+               get_result(4, [5., 6., 7., 8.], [True, True, True, True])]
+    return build_maps(results, selections)
+
+def test_build_maps():
+    maps = get_maps()
+    np.testing.assert_array_equal(maps['pt_edges'], [2., 4., 8.])
+    assert maps['sigma'].shape == (4, 2, 1) and maps['converged'].dtype == bool
+    np.testing.assert_allclose(maps['reso'][:, 1, 0], [5., 6., 7., 8.])
+    np.testing.assert_allclose(maps['acceptance'], 1.)
+
+def test_lookup_maps_dtypes(tmp_path):
+    save_maps(str(tmp_path / 'maps.npz'), get_maps())
+    maps = load_maps(str(tmp_path / 'maps.npz'))
+    step = np.pi / 2
+    # centre of the second slice, between the centres of the third and fourth ones, outside of the pT edges
+    phi = np.array([1.5 * step, 3. * step, 3. * step, 1.5 * step])
+    pt = np.array([3., 3., 5., 10.])
+    values = lookup_maps(maps, phi, pt, keys=('sigma', 'converged'))
+    np.testing.assert_array_equal(values['inside'], [True, True, True, False])
+    np.testing.assert_allclose(values['sigma'], [2., 3.5, 7.5, np.nan])
+    # flags stay boolean, hold if they hold in both slices, and are False outside of the maps
+    assert values['converged'].dtype == bool
+    np.testing.assert_array_equal(values['converged'], [True, False, True, False])
+
+    values = lookup_maps(maps, phi + 2 * np.pi, pt, keys=('sigma', 'converged'), interpolate=False)
+    np.testing.assert_allclose(values['sigma'], [2., 4., 8., np.nan])
+    np.testing.assert_array_equal(values['converged'], [True, True, True, False])
+
+def test_lookup_maps_periodic():
+    maps = get_maps()
+    step = np.pi / 2
+    # between the centres of the last and first slices, across 0 = 2pi
+    values = lookup_maps(maps, np.array([-0.25 * step, 0.25 * step]), np.array([3., 3.]), keys=('sigma',))
+    np.testing.assert_allclose(values['sigma'], [2.5 + 0.25 * 3, 2.5 - 0.25 * 3])
@@ -0,0 +1,81 @@
+'''
+Tests of the scheduling of the bins of splot_fit, with a light bin function in place of the fits
+'''
+import os
+import time
+import numpy as np
+import pytest
+
+from export_utils import FigureExporter, get_file_names
+from splot_fit import get_seeds_file, load_seeds, run_bins, run_warm_started_bins
+
+def draw_bin(values):
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+    fig, ax = plt.subplots()
+    ax.hist(values)
+    return fig
+
+def process_fake_bin(ibin, values, out_dir):
+    '''
+    Bin function with the same return convention as process_bin: record first, image exports last
+    '''
+    time.sleep(0.05 * (ibin % 3))
+    out_base = os.path.join(out_dir, f'bin_{ibin}')
+    return {'ibin': ibin, 'pid': os.getpid()}, float(values.mean()), [(out_base, [ibin], draw_bin, (values,))]
+
+def run(tmp_path, jobs, n_bins=7):
+    generated, collected = [], []
+
+    def bins_args():
+        for ibin in range(n_bins):
+            generated.append(ibin)
+            yield ibin, np.full(100, ibin, dtype=np.float64), str(tmp_path)
+
+    def on_result(result):
+        # the arguments of a bin are only generated when a bin in flight is done
+        assert len(generated) - len(collected) <= jobs + 1
+        collected.append(result[0]['ibin'])
+
+    export_cfg = {'formats': ['png'], 'dpi': 20, 'only_if_changed': False, 'jobs': 1}
+    with FigureExporter(export_cfg) as exporter:
+        results = run_bins(process_fake_bin, bins_args(), exporter, jobs, on_result)
+    return results, collected
+
+def test_run_bins_in_place(tmp_path):
+    results, collected = run(tmp_path, 1)
+    assert collected == list(range(7))
+    assert [result[1] for result in results] == list(range(7))
+    assert all(result[0]['pid'] == os.getpid() and result[0]['export_time'] > 0 for result in results)
+    assert all(os.path.isfile(get_file_names(str(tmp_path / f'bin_{ibin}'), ['png'])[0]) for ibin in range(7))
+
+def test_run_bins_bounded_workers(tmp_path):
+    results, collected = run(tmp_path, 2)
+    # results in bin order, whatever the order in which the bins finish
+    assert collected == list(range(7))
+    assert [result[1] for result in results] == list(range(7))
+    # the images are saved by the workers, only the results (no figures) come back
+    assert all(result[0]['pid'] != os.getpid() and result[0]['export_time'] > 0 for result in results)
+    assert all(len(result) == 2 for result in results)
+    assert all(os.path.isfile(get_file_names(str(tmp_path / f'bin_{ibin}'), ['png'])[0]) for ibin in range(7))
+
+def fit_fake_bin(ibin, init_pars):
+    '''
+    Bin function of the warm-started runs: odd bins come from the fit cache, with the minimizer calls of their first fit
+    '''
+    fit_info = {'valid': True, 'converged': True, 'n_eval': 100 + ibin, 'mean': [1.87, 0.001],
+                'sigma': [0.01, 0.001], 'seed': init_pars['seed']}
+    return {'from_cache': ibin % 2 == 1}, fit_info, []
+
+@pytest.mark.parametrize('warm_start', [False, True])
+def test_warm_started_bins(tmp_path, capsys, warm_start):
+    cfg = {'output': {'dir': str(tmp_path), 'suffix': ''},
+           'fit_config': {'mean': 1.86, 'sigma': 0.02, 'warm_start': warm_start}}
+    bins_args = [(0, f'cent_0_10/pt_{ipt}_{ipt + 1}/bkg', (ipt,)) for ipt in range(4)]
+    with FigureExporter({'formats': [], 'dpi': 20, 'only_if_changed': False, 'jobs': 1}) as exporter:
+        results = run_warm_started_bins(fit_fake_bin, bins_args, exporter, cfg)
+    assert [result[1]['seed'] for result in results] == ['config'] + ['neighbour' if warm_start else 'config'] * 3
+    # the seeds are only saved for the warm start of the next runs
+    assert os.path.isfile(get_seeds_file(cfg)) == warm_start
+    if warm_start:
+        assert sorted(load_seeds(get_seeds_file(cfg))) == [f'cent_0_10/pt_{ipt}_{ipt + 1}' for ipt in range(4)]
+    assert 'Minimizer calls: 202,' in capsys.readouterr().out
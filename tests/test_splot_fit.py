@@ -0,0 +1,159 @@
+'''
+Tests of the mass fits and sWeights of splot_fit with flarefly 0.1 (skipped if flarefly is not installed),
+on a fixed-seed sample of a Gaussian peak over an exponential background
+'''
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('flarefly')
+import matplotlib.pyplot as plt # pylint: disable=wrong-import-position
+
+from splot_fit import fit_mass, get_chunked_sweights, get_pdf_values, process_working_point # pylint: disable=wrong-import-position
+from store_utils import get_partition # pylint: disable=wrong-import-position
+from export_utils import FigureExporter, get_export_config # pylint: disable=wrong-import-position
+
+def get_mass(n_cand=10000, sgn_frac=0.25, seed=1, permute=True):
+    '''
+    Candidate masses in [1.72, 2.02], the signal first if not permuted
+    '''
+    rng = np.random.default_rng(seed)
+    sgn = rng.normal(1.87, 0.01, int(n_cand * sgn_frac))
+    bkg = 1.72 + rng.exponential(0.3, 4 * n_cand)
+    bkg = bkg[bkg < 2.02][:n_cand - len(sgn)]
+    mass = np.concatenate([sgn, bkg])
+    return rng.permutation(mass) if permute else mass
+
+def get_fitter(mass, limits):
+    from flarefly.data_handler import DataHandler # pylint: disable=import-outside-toplevel
+    from flarefly.fitter import F2MassFitter # pylint: disable=import-outside-toplevel
+    fitter = F2MassFitter(DataHandler(pd.DataFrame({'fM': mass}), 'fM', limits=list(limits)),
+                          ['gaussian'], ['expo'], verbosity=0, name='test_splot_fit')
+    fitter.set_signal_initpar(0, 'mu', 1.87)
+    fitter.set_signal_initpar(0, 'sigma', 0.012)
+    assert fitter.mass_zfit().valid
+    return fitter
+
+def get_cfg(tmp_path, **fit_config):
+    input_file = tmp_path / 'input.parquet'
+    input_file.write_bytes(b'')
+    return {
+        'inputs': {'data': str(input_file), 'fTreeDmeson': 'O2hfcanddplite'},
+        'output': {'dir': str(tmp_path / 'out'), 'suffix': '', 'export': {'formats': []}},
+        'fit_config': {'sgn_func': 'gaussian', 'bkg_func': 'expo', 'mean': 1.87, 'sigma': 0.012, **fit_config}
+    }
+
+@pytest.fixture(scope='module')
+def fitted():
+    mass = get_mass()
+    limits = (float(mass.min()), float(mass.max()))
+    return mass, limits, get_fitter(mass, limits)
+
+def test_pdf_values_normalised(fitted):
+    _, limits, fitter = fitted
+    grid = np.linspace(limits[0], limits[1], 20001)
+    pdf_values = get_pdf_values(fitter, grid, limits, chunk_size=7000)
+    assert pdf_values.shape == (len(grid), 2) and pdf_values.dtype == np.float32
+    np.testing.assert_allclose(np.trapz(pdf_values, grid, axis=0), [1., 1.], rtol=1.e-3)
+    # the signal peaks at the fitted mean, the background falls with the mass
+    assert abs(grid[np.argmax(pdf_values[:, 0])] - fitter.get_mass(0)[0]) < 1.e-3
+    assert pdf_values[0, 1] > pdf_values[-1, 1]
+
+def test_chunked_sweights_match_flarefly(fitted):
+    mass, limits, fitter = fitted
+    sweights, sgn_yield, sgn_yield_unc = get_chunked_sweights(fitter, mass, len(mass), limits, chunk_size=3000)
+    assert sweights.dtype == np.float32 and len(sweights) == len(mass)
+    np.testing.assert_allclose(sweights.sum(), sgn_yield, rtol=1.e-4)
+    np.testing.assert_allclose(sgn_yield, fitter.get_raw_yield(0)[0], rtol=1.e-3)
+    np.testing.assert_allclose(sgn_yield_unc, fitter.get_raw_yield(0)[1], rtol=0.05)
+    np.testing.assert_allclose(sweights, np.asarray(fitter.get_sweights()['signal0']), atol=2.e-3)
+
+@pytest.mark.parametrize('fit_config', [{}, {'max_fit_cand': 4000}])
+def test_fit_mass(tmp_path, fit_config):
+    mass = get_mass()
+    cfg = get_cfg(tmp_path, **fit_config)
+    record, fit_info, sweights, exports = fit_mass(pd.DataFrame({'fM': mass}), 'sel', 2, 4, cfg, 'cent_0_10/pt_2_4')
+    assert fit_info['valid'] and fit_info['converged'] and record['valid']
+    assert fit_info['n_fit'] == min(len(mass), fit_config.get('max_fit_cand', len(mass)))
+    assert fit_info['sweights'] == ('streamed' if fit_config else 'full') and record['sweights'] == fit_info['sweights']
+    assert sweights.dtype == np.float32 and len(sweights) == len(mass)
+    np.testing.assert_allclose(sweights.sum(), fit_info['raw_yield'][0], rtol=1.e-3)
+    np.testing.assert_allclose(fit_info['raw_yield'][0], 2500, rtol=0.1)
+    np.testing.assert_allclose(fit_info['mean'][0], 1.87, atol=1.e-3)
+    # the mass-fit figure is drawn with the fitter and handed over to the exporter
+    assert [os.path.basename(export[0]) for export in exports] == ['mass_fit_sel']
+    plt.close(exports[0][2](*exports[0][3]))
+
+def test_binned_fit_mass(tmp_path):
+    mass = get_mass(40000)
+    limits = (float(mass.min()), float(mass.max()))
+    df = pd.DataFrame({'fM': mass})
+    _, fit_info, sweights, _ = fit_mass(df, 'sel', 2, 4, get_cfg(tmp_path, mode='binned', nbins=150),
+                                        'cent_0_10/pt_2_4')
+    assert fit_info['mode'] == fit_info['sweights'] == 'binned' and fit_info['valid'] and fit_info['converged']
+    assert fit_info['n_fit'] == len(mass) and len(sweights) == len(mass)
+    np.testing.assert_allclose(sweights.sum(), fit_info['raw_yield'][0], rtol=1.e-3)
+    # same yield, shapes and sWeights as the unbinned fit, within the binning effects
+    fitter = get_fitter(mass, limits)
+    np.testing.assert_allclose(fit_info['raw_yield'][0], fitter.get_raw_yield(0)[0], rtol=0.02)
+    np.testing.assert_allclose(fit_info['sigma'][0], fitter.get_sigma(0)[0], rtol=0.02)
+    np.testing.assert_allclose(sweights, np.asarray(fitter.get_sweights()['signal0']), atol=0.03)
+
+def test_empty_bin(tmp_path):
+    cfg = get_cfg(tmp_path)
+    df = pd.DataFrame({col: np.empty(0, dtype=np.float32) for col in ['fM', 'fPhi', 'fImpactParameterXY']})
+    record, fit_info, sweights, exports = fit_mass(df, 'sel', 24, 36, cfg, 'cent_0_20/pt_24_36')
+    assert not record['valid'] and not fit_info['converged'] and fit_info['n_fit'] == 0
+    assert len(sweights) == 0 and fit_info['sweights'] == 'none' and not exports
+
+    # the bin is stored and summarised without aborting the run
+    record, summary, _, exports = process_working_point(df, 'sel', 24, 36, cfg, 'cent_0_20/pt_24_36/wp',
+                                                        get_partition(0, 20, 24, 36, 0.1, 0.5))
+    assert record['n_cand'] == 0 and not summary['valid'] and summary['raw_yield'] == 0
+    assert np.isnan(summary['sigma68_d0xy_phi_0'])
+    assert not exports
+
+def test_cache_hit_regenerates_missing_image(tmp_path):
+    mass = get_mass(5000)
+    df = pd.DataFrame({'fM': mass})
+    cfg = get_cfg(tmp_path)
+    cfg['output']['export'] = {'formats': ['png'], 'dpi': 20}
+    cfg['cache'] = {'dir': str(tmp_path / 'cache')}
+
+    def run():
+        record, fit_info, sweights, exports = fit_mass(df, 'sel', 2, 4, cfg, 'cent_0_10/pt_2_4')
+        with FigureExporter(get_export_config(cfg)) as exporter:
+            exporter.submit_all(exports)
+        return record, fit_info, sweights
+
+    record, fit_info, sweights = run()
+    image = tmp_path / 'out' / 'cent_0_10' / 'pt_2_4' / 'mass_fit_sel.png'
+    assert not record['from_cache'] and image.is_file()
+    record, cached_info, cached_sweights = run()
+    assert record['from_cache'] and cached_info == fit_info
+    np.testing.assert_array_equal(cached_sweights, sweights)
+
+    # a deleted image is drawn again, by refitting the bin
+    os.remove(image)
+    record, refit_info, _ = run()
+    assert not record['from_cache'] and image.is_file()
+    assert refit_info['raw_yield'] == pytest.approx(fit_info['raw_yield'])
+    assert run()[0]['from_cache']
+
+def test_working_point_summary(tmp_path):
+    # d0xy of the signal (first candidates) narrower than that of the background
+    mass = get_mass(permute=False)
+    n_sgn = 2500
+    rng = np.random.default_rng(12)
+    d0xy = np.concatenate([rng.normal(0., 0.001, n_sgn), rng.normal(0., 0.003, len(mass) - n_sgn)])
+    df = pd.DataFrame({'fM': mass, 'fPhi': rng.uniform(0., 2 * np.pi, len(mass)), 'fImpactParameterXY': d0xy})
+    _, summary, _, exports = process_working_point(df, 'sel', 2, 4, get_cfg(tmp_path), 'cent_0_10/pt_2_4/wp',
+                                                   get_partition(0, 10, 2, 4, 0.1, 0.5), nphibins=2)
+    for export in exports:
+        if export[2].__name__ == 'get_figure':
+            plt.close(export[3][0])
+    assert summary['valid']
+    for iphi in range(2):
+        np.testing.assert_allclose(summary[f'sigma68_d0xy_phi_{iphi}'], 0.001, rtol=0.15)
+        np.testing.assert_allclose(summary[f'sigma_d0xy_phi_{iphi}'], 0.001, rtol=0.25)
@@ -0,0 +1,61 @@
+'''
+Tests of the grouped weighted statistics against NumPy
+'''
+import numpy as np
+
+from stats_utils import grouped_moments, weighted_quantiles, histogram
+
+QUANTILES = [0., 0.05, 0.158655, 0.25, 0.5, 0.75, 0.841345, 0.99, 1.]
+
+def test_weighted_quantiles_unit_weights():
+    rng = np.random.default_rng(7)
+    values = rng.normal(size=200)
+    np.testing.assert_array_equal(weighted_quantiles(values, QUANTILES)[0],
+                                  np.quantile(values, QUANTILES, method='inverted_cdf'))
+
+def test_weighted_quantiles_integer_weights():
+    # integer weights are equivalent to repeated entries
+    rng = np.random.default_rng(8)
+    values = rng.exponential(size=150)
+    weights = rng.integers(1, 5, len(values))
+    np.testing.assert_array_equal(weighted_quantiles(values, QUANTILES, weights)[0],
+                                  np.quantile(np.repeat(values, weights), QUANTILES, method='inverted_cdf'))
+
+def test_weighted_quantiles_groups():
+    rng = np.random.default_rng(9)
+    values = rng.normal(size=400)
+    weights = rng.integers(1, 4, len(values)).astype(np.float64)
+    groups = rng.integers(0, 3, len(values))
+    quantiles = weighted_quantiles(values, QUANTILES, weights, groups, n_groups=4)
+    assert quantiles.shape == (4, len(QUANTILES))
+    for group in range(3):
+        sel = groups == group
+        np.testing.assert_array_equal(quantiles[group], np.quantile(np.repeat(values[sel], weights[sel].astype(int)),
+                                                                    QUANTILES, method='inverted_cdf'))
+    # no entry in the last group
+    assert np.isnan(quantiles[3]).all()
+
+def test_grouped_moments():
+    rng = np.random.default_rng(10)
+    values = {'x': rng.normal(size=300), 'y': rng.uniform(size=300)}
+    weights = rng.uniform(0.5, 2., 300)
+    groups = rng.integers(0, 2, 300)
+    moments = grouped_moments(values, weights, groups, n_groups=3)
+    for ivar, var in enumerate(values.values()):
+        for group in range(2):
+            sel = groups == group
+            mean = np.average(var[sel], weights=weights[sel])
+            np.testing.assert_allclose(moments['mean'][ivar, group], mean)
+            np.testing.assert_allclose(moments['var'][ivar, group], np.average((var[sel] - mean)**2, weights=weights[sel]))
+    np.testing.assert_allclose(moments['neff'][:2], [weights[groups == group].sum()**2 / (weights[groups == group]**2).sum()
+                                                     for group in range(2)])
+    assert moments['sumw'][2] == 0 and np.isnan(moments['mean'][:, 2]).all()
+
+def test_histogram():
+    rng = np.random.default_rng(11)
+    values, weights = rng.normal(size=500), rng.uniform(size=500)
+    hist = histogram(values, 20, -2., 2., weights)
+    np.testing.assert_array_equal(hist['entries'][1:-1], np.histogram(values, 20, (-2., 2.))[0])
+    np.testing.assert_allclose(hist['sumw'][1:-1], np.histogram(values, 20, (-2., 2.), weights=weights)[0])
+    np.testing.assert_allclose(hist['sumw2'][1:-1], np.histogram(values, 20, (-2., 2.), weights=weights**2)[0])
+    assert hist['entries'][0] == np.sum(values < -2.) and hist['entries'][-1] == np.sum(values >= 2.)